@@ -3,14 +3,24 @@ import json
 import os
 
 
-from flask import Flask, redirect, request, make_response, session, jsonify, render_template_string
+from flask import Flask, redirect, request, make_response, session, jsonify, render_template_string, g
 from flask_cors import CORS
 from flask_session import Session
 
 # gevent.monkey.patch_all()
 
-from config import redis_client, AUTH_SERVICE_DOMAIN, FLASK_SECRET_KEY
+from config import redis_client, AUTH, AUTH_SERVICE_DOMAIN, FLASK_SECRET_KEY
 from routes import routes_blueprint
+from metrics import init_metrics
+from profiler import init_profiler
+from tracing import init_tracing
+from rate_limit import init_rate_limits
+from degraded_mode import init_degraded_mode, redis_degraded
+from user_state import user_state_blueprint
+from change_feed import change_feed_blueprint
+from codec import CodecJSONProvider
+from token_generation import get_signing_key
+from userinfo_cookie import signer as userinfo_cookie_signer
 
 
 # Logging setup
@@ -18,7 +28,7 @@ def setup_logging():
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.INFO)
     if not logger.handlers:
-        file_handler = logging.FileHandler(os.path.join(os.getcwd(), 'app.log'))
+        file_handler = logging.FileHandler(os.path.join(os.getcwd(), 'app.log'), delay=True)
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s-%(lineno)d - %(message)s')
         file_handler.setFormatter(formatter)
         logger.addHandler(file_handler)
@@ -26,9 +36,28 @@ def setup_logging():
 
 logger = setup_logging()
 
+def init_logging():
+    # Console logging for every module (previously set up as an import side effect of arcgis_api)
+    logging.basicConfig(level=logging.INFO)
+
+def init_resources():
+    """
+    Explicit initialization phase. Loads configuration and the signing key once so that,
+    under `gunicorn --preload`, they live in the master and are shared copy-on-write with
+    workers; a missing FLASK_SECRET_KEY fails here. Network clients (Redis, HTTP) stay lazy and are built in each worker after fork.
+    """
+    AUTH._resolve()
+    get_signing_key()
+    userinfo_cookie_signer._resolve()
+    logger.info("Application resources initialized")
+
 def create_app():
+    init_logging()
+    init_resources()
+
     # Initialize the Flask application
     app = Flask(__name__)
+    app.json = CodecJSONProvider(app)
 
     # Configure the app
     app.secret_key = FLASK_SECRET_KEY
@@ -50,6 +79,8 @@ def create_app():
 
     # Initialize session after app creation
     Session(app)
+    # Sessions are neither read nor written while Redis is unreachable (see degraded_mode.py)
+    init_degraded_mode(app)
     # Register before_request function
     @app.before_request
     def log_request():
@@ -58,11 +89,26 @@ def create_app():
     # Register after_request function
     @app.after_request
     def commit_session(response):
-        session.modified = True
+        # Rejected requests leave no session write behind (see rate_limit.py), nor does degraded mode
+        if not g.get('rate_limited') and not redis_degraded():
+            session.modified = True
         return response
 
     # Register the blueprint for routing
     app.register_blueprint(routes_blueprint)
+    # Bulk user-state queries for admins (403 unless ADMIN_API_TOKEN is set)
+    app.register_blueprint(user_state_blueprint)
+    # Change-data feed reads and consumer offsets for admins (see change_feed.py)
+    app.register_blueprint(change_feed_blueprint)
+
+    # Request latency instrumentation and the /metrics endpoint
+    init_metrics(app)
+    # Per-request sampling profiler and /admin/profiles (no-op unless configured)
+    init_profiler(app)
+    # Per-request spans, carried across the login redirects (no-op unless TRACING_EXPORTERS is set)
+    init_tracing(app)
+    # Admission control for /auth and /callback; registered last so the hooks above see rejections
+    init_rate_limits(app)
 
 
     return app
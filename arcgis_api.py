@@ -1,13 +1,16 @@
 import logging
-import requests
+import time
 
-from config import ARCGIS_CLIENT_URL, ARCGIS_CLIENT_ID, ARCGIS_CLIENT_SECRET
+import requests
 
-# Set up logging to both console and a file
-logging.basicConfig(level=logging.INFO)
+from config import ARCGIS_CLIENT_URL, ARCGIS_CLIENT_ID, ARCGIS_CLIENT_SECRET, http_session, \
+    ARCGIS_TOKEN_EXPIRY_MARGIN_SECONDS, ARCGIS_TOKEN_REFRESH_BEFORE_SECONDS
+from metrics import timed_dependency
+from redis_helpers import get_cached_arcgis_token, put_cached_arcgis_token, record_change
+from singleflight import single_flight
 
-# Create a file handler to log messages to a file
-file_handler = logging.FileHandler('./arcgis_api.log')
+# Console logging is configured by app.init_logging(); create a file handler to log messages to a file
+file_handler = logging.FileHandler('./arcgis_api.log', delay=True)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 file_handler.setFormatter(formatter)
 
@@ -16,22 +19,36 @@ logger = logging.getLogger()
 logger.addHandler(file_handler)
 
 # Remove '/home/' from the end of ARCGIS_CLIENT_URL
-ARCGIS_API_URL = ARCGIS_CLIENT_URL.rstrip('/home/') + '/'
-
-# Print the result
-print("ARCGIS_API_URL:", ARCGIS_API_URL)
+ARCGIS_API_URL = (ARCGIS_CLIENT_URL or '').rstrip('/home/') + '/'
+TOKEN_EXPIRATION_MINUTES = 60
 
 def get_token():
+    """Service-account token, shared by all workers through Redis and refreshed ahead of expiry."""
+    token, _ = get_cached_arcgis_token()
+    return token or generate_token()
+
+def refresh_token(min_remaining_seconds=ARCGIS_TOKEN_REFRESH_BEFORE_SECONDS):
+    """Generate a new token if the cached one expires within `min_remaining_seconds` (scheduler job)."""
+    token, remaining_ms = get_cached_arcgis_token()
+    if token and remaining_ms > min_remaining_seconds * 1000:
+        return False
+    if generate_token() is None:
+        raise RuntimeError('ArcGIS generateToken failed')
+    return True
+
+@single_flight('arcgis.generate_token')
+@timed_dependency('arcgis')
+def generate_token():
     headers = {'content-type': 'application/x-www-form-urlencoded'}
     parameters = {'username': ARCGIS_CLIENT_ID,
                   'password': ARCGIS_CLIENT_SECRET,
                   'client': 'referer',
                   'referer': ARCGIS_API_URL,
-                  'expiration': 60,
+                  'expiration': TOKEN_EXPIRATION_MINUTES,
                   'f': 'json'}
     url = f"{ARCGIS_API_URL}sharing/rest/generateToken?"
     logger.info(f"Requesting token from {url}")
-    response = requests.post(url, data=parameters, headers=headers)
+    response = http_session.post(url, data=parameters, headers=headers)
 
     try:
         logger.info(f"Response Status: {response.status_code}")
@@ -39,6 +56,11 @@ def get_token():
         jsonResponse = response.json()
         if 'token' in jsonResponse:
             logger.info("Token retrieved successfully.")
+            # Stop handing the token out a margin before the portal expires it
+            expires_ms = jsonResponse.get('expires', (time.time() + TOKEN_EXPIRATION_MINUTES * 60) * 1000)
+            ttl_ms = int(expires_ms - time.time() * 1000) - ARCGIS_TOKEN_EXPIRY_MARGIN_SECONDS * 1000
+            if ttl_ms > 0:
+                put_cached_arcgis_token(jsonResponse['token'], ttl_ms)
             return jsonResponse['token']
         elif 'error' in jsonResponse:
             logger.error(f"Error retrieving token: {jsonResponse['error']['message']}")
@@ -47,6 +69,8 @@ def get_token():
     except ValueError:
         logger.exception("An error occurred while parsing the token response.")
 
+@single_flight('arcgis.get_user_from_username')
+@timed_dependency('arcgis')
 def get_user_from_username(username):
     if username is None:
         logger.warning("Username is None.")
@@ -58,7 +82,7 @@ def get_user_from_username(username):
         'token': token
     }
     logger.info(f"Getting user info for username: {username}")
-    response = requests.get(url, params=params)
+    response = http_session.get(url, params=params)
     try:
         response.raise_for_status()  # Raise an exception for any HTTP error
         logger.info(f"Response Status: {response.status_code}")
@@ -68,6 +92,8 @@ def get_user_from_username(username):
         logger.error(f"Request failed: {e}")
         return None
 
+@single_flight('arcgis.get_user_by_email')
+@timed_dependency('arcgis')
 def get_user_by_email(user_email):
     if user_email is None:
         logger.warning("User email is None.")
@@ -81,7 +107,7 @@ def get_user_by_email(user_email):
         'q': f'email:{user_email}'
     }
     logger.info(f"Searching for user by email: {user_email}")
-    email_query_response = requests.get(url, params=email_query_params)
+    email_query_response = http_session.get(url, params=email_query_params)
     try:
         email_query_response.raise_for_status()
         response_json = email_query_response.json()
@@ -108,7 +134,7 @@ def get_user_by_email(user_email):
         'q': f'username:{default_username}*'
     }
     logger.info(f"Searching for user by default username: {default_username}")
-    username_query_response = requests.get(url, params=username_query_params)
+    username_query_response = http_session.get(url, params=username_query_params)
     try:
         username_query_response.raise_for_status()
         response_json = username_query_response.json()
@@ -131,6 +157,8 @@ def get_user_by_email(user_email):
     logger.info(f"User {user_email} not found in ArcGIS")
     return None
 
+@single_flight('arcgis.get_group_by_title')
+@timed_dependency('arcgis')
 def get_group_by_title(group_title):
     if group_title is None:
         logger.warning("Group title is None.")
@@ -143,7 +171,7 @@ def get_group_by_title(group_title):
         'q': f'title:{group_title}'
     }
     logger.info(f"Searching for group by title: {group_title}")
-    response = requests.get(url, params=params)
+    response = http_session.get(url, params=params)
     try:
         response.raise_for_status()
         response_json = response.json()
@@ -173,29 +201,76 @@ def get_group_by_title(group_title):
     logger.info(f"Group {group_title} not found.")
     return None
 
-def add_user_to_groups(user, all_groups):
+@timed_dependency('arcgis')
+def add_user_to_groups(user, all_groups, groups=None):
+    """
+    Add the user to each titled group; `groups` maps titles to already resolved groups ({'id', 'title'}).
+    Returns the titles that were not applied (group not found, request failed or user not added).
+    """
     if not all([user, all_groups]):
         logger.warning("User, all_groups, or proper_group_names is None.")
-        return
+        return list(all_groups or [])
+    groups = groups or {}
     token = get_token()
+    not_applied = []
     for group_name in all_groups:
-        group = get_group_by_title(group_name)
-        if group:
-            url = f"{ARCGIS_API_URL}sharing/rest/community/groups/{group['id']}/addUsers"
-            params = {
-                'f': 'json',
-                'token': token,
-                'users': user['username']
-            }
-            logger.info(f"Adding user {user['username']} to group {group['title']}.")
-            response = requests.post(url, data=params)
-            try:
-                response.raise_for_status()
-                logger.info(f"Add user response: {response.json()}")
-            except ValueError:
-                logger.error("Error parsing add user response as JSON.")
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Request failed: {e}")
+        group = groups.get(group_name) or get_group_by_title(group_name)
+        if not group:
+            not_applied.append(group_name)
+            continue
+        url = f"{ARCGIS_API_URL}sharing/rest/community/groups/{group['id']}/addUsers"
+        params = {
+            'f': 'json',
+            'token': token,
+            'users': user['username']
+        }
+        logger.info(f"Adding user {user['username']} to group {group['title']}.")
+        response = http_session.post(url, data=params)
+        try:
+            response.raise_for_status()
+            response_json = response.json()
+            logger.info(f"Add user response: {response_json}")
+            if 'error' not in response_json and user['username'] not in response_json.get('notAdded', []):
+                record_change('arcgis.add_users', group=group['title'], group_id=group['id'],
+                              usernames=[user['username']])
+                continue
+        except ValueError:
+            logger.error("Error parsing add user response as JSON.")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Request failed: {e}")
+        not_applied.append(group_name)
+    return not_applied
+
+@timed_dependency('arcgis')
+def add_users_to_group(group, usernames, token=None):
+    """Add several users to one group in a single addUsers call. Returns the usernames that were not added."""
+    if not group or not usernames:
+        return []
+    token = token or get_token()
+    url = f"{ARCGIS_API_URL}sharing/rest/community/groups/{group['id']}/addUsers"
+    params = {
+        'f': 'json',
+        'token': token,
+        'users': ','.join(usernames)
+    }
+    logger.info(f"Adding {len(usernames)} users to group {group['title']}.")
+    response = http_session.post(url, data=params)
+    try:
+        response.raise_for_status()
+        response_json = response.json()
+        logger.info(f"Add users response: {response_json}")
+        if 'error' in response_json:
+            return list(usernames)
+        not_added = response_json.get('notAdded', [])
+        added = [username for username in usernames if username not in not_added]
+        if added:
+            record_change('arcgis.add_users', group=group['title'], group_id=group['id'], usernames=added)
+        return not_added
+    except ValueError:
+        logger.error("Error parsing add users response as JSON.")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Request failed: {e}")
+    return list(usernames)
 
     
     # if __name__ == "__main__":
@@ -0,0 +1,88 @@
+import logging
+import os
+import queue
+import threading
+
+from config import ARCGIS_PREFETCH_ENABLED, ARCGIS_PREFETCH_QUEUE_SIZE, ARCGIS_PREFETCH_WORKERS
+from metrics import ARCGIS_PREFETCH
+from manage_arcgis_user_groups_helper_functions import prefetch_arcgis_lookups
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./arcgis_prefetch.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+class ArcgisPrefetcher:
+    """
+    Background prefetch of the portal lookups a new account's webhook will need.
+
+    /callback submits the user's email and returns at once; a small pool of workers resolves the
+    target groups and any existing portal user and stores them in Redis for
+    ARCGIS_PREFETCH_TTL_SECONDS. The webhook handler uses them instead of searching the portal
+    (arcgis_prefetch_lookups_total reports the hit rate). Prefetching is best effort: an email
+    already queued is not queued again, and submissions are dropped while the queue is full.
+    Workers are started lazily in the process that first submits (i.e. after fork).
+    """
+
+    def __init__(self, handler=prefetch_arcgis_lookups, max_queue_size=ARCGIS_PREFETCH_QUEUE_SIZE,
+                 workers=ARCGIS_PREFETCH_WORKERS, enabled=ARCGIS_PREFETCH_ENABLED):
+        self.handler = handler
+        self.max_queue_size = max_queue_size
+        self.workers = workers
+        self.enabled = enabled
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_workers(self):
+        if self._pid == os.getpid():
+            return
+        self._queue = queue.Queue(maxsize=self.max_queue_size)
+        self._pending = set()
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f'arcgis-prefetch-{i}', daemon=True).start()
+        self._pid = os.getpid()
+
+    def submit(self, user_email):
+        """Queue a prefetch for `user_email`. Returns False if it was skipped or dropped."""
+        if not self.enabled or not user_email:
+            return False
+        with self._lock:
+            self._ensure_workers()
+            if user_email in self._pending:
+                ARCGIS_PREFETCH.labels('skipped').inc()
+                return False
+            try:
+                self._queue.put_nowait(user_email)
+            except queue.Full:
+                ARCGIS_PREFETCH.labels('dropped').inc()
+                logger.warning(f"Prefetch queue full ({self.max_queue_size}), dropping prefetch for {user_email}")
+                return False
+            self._pending.add(user_email)
+        ARCGIS_PREFETCH.labels('queued').inc()
+        return True
+
+    def _work(self):
+        while True:
+            user_email = self._queue.get()
+            try:
+                self.handler(user_email)
+                ARCGIS_PREFETCH.labels('ok').inc()
+            except Exception as e:
+                ARCGIS_PREFETCH.labels('failed').inc()
+                logger.error(f"Prefetch for {user_email} failed: {e}", exc_info=True)
+            finally:
+                with self._lock:
+                    self._pending.discard(user_email)
+                self._queue.task_done()
+
+    def join(self):
+        """Wait until every queued prefetch has run (tests and tooling)."""
+        self._queue.join()
+
+
+arcgis_prefetcher = ArcgisPrefetcher()
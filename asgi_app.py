@@ -0,0 +1,102 @@
+"""
+ASGI entry point (async mode).
+
+The login routes listed in async_routes.ASYNC_ROUTES are served by a Quart app on one event loop
+per worker; every other path (webhooks, admin, /metrics) is handed to the unchanged Flask app
+from app.py, run in a thread pool by hypercorn's WSGI middleware. Both share Redis, keys and
+metrics, so a deployment can move between modes without migrating anything:
+
+    PROMETHEUS_MULTIPROC_DIR=/tmp/prometheus_multiproc hypercorn --workers 4 --bind 0.0.0.0:80 asgi_app:app
+
+The sync deployment (gunicorn.conf.py, app:create_app()) is unchanged and stays the default.
+Async mode does not yet record tracing spans for the async routes.
+"""
+import asyncio
+import time
+
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from quart import Quart, g, request
+
+from app import create_app, init_logging, init_resources, logger
+from async_redis_helpers import take_rate_limit_tokens
+from async_routes import ASYNC_ROUTES, async_routes_blueprint
+from config import RATE_LIMIT_ENABLED, RATE_LIMIT_TRUSTED_PROXIES, WEBHOOK_DRAIN_TIMEOUT_SECONDS
+from metrics import REQUEST_LATENCY, REQUESTS_IN_FLIGHT
+from rate_limit import ROUTE_LIMITS, forwarded_client_ip, rate_limit_decision, rate_limiter_unavailable, \
+    route_buckets
+from webhook_processor import webhook_processor
+
+
+async def check_rate_limit():
+    """Async rate_limit.check_rate_limit."""
+    route = request.url_rule.rule if request.url_rule else None
+    if route not in ROUTE_LIMITS:
+        return None
+    ip = forwarded_client_ip(request.headers.get('X-Forwarded-For', ''), request.remote_addr,
+                             RATE_LIMIT_TRUSTED_PROXIES)
+    buckets, scopes = route_buckets(route, ip)
+    if not buckets:
+        return None
+    try:
+        result = await take_rate_limit_tokens(buckets)
+    except Exception as e:
+        return rate_limiter_unavailable(route, e)
+    return rate_limit_decision(route, ip, buckets, scopes, result)
+
+
+def init_async_metrics(app):
+    """metrics.init_metrics for the Quart app; /metrics itself is served by the Flask app."""
+
+    @app.before_request
+    async def start_request_timer():
+        g.metrics_start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+
+    @app.after_request
+    async def record_request_latency(response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            REQUEST_LATENCY.labels(route, request.method, response.status_code).observe(time.perf_counter() - start)
+        return response
+
+    @app.teardown_request
+    async def finish_request(exc):
+        REQUESTS_IN_FLIGHT.dec()
+
+
+def create_async_app():
+    init_logging()
+    init_resources()
+
+    app = Quart(__name__)
+    app.register_blueprint(async_routes_blueprint)
+    init_async_metrics(app)
+
+    @app.after_serving
+    async def drain_webhook_events():
+        # worker_exit in gunicorn.conf.py, for hypercorn: finish the events already answered 200
+        await asyncio.to_thread(webhook_processor.stop, WEBHOOK_DRAIN_TIMEOUT_SECONDS)
+
+    # Registered last, as in create_app, so the metrics hooks see rejections
+    if RATE_LIMIT_ENABLED:
+        app.before_request(check_rate_limit)
+    return app
+
+
+def create_asgi_app():
+    """One ASGI callable: async login routes on Quart, everything else on the Flask app."""
+    async_app = create_async_app()
+    flask_app = AsyncioWSGIMiddleware(create_app())
+
+    async def dispatch(scope, receive, send):
+        if scope['type'] == 'lifespan' or (scope['type'] == 'http' and scope['path'] in ASYNC_ROUTES):
+            await async_app(scope, receive, send)
+        else:
+            await flask_app(scope, receive, send)
+
+    logger.info(f"ASGI app created, async routes: {', '.join(ASYNC_ROUTES)}")
+    return dispatch
+
+
+app = create_asgi_app()
@@ -0,0 +1,192 @@
+"""
+redis.asyncio counterparts of the redis_helpers functions on the login path, for async_routes.py.
+
+Keys, encodings, scripts and the commands queued on pipelines are shared with redis_helpers, so
+both modes read and write the same data. Error handling matches the sync helpers: reads that fail
+return None (and fall back to the recent cache in degraded mode), writes that find Redis
+unavailable are buffered and replayed with the sync client when it is back.
+"""
+import asyncio
+import logging
+
+from config import async_redis_client, redis_client, OIDC_TRANSACTION_TTL_SECONDS
+from codec import encode, decode
+from degraded_mode import UNAVAILABLE_ERRORS, recent_cache, redis_degraded, write_buffer
+from metrics import observe_redis
+from redis_helpers import (
+    ACCESS_TOKEN_TO_USERINFO_KEY, AUTH_CODE_TO_ACCESS_TOKEN_KEY, IDP_ACCESS_TOKEN_KEY, IDP_ACCESS_TOKEN_TTL_SECONDS,
+    LOGIN_USERINFO_KEY, OIDC_TRANSACTION_KEY, RATE_LIMIT_KEY, REFRESH_TOKEN_KEY, ROTATE_REFRESH_SCRIPT,
+    TOKEN_BUCKET_SCRIPT, USER_RECORD_KEY, USER_TOKEN_INDEX_KEY,
+    cached_read, decode_fields, login_token_items, migrate_user_record, needs_migration, queue_index_keys,
+    queue_login_tokens, queue_login_userinfo, queue_user_update, redeemed, rotate_refresh_arguments,
+    token_bucket_arguments, token_bucket_result, user_record_key,
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./redis.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+_scripts = {}
+
+
+def _script(source):
+    if source not in _scripts:
+        _scripts[source] = async_redis_client.register_script(source)
+    return _scripts[source]
+
+
+async def redis_get(key):
+    try:
+        with observe_redis('hgetall', key):
+            item = await async_redis_client.hgetall(key)
+        return item or None
+    except Exception as e:
+        logger.error(f"Error reading from Redis: {e}")
+        return None
+
+
+def _replay(queue, args):
+    pipe = redis_client.pipeline(transaction=True)
+    queue(pipe, *args)
+    pipe.execute()
+
+
+async def execute_or_buffer(description, family, queue, *args):
+    """
+    Run queue(pipe, *args) as one MULTI on the async client. While Redis is unavailable the same
+    commands are put in the write-behind buffer and replayed later with the sync client.
+    """
+    if redis_degraded():
+        write_buffer.add(description, _replay, (queue, args))
+        return
+    try:
+        with observe_redis('multi', family):
+            pipe = async_redis_client.pipeline(transaction=True)
+            queue(pipe, *args)
+            await pipe.execute()
+    except UNAVAILABLE_ERRORS:
+        write_buffer.add(description, _replay, (queue, args))
+    except Exception as e:
+        logger.error(f"Error writing {description} to Redis: {e}")
+
+
+# OIDC transactions
+
+async def put_oidc_transaction(state, transaction, ttl=OIDC_TRANSACTION_TTL_SECONDS):
+    try:
+        with observe_redis('setex', OIDC_TRANSACTION_KEY):
+            await async_redis_client.setex(f"{OIDC_TRANSACTION_KEY}:{state}", ttl, encode(transaction))
+        return True
+    except Exception as e:
+        logger.error(f"Error writing to Redis: {e}")
+        return False
+
+
+async def pop_oidc_transaction(state):
+    try:
+        with observe_redis('getdel', OIDC_TRANSACTION_KEY):
+            response = await async_redis_client.getdel(f"{OIDC_TRANSACTION_KEY}:{state}")
+        return decode(response)
+    except Exception as e:
+        logger.error(f"Error reading from Redis: {e}")
+        return None
+
+
+# User record
+
+async def get_user_record(email):
+    """The decoded user record. Users not migrated yet are migrated by the sync helper in a thread."""
+    record = decode_fields(await redis_get(user_record_key(email)))
+    if needs_migration(record):
+        record = await asyncio.to_thread(migrate_user_record, email, record)
+    return record
+
+
+def queue_callback_login(pipe, email, fields, idp_token_key, token_data, userinfo_key, userinfo):
+    """Everything /callback writes after the IdP exchange, as one transaction."""
+    queue_user_update(pipe, email, fields)
+    pipe.setex(idp_token_key, IDP_ACCESS_TOKEN_TTL_SECONDS, encode(token_data))
+    queue_index_keys(pipe, email, [idp_token_key], IDP_ACCESS_TOKEN_TTL_SECONDS)
+    queue_login_userinfo(pipe, userinfo_key, userinfo)
+
+
+async def put_callback_login(email, userinfo, token_data, userinfo_handle, auth_access=None):
+    """
+    Store the login's userinfo on the user record (and auth_access, if given), the IdP token
+    response and the userinfo behind the cookie handle, in one round trip.
+    """
+    fields = {'userinfo': userinfo}
+    if auth_access is not None:
+        fields['auth_access'] = auth_access
+    userinfo_key = f"{LOGIN_USERINFO_KEY}:{userinfo_handle}"
+    recent_cache.put(userinfo_key, userinfo)
+    await execute_or_buffer(f"put_callback_login {email}", USER_RECORD_KEY, queue_callback_login, email, fields,
+                            f"{IDP_ACCESS_TOKEN_KEY}:{token_data['access_token']}", token_data, userinfo_key, userinfo)
+
+
+# Login tokens
+
+async def put_login_tokens(email, auth_code, access_token, userinfo, traceparent=None, refresh_token=None):
+    args = login_token_items(email, auth_code, access_token, userinfo, traceparent, refresh_token)
+    await execute_or_buffer(f"put_login_tokens {email}", USER_TOKEN_INDEX_KEY, queue_login_tokens, *args)
+
+
+async def put_login_userinfo(handle, userinfo):
+    key = f"{LOGIN_USERINFO_KEY}:{handle}"
+    recent_cache.put(key, userinfo)
+    await execute_or_buffer(f"put_login_userinfo {handle}", LOGIN_USERINFO_KEY, queue_login_userinfo, key, userinfo)
+
+
+async def get_login_userinfo(handle):
+    key = f"{LOGIN_USERINFO_KEY}:{handle}"
+    try:
+        with observe_redis('get', LOGIN_USERINFO_KEY):
+            response = await async_redis_client.get(key)
+        return cached_read(key, decode(response))
+    except Exception as e:
+        logger.error(f"Error reading from Redis: {e}")
+        return recent_cache.fallback(key)
+
+
+async def redeem_auth_code(auth_code):
+    """See redis_helpers.redeem_auth_code."""
+    key = f"{AUTH_CODE_TO_ACCESS_TOKEN_KEY}:{auth_code}"
+    try:
+        with observe_redis('multi', AUTH_CODE_TO_ACCESS_TOKEN_KEY):
+            pipe = async_redis_client.pipeline(transaction=True)
+            pipe.hgetall(key)
+            pipe.delete(key)
+            item, _ = await pipe.execute()
+    except Exception as e:
+        logger.error(f"Error reading from Redis: {e}")
+        item = None
+    return redeemed(key, item)
+
+
+async def get_access_token_to_userinfo(access_token):
+    key = f"{ACCESS_TOKEN_TO_USERINFO_KEY}:{access_token}"
+    return cached_read(key, decode_fields(await redis_get(key)))
+
+
+async def rotate_refresh_token(refresh_token, new_refresh_token, access_token, access_token_ttl):
+    """See redis_helpers.rotate_refresh_token."""
+    call = rotate_refresh_arguments(refresh_token, new_refresh_token, access_token, access_token_ttl)
+    if call is None:
+        return 'invalid', None
+    keys, args = call
+    with observe_redis('evalsha', REFRESH_TOKEN_KEY):
+        outcome, email = await _script(ROTATE_REFRESH_SCRIPT)(keys=keys, args=args, client=async_redis_client)
+    return outcome, email or None
+
+
+# Rate limiting
+
+async def take_rate_limit_tokens(buckets, cost=1):
+    """See redis_helpers.take_rate_limit_tokens; raises on Redis errors."""
+    keys, args = token_bucket_arguments(buckets, cost)
+    with observe_redis('evalsha', RATE_LIMIT_KEY):
+        result = await _script(TOKEN_BUCKET_SCRIPT)(keys=keys, args=args, client=async_redis_client)
+    return token_bucket_result(result)
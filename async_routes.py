@@ -0,0 +1,209 @@
+"""
+Async variants of the login routes for ASGI mode (see asgi_app.py).
+
+/auth, /callback, /arcgis_callback, /token and /userinfo spend nearly all their time waiting on
+login.gov and Redis. Here they run on Quart with httpx and redis.asyncio, so a worker holds many
+logins in flight on one event loop instead of one per greenlet. What each route decides comes
+from login_flow.py, the same functions the Flask routes in routes.py use; only the I/O differs.
+/callback also batches its writes into one Redis transaction (see put_callback_login).
+"""
+import logging
+
+import httpx
+import redis
+from quart import Blueprint, jsonify, redirect, request
+
+from config import LazyResource, ARCGIS_LOGIN_CALLBACK_URL, ACCESS_TOKEN_TTL_SECONDS, ASYNC_HTTP_MAX_CONNECTIONS, \
+    USERINFO_COOKIE_TTL_SECONDS
+from token_generation import OIDC_BINDING_COOKIE, construct_idp_token_post, construct_idp_userinfo_get, \
+    handle_userinfo_response, idp_authorization_request, oidc_binding_matches, read_idp_token_response, \
+    set_oidc_binding_cookie
+from login_flow import (
+    arcgis_login_redirect, callback_decision, complete_userinfo, login_return_target, new_login_tokens,
+    prepare_refresh_grant, record_refresh_outcome, should_prefetch, token_response
+)
+from async_redis_helpers import (
+    get_access_token_to_userinfo, get_login_userinfo, get_user_record, pop_oidc_transaction, put_callback_login,
+    put_login_tokens, put_login_userinfo, put_oidc_transaction, redeem_auth_code, rotate_refresh_token
+)
+from arcgis_prefetch import arcgis_prefetcher
+from userinfo_cookie import is_legacy_userinfo_cookie, legacy_userinfo, new_userinfo_cookie, userinfo_cookie_handle
+from metrics import observe_outbound, TOKEN_GRANTS
+from tracing import set_attribute
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./async_routes.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+async_routes_blueprint = Blueprint("async_routes", __name__)
+
+# Paths served by this blueprint in ASGI mode; everything else goes to the Flask app
+ASYNC_ROUTES = ('/auth', '/callback', '/arcgis_callback', '/token', '/userinfo')
+
+
+def _create_async_http_client():
+    limits = httpx.Limits(max_connections=ASYNC_HTTP_MAX_CONNECTIONS, max_keepalive_connections=20)
+    return httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(30.0))
+
+
+async_http_client = LazyResource(_create_async_http_client, per_process=True, cls=httpx.AsyncClient)
+
+
+async def load_userinfo_cookie(cookie):
+    """Async userinfo_cookie.load_userinfo_cookie."""
+    if not cookie:
+        return None
+    if is_legacy_userinfo_cookie(cookie):
+        return legacy_userinfo(cookie)
+    handle = userinfo_cookie_handle(cookie)
+    return await get_login_userinfo(handle) if handle else None
+
+
+async def issue_userinfo_cookie(userinfo):
+    """Async userinfo_cookie.issue_userinfo_cookie; /callback stores its userinfo with put_callback_login instead."""
+    handle, cookie = new_userinfo_cookie()
+    await put_login_userinfo(handle, userinfo)
+    return cookie
+
+
+@async_routes_blueprint.route('/auth')
+async def auth():
+    redirect_url, state, transaction, binding = idp_authorization_request(
+        login_return_target(request.args.get('return_to')))
+    if not await put_oidc_transaction(state, transaction):
+        return 'Sign-in is temporarily unavailable, please try again', 503
+    response = redirect(redirect_url)
+    set_oidc_binding_cookie(response, binding)
+
+    # Clear old session coookies
+    response.set_cookie("session", "", expires=0)
+
+    # Set a new session cookie
+    response.set_cookie("session", "new_session_value", httponly=True, secure=True, samesite="Lax")
+    return response
+
+
+@async_routes_blueprint.route('/callback')
+async def callback():
+    """Handle IDP callback and authenticate user."""
+    auth_code = request.args.get('code')
+    if not auth_code:
+        return 'Authorization code missing', 400
+
+    # The transaction written by /auth; consuming it makes each state single-use
+    state = request.args.get('state')
+    transaction = await pop_oidc_transaction(state) if state else None
+    if not transaction:
+        logger.warning(f'Callback with unknown or expired OIDC state: {state}')
+        return 'Login expired or invalid, please sign in again', 400
+    if not oidc_binding_matches(transaction, request.cookies.get(OIDC_BINDING_COOKIE)):
+        logger.warning(f'Callback with OIDC state {state} from a browser that did not start the login')
+        return 'Login expired or invalid, please sign in again', 400
+    return_to = transaction.get('return_to') or ARCGIS_LOGIN_CALLBACK_URL
+
+    token_url, headers, data = construct_idp_token_post(auth_code)
+    with observe_outbound('login.gov', 'token'):
+        idp_token_response = await async_http_client.post(token_url, headers=headers, data=data)
+    token_data = read_idp_token_response(idp_token_response, nonce=transaction.get('nonce'))
+    if isinstance(token_data, tuple):
+        return token_data
+
+    userinfo_url, headers = construct_idp_userinfo_get(token_data['access_token'])
+    with observe_outbound('login.gov', 'userinfo'):
+        userinfo_response = await async_http_client.get(userinfo_url, headers=headers)
+    userinfo = handle_userinfo_response(userinfo_response)
+    if isinstance(userinfo, tuple):
+        return userinfo
+    if not userinfo:
+        return "Error: Userinfo missing", 400
+
+    user_email = userinfo.get('email')
+    set_attribute('enduser.id', user_email)
+    complete_userinfo(userinfo)
+
+    user_record = await get_user_record(user_email)
+    location, set_userinfo_cookie, auth_access = callback_decision(userinfo, user_record, return_to)
+    handle, userinfo_cookie = new_userinfo_cookie()
+    await put_callback_login(user_email, userinfo, token_data, handle, auth_access)
+    logger.info(f'User info processed for email: {user_email}')
+
+    if should_prefetch(user_email, user_record):
+        arcgis_prefetcher.submit(user_email)
+
+    response = redirect(location)
+    response.delete_cookie(OIDC_BINDING_COOKIE, path='/callback')
+    if set_userinfo_cookie:
+        response.set_cookie('userinfo', userinfo_cookie)
+    return response
+
+
+@async_routes_blueprint.route('/arcgis_callback')
+async def arcgis_callback():
+    try:
+        arcgis_auth_code, arcgis_access_token, refresh_token = new_login_tokens()
+
+        userinfo_cookie = request.cookies.get('userinfo')
+        userinfo = await load_userinfo_cookie(userinfo_cookie)
+        if not userinfo:
+            return "Error: UID missing in user info", 400
+        if not userinfo.get('email'):
+            return "Error: Email missing in user info", 400
+        if is_legacy_userinfo_cookie(userinfo_cookie):
+            userinfo_cookie = await issue_userinfo_cookie(userinfo)
+        set_attribute('enduser.id', userinfo.get('email'))
+
+        # Code, token and refresh token family are indexed under the user so account deletion revokes them
+        await put_login_tokens(userinfo.get('email'), arcgis_auth_code, arcgis_access_token, userinfo,
+                               refresh_token=refresh_token)
+
+        response = redirect(arcgis_login_redirect(arcgis_auth_code))
+        response.set_cookie("userinfo", userinfo_cookie, httponly=True, secure=True, max_age=USERINFO_COOKIE_TTL_SECONDS)
+        return response
+    except Exception as e:
+        logger.error(f"Error in arcgis_callback: {str(e)}")
+        return "Internal server error", 500
+
+
+@async_routes_blueprint.route('/token', methods=['POST'])
+async def token():
+    form = await request.form
+    if form.get('grant_type') == 'refresh_token':
+        return await refresh_token_grant(form.get('refresh_token'))
+
+    auth_code_record = await redeem_auth_code(form.get('code')) if form.get('code') else None
+    if not auth_code_record:
+        TOKEN_GRANTS.labels('authorization_code', 'invalid').inc()
+        return jsonify({"error": "invalid_grant"}), 400
+    TOKEN_GRANTS.labels('authorization_code', 'ok').inc()
+    return jsonify(token_response(auth_code_record['access_token'], auth_code_record.get('refresh_token')))
+
+
+async def refresh_token_grant(refresh_token):
+    grant = prepare_refresh_grant(refresh_token)
+    if not grant:
+        return jsonify({"error": "invalid_grant"}), 400
+
+    arcgis_access_token, new_refresh_token = grant
+    try:
+        outcome, email = await rotate_refresh_token(refresh_token, new_refresh_token, arcgis_access_token,
+                                                    ACCESS_TOKEN_TTL_SECONDS)
+    except redis.RedisError as e:
+        logger.error(f"Refresh token grant failed: {e}")
+        return jsonify({"error": "temporarily_unavailable"}), 503
+    if not record_refresh_outcome(refresh_token, outcome, email):
+        return jsonify({"error": "invalid_grant"}), 400
+
+    set_attribute('enduser.id', email)
+    return jsonify(token_response(arcgis_access_token, new_refresh_token))
+
+
+@async_routes_blueprint.route('/userinfo')
+async def userinfo_route():
+    auth_header = request.headers.get('Authorization') or ''
+    userinfo = (await get_access_token_to_userinfo(auth_header[7:]) or {}).get('userinfo')
+    if not userinfo:
+        return jsonify({"error": "Token invalid or expired"}), 401
+    return jsonify(userinfo)
@@ -0,0 +1,59 @@
+import json
+
+from benchmarks.bench_userinfo_cookie import USERINFO
+from benchmarks.registry import SkipCase, case
+
+AUTH_ACCESS = {'is_disallowed': False, 'has_selected_group': True, 'disallowed_selected_group': None}
+
+
+def _report_sizes():
+    from codec import CODECS, encode
+    for label, value in (('userinfo', USERINFO), ('auth_access', AUTH_ACCESS)):
+        sizes = {'json': len(json.dumps(value).encode())}
+        sizes.update({tag: len(encode(value, codec=tag).encode()) for tag in CODECS})
+        print(f'  {label} encoded bytes: {sizes}')
+
+
+@case('codec.legacy_json_roundtrip')
+def bench_legacy_json():
+    _report_sizes()
+    return lambda: json.loads(json.dumps(USERINFO))
+
+
+def _codec_case(tag):
+    from codec import CODECS, decode, encode
+    if tag not in CODECS:
+        raise SkipCase(f'codec {tag} not available')
+    return lambda: decode(encode(USERINFO, codec=tag))
+
+
+@case('codec.j1_roundtrip')
+def bench_j1():
+    return _codec_case('j1')
+
+
+@case('codec.o1_roundtrip')
+def bench_o1():
+    return _codec_case('o1')
+
+
+@case('codec.redis_user_auth_access_memory', requires_redis=True)
+def bench_redis_memory():
+    """Memory per user-auth-access key for each encoding (MEMORY USAGE, where the server supports it)."""
+    from codec import CODECS, encode
+    from config import redis_client
+    key = 'bench-codec-memory'
+    usage = {}
+    for tag in ('json', *CODECS):
+        redis_client.delete(key)
+        redis_client.hset(key, mapping={'user_email': USERINFO['email'], 'auth_access': encode(AUTH_ACCESS, codec=tag)})
+        try:
+            usage[tag] = redis_client.memory_usage(key)
+        except Exception:
+            usage = None
+            break
+    redis_client.delete(key)
+    print(f'  user-auth-access MEMORY USAGE per key: {usage or "not supported by this server"}')
+    from redis_helpers import get_user_auth_access, put_user_auth_access
+    put_user_auth_access('bench@usgs.gov', AUTH_ACCESS)
+    return lambda: get_user_auth_access('bench@usgs.gov')
@@ -0,0 +1,48 @@
+from benchmarks.registry import case
+
+RULE_COUNT = 5000
+EMAIL = 'jane_doe@region4.contractor.agency4999.gov'
+
+
+def _rules():
+    org_domains = {f'agency{i}.gov': f'agency{i}' for i in range(RULE_COUNT)}
+    bypass_domains = [f'contractor.agency{i}.gov' for i in range(RULE_COUNT)]
+    bypass_users = [f'user{i}@agency{i}.gov' for i in range(RULE_COUNT)]
+    return org_domains, bypass_users, bypass_domains
+
+
+@case(f'email_policy.get_org_{RULE_COUNT}_rules')
+def bench_get_org():
+    from email_policy import EmailPolicy
+    policy = EmailPolicy(*_rules())
+    return lambda: policy.get_org(EMAIL)
+
+
+@case(f'email_policy.is_bypass_{RULE_COUNT}_rules')
+def bench_is_bypass():
+    from email_policy import EmailPolicy
+    policy = EmailPolicy(*_rules())
+    return lambda: policy.is_bypass(EMAIL)
+
+
+@case(f'email_policy.linear_endswith_scan_{RULE_COUNT}_rules')
+def bench_linear_scan():
+    """The previous endswith() loop over the same rules, for comparison."""
+    org_domains, _, bypass_domains = _rules()
+    domains = list(org_domains)
+
+    def scan():
+        for domain in domains:
+            if EMAIL.endswith(domain):
+                break
+        for domain in bypass_domains:
+            if EMAIL.endswith(domain):
+                break
+    return scan
+
+
+@case(f'email_policy.compile_{RULE_COUNT}_rules')
+def bench_compile():
+    from email_policy import EmailPolicy
+    rules = _rules()
+    return lambda: EmailPolicy(*rules)
@@ -0,0 +1,107 @@
+import os
+import uuid
+
+from benchmarks.registry import case
+
+X509_SUBJECT = 'C=US, O=U.S. Government, OU=Department of the Interior, OU=Geological Survey, CN=JANE Q. DOE (AFFILIATE)'
+
+
+def _ensure_signing_key():
+    if not os.environ.get('AUTH_PRIVATE_KEY'):
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        os.environ['AUTH_PRIVATE_KEY'] = key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        ).decode()
+
+
+# Token generation (every /auth, /callback and /arcgis_callback)
+
+@case('token_generation.generate_jwt_token')
+def bench_generate_jwt_token():
+    _ensure_signing_key()
+    from token_generation import generate_jwt_token, get_signing_key
+    get_signing_key()
+    return lambda: generate_jwt_token('https://idp.example.gov/api/openid_connect/token', 'client-id')
+
+
+@case('token_generation.generate_nonce')
+def bench_generate_nonce():
+    from token_generation import generate_nonce
+    return generate_nonce
+
+
+@case('token_generation.parse_x509_subject')
+def bench_parse_x509_subject():
+    from token_generation import parse_x509_subject
+    return lambda: parse_x509_subject(X509_SUBJECT)
+
+
+# Group resolution (every /callback and webhook add event)
+
+@case('groups.get_user_group')
+def bench_get_user_group():
+    from manage_arcgis_user_groups_helper_functions import get_user_group
+    return lambda: get_user_group('jane_doe@census.gov')
+
+
+@case('groups.get_parent_groups')
+def bench_get_parent_groups():
+    from manage_arcgis_user_groups_helper_functions import get_parent_groups
+    return lambda: get_parent_groups('usgs')
+
+
+@case('groups.get_user_groups')
+def bench_get_user_groups():
+    from manage_arcgis_user_groups_helper_functions import get_user_groups
+    return lambda: get_user_groups('usgs')
+
+
+@case('routes.is_usda_user')
+def bench_is_usda_user():
+    from routes import is_usda_user
+    return lambda: is_usda_user('jane_doe@census.gov')
+
+
+# Redis helpers (put/get pairs against a local Redis)
+
+def _redis_pair(put, get, *values):
+    key = f"bench:{uuid.uuid4().hex}"
+
+    def run():
+        put(key, *values)
+        get(key)
+    return run
+
+
+@case('redis_helpers.username_to_email', requires_redis=True)
+def bench_username_to_email():
+    from redis_helpers import put_username_to_email, get_username_to_email
+    return _redis_pair(put_username_to_email, get_username_to_email, 'jane_doe@usgs.gov')
+
+
+@case('redis_helpers.user_auth_access', requires_redis=True)
+def bench_user_auth_access():
+    from redis_helpers import put_user_auth_access, get_user_auth_access
+    return _redis_pair(put_user_auth_access, get_user_auth_access, {'is_disallowed': False, 'has_selected_group': False})
+
+
+@case('redis_helpers.email_to_user_groups', requires_redis=True)
+def bench_email_to_user_groups():
+    from redis_helpers import put_email_to_user_groups, get_email_to_user_groups
+    return _redis_pair(put_email_to_user_groups, get_email_to_user_groups, 'usgs')
+
+
+@case('redis_helpers.access_token_to_userinfo', requires_redis=True)
+def bench_access_token_to_userinfo():
+    from redis_helpers import put_access_token_to_userinfo, get_access_token_to_userinfo
+    userinfo = '{"sub": "abc", "email": "jane_doe@usgs.gov", "given_name": "Jane", "family_name": "Doe"}'
+    return _redis_pair(put_access_token_to_userinfo, get_access_token_to_userinfo, userinfo)
+
+
+@case('redis_helpers.auth_code_to_access_token', requires_redis=True)
+def bench_auth_code_to_access_token():
+    from redis_helpers import put_auth_code_to_access_token, get_auth_code_to_access_token
+    return _redis_pair(put_auth_code_to_access_token, get_auth_code_to_access_token, 'eyJhbGciOiJSUzI1NiJ9.payload.sig')
@@ -0,0 +1,55 @@
+from collections import deque
+
+from benchmarks.registry import case
+
+USERS = 10000
+# The one-read-per-user baseline is 10x smaller to keep the run short; scale it by 10 to compare
+PER_USER_READS = 1000
+
+
+def _emails(count):
+    return [f"bench-state-{i}@usgs.gov" for i in range(count)]
+
+
+def _ensure_users():
+    """Records for USERS users, half of them with a username alias, written once per Redis."""
+    from codec import encode
+    from config import redis_client
+    from redis_helpers import user_record_key, username_alias_key
+    emails = _emails(USERS)
+    if redis_client.exists(user_record_key(emails[-1])):
+        return emails
+    pipe = redis_client.pipeline(transaction=False)
+    for i, email in enumerate(emails):
+        record = {'version': 1, 'email': email,
+                  'auth_access': encode({'is_disallowed': False, 'has_selected_group': i % 3 == 0})}
+        if i % 2:
+            record['username'] = f"bench_state_{i}"
+            pipe.set(username_alias_key(record['username']), email)
+        pipe.hset(user_record_key(email), mapping=record)
+    pipe.execute()
+    return emails
+
+
+@case(f'user_state.bulk_query_{USERS}_users', requires_redis=True)
+def bench_bulk_query():
+    """Emails and usernames mixed, pipelined in batches and serialized to NDJSON."""
+    from user_state import iter_user_states, ndjson_line
+    emails = _ensure_users()
+    queries = [f"bench_state_{i}" if i % 4 == 1 else email for i, email in enumerate(emails)]
+
+    def run():
+        deque((ndjson_line(state) for state in iter_user_states(queries)), maxlen=0)
+    return run
+
+
+@case(f'user_state.per_user_reads_{PER_USER_READS}_users', requires_redis=True)
+def bench_per_user_reads():
+    """What the help desk did before: one round trip per user."""
+    from redis_helpers import get_user_record
+    emails = _ensure_users()[:PER_USER_READS]
+
+    def run():
+        for email in emails:
+            get_user_record(email)
+    return run
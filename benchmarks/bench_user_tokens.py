@@ -0,0 +1,78 @@
+import uuid
+
+from benchmarks.registry import case
+
+SESSIONS = (10, 100, 1000)
+# Unrelated keys a SCAN-based purge has to walk past; production has far more
+BACKGROUND_KEYS = 10000
+
+
+def _populate(sessions):
+    """Write a user's record and `sessions` logins' worth of indexed tokens in one round trip."""
+    from config import redis_client
+    from redis_helpers import (ACCESS_TOKEN_TO_USERINFO_KEY, AUTH_CODE_TO_ACCESS_TOKEN_KEY, user_record_key,
+                               user_token_index_key)
+    email = f"bench-{uuid.uuid4().hex}@usgs.gov"
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hset(user_record_key(email), mapping={'email': email})
+    token_keys = []
+    for i in range(sessions):
+        code_key = f"{AUTH_CODE_TO_ACCESS_TOKEN_KEY}:bench-{email}-c{i}"
+        token_key = f"{ACCESS_TOKEN_TO_USERINFO_KEY}:bench-{email}-t{i}"
+        pipe.hset(code_key, mapping={'auth_code': i, 'access_token': i})
+        pipe.hset(token_key, mapping={'access_token': i, 'userinfo': '{}'})
+        token_keys += [code_key, token_key]
+    pipe.sadd(user_token_index_key(email), *token_keys)
+    pipe.execute()
+    return email, token_keys
+
+
+def _ensure_background_keys():
+    from config import redis_client
+    if redis_client.exists(f"bench:background:{BACKGROUND_KEYS - 1}"):
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    for i in range(BACKGROUND_KEYS):
+        pipe.set(f"bench:background:{i}", 1)
+    pipe.execute()
+
+
+def _register(sessions):
+    @case(f'user_tokens.populate_{sessions}_sessions', requires_redis=True)
+    def bench_populate():
+        """Setup cost included in the revoke cases below; subtract it to get the revoke cost."""
+        from config import redis_client
+        from redis_helpers import user_record_key, user_token_index_key
+        _ensure_background_keys()
+
+        def run():
+            email, token_keys = _populate(sessions)
+            redis_client.delete(user_record_key(email), user_token_index_key(email), *token_keys)
+        return run
+
+    @case(f'user_tokens.populate_and_indexed_revoke_{sessions}_sessions', requires_redis=True)
+    def bench_indexed():
+        from redis_helpers import delete_user_record
+        _ensure_background_keys()
+
+        def run():
+            email, _ = _populate(sessions)
+            delete_user_record(email)
+        return run
+
+    @case(f'user_tokens.populate_and_scan_revoke_{sessions}_sessions', requires_redis=True)
+    def bench_scan():
+        """What deletion would need without the index: walk the keyspace for the user's tokens."""
+        from config import redis_client
+        from redis_helpers import user_record_key, user_token_index_key
+        _ensure_background_keys()
+
+        def run():
+            email, _ = _populate(sessions)
+            keys = list(redis_client.scan_iter(match=f"*bench-{email}-*", count=1000))
+            redis_client.delete(user_record_key(email), user_token_index_key(email), *keys)
+        return run
+
+
+for _sessions in SESSIONS:
+    _register(_sessions)
@@ -0,0 +1,68 @@
+import json
+
+from itsdangerous import Signer
+from werkzeug.http import dump_cookie, parse_cookie
+
+from benchmarks.registry import SkipCase, case
+
+# Representative login.gov userinfo for a PIV/CAC login, after callback() adds the name fields
+USERINFO = {
+    'sub': 'b2d2d115-1d7e-4579-b9d6-f8e84f4f56ca',
+    'iss': 'https://idp.int.identitysandbox.gov/',
+    'email': 'jane.doe@usda.gov',
+    'email_verified': True,
+    'all_emails': ['jane.doe@usda.gov', 'jane.doe@fs.fed.us'],
+    'ial': 'http://idmanagement.gov/ns/assurance/ial/1',
+    'aal': 'urn:gov:gsa:ac:classes:sp:PasswordProtectedTransport:duo',
+    'x509_subject': 'C=US, O=U.S. Government, OU=Department of Agriculture, OU=Forest Service, '
+                    'CN=JANE DOE OID.0.9.2342.19200300.100.1.1=12001002003004',
+    'x509_presented': True,
+    'organizations': ['U.S. Government', 'Department of Agriculture', 'Forest Service'],
+    'given_name': 'jane',
+    'family_name': 'doe',
+}
+# callback() sets the cookie once, arcgis_callback() reads it and sets it again
+COOKIES_PER_LOGIN = 2
+
+
+def _cookie_roundtrip(value):
+    header = dump_cookie('userinfo', value)
+    return parse_cookie(header.split(';', 1)[0])['userinfo']
+
+
+def _report_bytes(label, value):
+    per_cookie = len(dump_cookie('userinfo', value))
+    print(f'  {label}: {per_cookie} bytes per Set-Cookie, '
+          f'{per_cookie * COOKIES_PER_LOGIN} bytes per login (plus the Cookie header on every later request)')
+
+
+@case('userinfo_cookie.legacy_json_roundtrip')
+def bench_legacy_json():
+    """The previous cookie: the whole userinfo JSON, quoted and escaped by werkzeug."""
+    _report_bytes('legacy json cookie', json.dumps(USERINFO))
+
+    def roundtrip():
+        json.loads(_cookie_roundtrip(json.dumps(USERINFO)))
+    return roundtrip
+
+
+@case('userinfo_cookie.signed_handle_roundtrip')
+def bench_signed_handle():
+    """Sign/verify of the handle cookie only; the Redis fetch is measured separately below."""
+    # A local signer: the app's needs FLASK_SECRET_KEY, and the cost does not depend on the key
+    signer = Signer('bench-secret', salt='userinfo-cookie')
+    value = signer.sign('Xo0gQ3n1Yv3b0u2kq7m3Vw').decode()
+    _report_bytes('signed handle cookie', value)
+
+    def roundtrip():
+        signer.unsign(_cookie_roundtrip(value))
+    return roundtrip
+
+
+@case('userinfo_cookie.issue_and_load', requires_redis=True)
+def bench_issue_and_load():
+    from config import FLASK_SECRET_KEY
+    from userinfo_cookie import issue_userinfo_cookie, load_userinfo_cookie
+    if not FLASK_SECRET_KEY:
+        raise SkipCase('FLASK_SECRET_KEY not set')
+    return lambda: load_userinfo_cookie(_cookie_roundtrip(issue_userinfo_cookie(USERINFO)))
@@ -0,0 +1,14 @@
+"""Registry of benchmark cases, shared by the bench_*.py modules and the runner."""
+
+CASES = {}
+
+
+class SkipCase(Exception):
+    """Raised by a case's setup when it cannot run in this environment."""
+
+
+def case(name, requires_redis=False):
+    def decorator(setup):
+        CASES[name] = {'setup': setup, 'requires_redis': requires_redis}
+        return setup
+    return decorator
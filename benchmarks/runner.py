@@ -0,0 +1,168 @@
+"""
+Micro-benchmarks for the per-login and per-webhook building blocks.
+
+Cases live in benchmarks/bench_*.py and register themselves with @case. Each case is a
+function that does its setup and returns the zero-argument callable to time.
+
+    python -m benchmarks.runner                      # run and print
+    python -m benchmarks.runner --compare            # fail if a case regressed past the threshold
+    python -m benchmarks.runner --save               # record results as the new baseline
+    python -m benchmarks.runner -k groups --compare --threshold 0.3
+
+Cases marked requires_redis run against REDIS_SERVER/REDIS_PORT/REDIS_SSL (use a local,
+disposable Redis; keys are written under a bench: prefix) and are skipped when it is not reachable.
+A case that raises is reported as an error and makes the run exit 1; the other cases still run.
+"""
+import argparse
+import glob
+import importlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks.registry import CASES, SkipCase
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baseline.json')
+DEFAULT_THRESHOLD = 0.25
+TARGET_REPEAT_SECONDS = 0.2
+
+
+def load_cases():
+    for path in sorted(glob.glob(os.path.join(BENCHMARK_DIR, 'bench_*.py'))):
+        importlib.import_module(f"benchmarks.{os.path.basename(path)[:-3]}")
+
+
+def redis_available():
+    from config import redis_client
+    try:
+        return bool(redis_client.ping())
+    except Exception:
+        return False
+
+
+def measure(func, repeats):
+    """Return per-call timings (seconds) for `repeats` runs, each sized to ~TARGET_REPEAT_SECONDS."""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= TARGET_REPEAT_SECONDS / 4 or loops >= 1_000_000:
+            break
+        loops *= 4
+    loops = max(1, int(loops * TARGET_REPEAT_SECONDS / max(elapsed, 1e-9)))
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        timings.append((time.perf_counter() - start) / loops)
+    return timings, loops
+
+
+def run(selected, repeats):
+    """
+    Run the selected cases. Returns (results, errors); a case that raises is reported as an
+    error and the remaining cases still run.
+    """
+    results = {}
+    errors = []
+    have_redis = None
+    for name, spec in sorted(CASES.items()):
+        if selected and not any(pattern in name for pattern in selected):
+            continue
+        if spec['requires_redis']:
+            if have_redis is None:
+                have_redis = redis_available()
+            if not have_redis:
+                print(f"{name:<45} skipped (Redis not reachable)")
+                continue
+        try:
+            func = spec['setup']()
+            timings, loops = measure(func, repeats)
+        except SkipCase as e:
+            print(f"{name:<45} skipped ({e})")
+            continue
+        except Exception as e:
+            print(f"{name:<45} ERROR {type(e).__name__}: {e}")
+            errors.append(name)
+            continue
+        results[name] = {
+            'min_us': round(min(timings) * 1e6, 3),
+            'median_us': round(statistics.median(timings) * 1e6, 3),
+            'loops': loops,
+        }
+        print(f"{name:<45} min {results[name]['min_us']:>12.3f} us   median {results[name]['median_us']:>12.3f} us")
+    return results, errors
+
+
+def compare(results, baseline, threshold):
+    """Return the names of cases whose min time exceeds the baseline by more than `threshold`."""
+    regressions = []
+    print(f"\n{'case':<45}{'baseline us':>14}{'current us':>14}{'change':>9}")
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            print(f"{name:<45}{'-':>14}{current['min_us']:>14.3f}{'new':>9}")
+            continue
+        change = current['min_us'] / previous['min_us'] - 1
+        flag = '  REGRESSION' if change > threshold else ''
+        print(f"{name:<45}{previous['min_us']:>14.3f}{current['min_us']:>14.3f}{change:>+8.0%}{flag}")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get('cases', {})
+
+
+def save_baseline(path, results):
+    cases = load_baseline(path)
+    cases.update(results)
+    with open(path, 'w') as f:
+        json.dump({'python': sys.version.split()[0], 'cases': dict(sorted(cases.items()))}, f, indent=2)
+        f.write('\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='selected', action='append', help='only run cases containing this text')
+    parser.add_argument('--repeats', type=int, default=7)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--compare', action='store_true', help='exit 1 if any case regressed past --threshold')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='allowed slowdown, e.g. 0.25 = 25%%')
+    parser.add_argument('--save', action='store_true', help='merge the results into the baseline file')
+    args = parser.parse_args(argv)
+
+    # The modules under test log to ./<module>.log; keep those files out of the working tree
+    os.chdir(tempfile.mkdtemp(prefix='iipp-auth-bench-'))
+    load_cases()
+    results, errors = run(args.selected, args.repeats)
+
+    failed = bool(errors)
+    if args.compare:
+        regressions = compare(results, load_baseline(args.baseline), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} case(s) regressed more than {args.threshold:.0%}: {', '.join(regressions)}")
+            failed = True
+    if args.save:
+        save_baseline(args.baseline, results)
+        print(f"\nBaseline written to {args.baseline}")
+    if errors:
+        print(f"\n{len(errors)} case(s) failed to run: {', '.join(errors)}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
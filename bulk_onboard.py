@@ -0,0 +1,194 @@
+"""
+Pre-provision ArcGIS group memberships for a list of users.
+
+Reads emails from a CSV (an `email` column, or the first column) or JSONL file (`{"email": ...}`),
+finds each user in the portal, computes their groups the same way the webhook does (self-selected
+group first, otherwise the email domain) and adds them with one addUsers call per group batch.
+
+Records are processed in chunks; after each chunk the offset is checkpointed in Redis, so rerunning
+the same command after a crash resumes where it stopped (addUsers is idempotent).
+
+    python bulk_onboard.py users.csv --dry-run
+    python bulk_onboard.py users.csv --concurrency 16 --chunk-size 200
+    python bulk_onboard.py users.jsonl --job-id agency-2026-10 --restart
+"""
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import arcgis_api
+import webhook_idempotency
+from codec import encode, decode
+from manage_arcgis_user_groups_helper_functions import get_user_group, get_user_groups
+from redis_helpers import (
+    get_email_to_user_groups, get_bulk_onboard_checkpoint, put_bulk_onboard_checkpoint,
+    delete_bulk_onboard_checkpoint
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./bulk_onboard.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+ADD_USERS_BATCH_SIZE = 25
+
+
+def read_emails(path):
+    """Yield emails from a CSV or JSONL file without loading it into memory."""
+    with open(path, newline='') as f:
+        if path.endswith(('.jsonl', '.ndjson')):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line).get('email', '').strip()
+            return
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        column = 0
+        if 'email' in [name.strip().lower() for name in header]:
+            column = [name.strip().lower() for name in header].index('email')
+        elif '@' in header[0]:
+            yield header[0].strip()
+        for row in reader:
+            if len(row) > column:
+                yield row[column].strip()
+
+
+def default_job_id(path):
+    stat = os.stat(path)
+    return hashlib.sha1(f"{os.path.abspath(path)}:{stat.st_size}".encode()).hexdigest()[:12]
+
+
+def resolve_user(email):
+    """Return (email, outcome, portal user, group titles) for one email."""
+    if not email or '@' not in email:
+        return email, 'invalid_email', None, None
+    selected_group = get_email_to_user_groups(email)
+    user_group = selected_group['user_groups'] if selected_group else get_user_group(email)
+    if not user_group:
+        return email, 'not_in_allowed_orgs', None, None
+    user = arcgis_api.get_user_by_email(email)
+    if not user:
+        return email, 'not_in_portal', None, None
+    return email, 'resolved', user, get_user_groups(user_group)
+
+
+class GroupResolver:
+    """Caches group title -> portal group for the duration of the run."""
+
+    def __init__(self):
+        self._groups = {}
+
+    def get(self, title):
+        if title not in self._groups:
+            self._groups[title] = arcgis_api.get_group_by_title(title)
+        return self._groups[title]
+
+
+def apply_memberships(resolved, groups, pool, dry_run, batch_size):
+    """Add resolved users to their groups with batched, concurrent addUsers calls."""
+    usernames_by_title = defaultdict(list)
+    for _, _, user, titles in resolved:
+        for title in titles:
+            usernames_by_title[title].append(user['username'])
+
+    batches = []
+    for title, usernames in usernames_by_title.items():
+        group = groups.get(title)
+        if not group:
+            logger.warning(f"Group {title} not found in portal, skipping {len(usernames)} users")
+            continue
+        for i in range(0, len(usernames), batch_size):
+            batches.append((group, usernames[i:i + batch_size]))
+
+    if dry_run:
+        for group, usernames in batches:
+            logger.info(f"[dry-run] would add {usernames} to {group['title']}")
+        return len(batches), []
+
+    token = arcgis_api.get_token()
+    results = pool.map(lambda batch: arcgis_api.add_users_to_group(batch[0], batch[1], token=token), batches)
+    failed = {(group['title'], username) for (group, _), result in zip(batches, results) for username in result}
+    not_added = {username for _, username in failed}
+    for _, _, user, titles in resolved:
+        # Only a user added to every one of their groups is satisfied; a webhook retries the rest
+        if all(groups.get(title) and (title, user['username']) not in failed for title in titles):
+            webhook_idempotency.mark_assignment_satisfied(user['username'], titles)
+    return len(batches), not_added
+
+
+def run(path, job_id, concurrency, chunk_size, batch_size, dry_run, checkpoint=None):
+    offset = int(checkpoint['offset']) if checkpoint else 0
+    counts = Counter(decode(checkpoint['counts'])) if checkpoint else Counter()
+    if offset:
+        print(f"Resuming job {job_id} at record {offset}")
+
+    groups = GroupResolver()
+    emails = islice(read_emails(path), offset, None)
+    start = time.perf_counter()
+    processed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            chunk = list(islice(emails, chunk_size))
+            if not chunk:
+                break
+            results = list(pool.map(resolve_user, chunk))
+            resolved = [result for result in results if result[1] == 'resolved']
+            counts.update(outcome for _, outcome, _, _ in results)
+            for email, outcome, _, titles in results:
+                logger.info(f"{email}: {outcome} {titles or ''}")
+
+            batch_count, not_added = apply_memberships(resolved, groups, pool, dry_run, batch_size)
+            counts['add_users_calls'] += batch_count
+            counts['not_added'] += len(not_added)
+
+            processed += len(chunk)
+            offset += len(chunk)
+            if not dry_run:
+                put_bulk_onboard_checkpoint(job_id, {'offset': offset, 'counts': encode(counts)})
+            elapsed = time.perf_counter() - start
+            print(f"{offset} records, {processed / elapsed:.1f} records/s, {dict(counts)}", flush=True)
+
+    elapsed = time.perf_counter() - start
+    if not dry_run:
+        put_bulk_onboard_checkpoint(job_id, {'offset': offset, 'counts': encode(counts), 'completed': 1})
+    print(f"{'Dry run' if dry_run else 'Job'} {job_id} finished: {processed} records in {elapsed:.1f}s "
+          f"({processed / elapsed if elapsed else 0:.1f} records/s), {dict(counts)}")
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='CSV or JSONL file of user emails')
+    parser.add_argument('--job-id', help='checkpoint name (defaults to a hash of the file path and size)')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent portal requests')
+    parser.add_argument('--chunk-size', type=int, default=100, help='records per checkpoint')
+    parser.add_argument('--batch-size', type=int, default=ADD_USERS_BATCH_SIZE, help='usernames per addUsers call')
+    parser.add_argument('--dry-run', action='store_true', help='resolve users and groups without adding anyone')
+    parser.add_argument('--restart', action='store_true', help='ignore and replace an existing checkpoint')
+    args = parser.parse_args(argv)
+
+    job_id = args.job_id or default_job_id(args.path)
+    if args.restart and not args.dry_run:
+        delete_bulk_onboard_checkpoint(job_id)
+    checkpoint = None if (args.dry_run or args.restart) else get_bulk_onboard_checkpoint(job_id)
+    if checkpoint and checkpoint.get('completed'):
+        print(f"Job {job_id} already completed ({checkpoint}); use --restart to run it again")
+        return 0
+    run(args.path, job_id, args.concurrency, args.chunk_size, args.batch_size, args.dry_run, checkpoint)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+"""
+Change-data feed of user state and group assignments, for reporting and the agency audit.
+
+Every change redis_helpers makes to a user record, username alias or group assignment, and every
+successful addUsers call, appends one entry to the capped change-feed stream in Redis (about
+CHANGE_FEED_MAXLEN entries are kept). The entry id orders the changes and carries the millisecond
+they were written at:
+
+    {"id": "1760000000000-0", "op": "user.update", "email": "jdoe@usgs.gov", "fields": ["auth_access"],
+     "auth_access": {"is_disallowed": false, "has_selected_group": true}}
+
+    ops: user.update, user.migrate, user.username, user.delete, user.delete_field, username.delete,
+         group_assignment.put, group_assignment.delete, arcgis.add_users
+
+Login tokens, OIDC transactions, caches and idempotency markers are not user state and are not in
+the feed. Consumers read increments after an offset, the id of the last change they processed. A
+named consumer can keep its offset here: a read without an explicit offset starts after the one it
+committed, so committing after processing makes a job resumable. How far each named consumer is
+behind, and the stream length, are exported as metrics by the change_feed_metrics scheduler job.
+
+    GET  /admin/changes?consumer=audit[&after=<id>][&count=1000]    NDJSON, oldest first
+    POST /admin/changes/offsets  {"consumer": "audit", "id": "<id>"}
+
+    python change_feed.py --consumer audit --commit > changes.ndjson   # everything new since last run
+    python change_feed.py --status
+
+Both endpoints need Authorization: Bearer <ADMIN_API_TOKEN>. X-Change-Feed-Next is the offset to
+read (and commit) after the response. X-Change-Feed-Truncated: true means the offset itself has been
+trimmed, so changes after it may have been too; run a full user_state.py export to catch up.
+"""
+import argparse
+import logging
+import re
+import sys
+import time
+
+import redis
+from flask import Blueprint, Response, jsonify, request
+
+from config import CHANGE_FEED_READ_COUNT
+from metrics import CHANGE_FEED_CONSUMER_LAG, CHANGE_FEED_LENGTH
+from redis_helpers import get_change_feed_bounds, get_change_feed_offset, get_change_feed_offsets, \
+    get_next_change_ids, put_change_feed_offset, read_change_feed
+from user_state import ndjson_line, require_admin_token
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./change_feed.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+change_feed_blueprint = Blueprint('change_feed', __name__)
+
+CHANGE_ID = re.compile(r'^\d+(-\d+)?$')
+CONSUMER_NAME = re.compile(r'^[\w.-]{1,64}$')
+
+
+def parse_change_id(change_id):
+    """'1760000000000-3' -> (1760000000000, 3), comparable in stream order."""
+    milliseconds, _, sequence = change_id.partition('-')
+    return int(milliseconds), int(sequence or 0)
+
+
+def read_changes(consumer=None, after=None, count=CHANGE_FEED_READ_COUNT):
+    """
+    Up to `count` changes after `after`, or after the consumer's committed offset when `after` is
+    None. Returns (changes, next offset, truncated); raises on Redis errors.
+    """
+    if after is None and consumer:
+        after = get_change_feed_offset(consumer)
+    changes = read_change_feed(after, count)
+    truncated = False
+    if after:
+        _, oldest, _ = get_change_feed_bounds()
+        # The offset itself was trimmed: the consumer is a full stream length behind and may have missed changes
+        truncated = oldest is not None and parse_change_id(after) < parse_change_id(oldest)
+        if truncated:
+            logger.warning(f"Change feed consumer {consumer or '-'} at {after} is behind the oldest change {oldest}")
+    return changes, changes[-1]['id'] if changes else after, truncated
+
+
+def update_change_feed_metrics(now=None):
+    """Export the stream length and each named consumer's lag; the scheduler job's result."""
+    length, _, _ = get_change_feed_bounds()
+    CHANGE_FEED_LENGTH.set(length)
+    offsets = get_change_feed_offsets()
+    consumers = sorted(offsets)
+    now = time.time() if now is None else now
+    lags = {}
+    for consumer, next_id in zip(consumers, get_next_change_ids([offsets[consumer] for consumer in consumers])):
+        lags[consumer] = round(max(0.0, now - parse_change_id(next_id)[0] / 1000), 3) if next_id else 0.0
+        CHANGE_FEED_CONSUMER_LAG.labels(consumer).set(lags[consumer])
+    return {'length': length, 'lag_seconds': lags}
+
+
+# Admin endpoints
+
+@change_feed_blueprint.route('/admin/changes')
+def changes_route():
+    require_admin_token()
+    consumer = request.args.get('consumer')
+    after = request.args.get('after')
+    if consumer is not None and not CONSUMER_NAME.match(consumer):
+        return jsonify({'error': 'consumer must be 1-64 letters, digits, ".", "_" or "-"'}), 400
+    if after is not None and not CHANGE_ID.match(after):
+        return jsonify({'error': 'after must be a change id'}), 400
+    try:
+        count = min(int(request.args.get('count', CHANGE_FEED_READ_COUNT)), CHANGE_FEED_READ_COUNT)
+    except ValueError:
+        return jsonify({'error': 'count must be a number'}), 400
+
+    try:
+        changes, next_offset, truncated = read_changes(consumer, after, max(1, count))
+    except redis.RedisError as e:
+        logger.error(f"Change feed read failed: {e}")
+        return jsonify({'error': 'Change feed temporarily unavailable'}), 503
+    headers = {'X-Change-Feed-Truncated': str(truncated).lower()}
+    if next_offset:
+        headers['X-Change-Feed-Next'] = next_offset
+    return Response(''.join(map(ndjson_line, changes)), mimetype='application/x-ndjson', headers=headers)
+
+
+@change_feed_blueprint.route('/admin/changes/offsets', methods=['POST'])
+def commit_offset_route():
+    require_admin_token()
+    body = request.get_json(silent=True) or {}
+    consumer, change_id = str(body.get('consumer', '')), str(body.get('id', ''))
+    if not CONSUMER_NAME.match(consumer) or not CHANGE_ID.match(change_id):
+        return jsonify({'error': 'Body must be {"consumer": "<name>", "id": "<change id>"}'}), 400
+    try:
+        put_change_feed_offset(consumer, change_id)
+    except redis.RedisError as e:
+        logger.error(f"Change feed offset commit failed: {e}")
+        return jsonify({'error': 'Change feed temporarily unavailable'}), 503
+    logger.info(f"Change feed consumer {consumer} committed {change_id} from {request.remote_addr}")
+    return jsonify({'consumer': consumer, 'id': change_id})
+
+
+# Command line
+
+def print_status(out=sys.stdout):
+    length, oldest, newest = get_change_feed_bounds()
+    out.write(f"length: {length}, oldest: {oldest or '-'}, newest: {newest or '-'}\n")
+    offsets = get_change_feed_offsets()
+    lags = update_change_feed_metrics()['lag_seconds']
+    for consumer in sorted(offsets):
+        out.write(f"  {consumer:<24} {offsets[consumer]:<20} lag {lags[consumer]:.0f}s\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--consumer', help='read after (and with --commit, save) this consumer\'s offset')
+    parser.add_argument('--after', help='read after this change id instead of the committed offset')
+    parser.add_argument('--commit', action='store_true', help='commit the offset after each batch is written')
+    parser.add_argument('--batch-size', type=int, default=CHANGE_FEED_READ_COUNT)
+    parser.add_argument('--status', action='store_true', help='show the stream bounds and consumer offsets')
+    args = parser.parse_args(argv)
+    if args.status:
+        print_status()
+        return 0
+    if args.commit and not args.consumer:
+        parser.error('--commit needs --consumer')
+
+    total, after = 0, args.after
+    while True:
+        changes, next_offset, truncated = read_changes(args.consumer, after, args.batch_size)
+        if truncated:
+            sys.stderr.write(f"warning: changes after {after or 'the committed offset'} were trimmed before "
+                             f"they were read\n")
+        if not changes:
+            break
+        sys.stdout.write(''.join(map(ndjson_line, changes)))
+        sys.stdout.flush()
+        if args.commit:
+            put_change_feed_offset(args.consumer, next_offset)
+        total += len(changes)
+        after = next_offset
+    sys.stderr.write(f"{total} changes, next offset {after or '-'}\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""
+Serialization for structured values stored in Redis and for Flask JSON responses.
+
+Encoded values carry a short version tag (``o1:{...}``) so the wire format can change
+without a flag day: readers accept every registered tag plus untagged legacy ``json.dumps``
+output, and REDIS_CODEC selects what writers produce. Roll out a new codec by deploying
+readers first (REDIS_CODEC=json, the default, keeps writing the legacy format), then switching
+writers with REDIS_CODEC=o1.
+"""
+import json
+import logging
+
+from flask.json.provider import DefaultJSONProvider
+
+from config import REDIS_CODEC
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is in requirements.txt
+    orjson = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./codec.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+LEGACY_CODEC = 'json'
+TAG_SEPARATOR = ':'
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+# tag -> (dumps, loads); tags are two characters so a tagged value can never be valid JSON
+CODECS = {'j1': (_json_dumps, json.loads)}
+if orjson is not None:
+    CODECS['o1'] = (_orjson_dumps, orjson.loads)
+
+_legacy_loads = orjson.loads if orjson is not None else json.loads
+
+
+def _select_write_codec(name):
+    if name == LEGACY_CODEC:
+        return None
+    if name not in CODECS:
+        fallback = 'o1' if 'o1' in CODECS else 'j1'
+        logger.error(f"Unknown or unavailable REDIS_CODEC {name!r}, writing {fallback}")
+        return fallback
+    return name
+
+
+WRITE_CODEC = _select_write_codec(REDIS_CODEC)
+
+
+def encode(obj, codec=None):
+    """Serialize obj with the configured (or given) codec; returns a str safe for decode_responses clients."""
+    tag = WRITE_CODEC if codec is None else _select_write_codec(codec)
+    if tag is None:
+        return json.dumps(obj)
+    dumps, _ = CODECS[tag]
+    return f"{tag}{TAG_SEPARATOR}{dumps(obj)}"
+
+
+def decode(value):
+    """Deserialize a value written by encode() with any registered codec, or legacy untagged JSON."""
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode()
+    if value[2:3] == TAG_SEPARATOR and value[:2] in CODECS:
+        _, loads = CODECS[value[:2]]
+        return loads(value[3:])
+    return _legacy_loads(value)
+
+
+class CodecJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson. The arguments Flask passes (compact separators, indent=2
+    in debug, sort_keys) are translated to orjson options; anything else falls back to the stdlib.
+    Dates and dataclasses still go through Flask's default so responses keep their format.
+    """
+
+    def _orjson_option(self, kwargs):
+        kwargs = {'sort_keys': self.sort_keys, **kwargs}
+        if orjson is None or set(kwargs) - {'separators', 'indent', 'sort_keys'}:
+            return None
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if kwargs.get('indent') == 2:
+            option |= orjson.OPT_INDENT_2
+        elif kwargs.get('indent') is not None or kwargs.get('separators', (',', ':')) != (',', ':'):
+            return None
+        if kwargs['sort_keys']:
+            option |= orjson.OPT_SORT_KEYS
+        return option
+
+    def dumps(self, obj, **kwargs):
+        option = self._orjson_option(kwargs)
+        if option is None:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
@@ -1,13 +1,32 @@
-import redis
-from types import SimpleNamespace
-from dotenv import load_dotenv
 import os
 import sys
+import threading
+
+import redis
+import redis.asyncio
+import requests
+from dotenv import load_dotenv
+
+from redis_breaker import BreakerAsyncRedis, BreakerRedis, CircuitBreaker
 
 load_dotenv()
 
 AUTH_SERVICE_DOMAIN = os.environ.get('AUTH_SERVICE_DOMAIN')
 REDIS_SERVER = os.environ.get('REDIS_SERVER')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+# ElastiCache requires TLS; set REDIS_SSL=false for a plain local Redis (load tests, benchmarks)
+REDIS_SSL = os.environ.get('REDIS_SSL', 'true').lower() != 'false'
+# Commands are sub-millisecond; a short timeout lets the circuit breaker trip quickly in a failover
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', 2))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT', 2))
+# Degraded mode (see redis_breaker.py and degraded_mode.py)
+REDIS_BREAKER_FAILURES = int(os.environ.get('REDIS_BREAKER_FAILURES', 3))
+REDIS_BREAKER_WINDOW_SECONDS = float(os.environ.get('REDIS_BREAKER_WINDOW_SECONDS', 10))
+REDIS_BREAKER_COOLDOWN_SECONDS = float(os.environ.get('REDIS_BREAKER_COOLDOWN_SECONDS', 5))
+DEGRADED_CACHE_SIZE = int(os.environ.get('DEGRADED_CACHE_SIZE', 10000))
+# Capped: a cached login outlives its revocation on other workers for up to this long while Redis is down
+DEGRADED_CACHE_TTL_SECONDS = min(int(os.environ.get('DEGRADED_CACHE_TTL_SECONDS', 120)), 300)
+DEGRADED_WRITE_BUFFER_SIZE = int(os.environ.get('DEGRADED_WRITE_BUFFER_SIZE', 1000))
 
 FLASK_SECRET_KEY = os.environ.get('FLASK_SECRET_KEY')
 
@@ -27,24 +46,227 @@ ARCGIS_LOGIN_CALLBACK_URL = f'https://{AUTH_SERVICE_DOMAIN}/arcgis_callback'
 ARCGIS_LOGIN_REDIRECT_URL = os.environ.get('ARCGIS_LOGIN_REDIRECT_URL')
 ADD_USER_TO_GROUP_ASSIGNMENT_QUEUE_URL = f'https://{AUTH_SERVICE_DOMAIN}/add_user_to_group_assignment_queue'
 
-AUTH = os.environ.get('AUTH_LOGIN_GOV')
+# In-process webhook event processing (bounded queue, see webhook_processor.py)
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 200))
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 4))
+# How long a stopping worker waits for accepted events; keep below the server's graceful timeout
+WEBHOOK_DRAIN_TIMEOUT_SECONDS = int(os.environ.get('WEBHOOK_DRAIN_TIMEOUT_SECONDS', 20))
+
+# Portal lookups for a new account are prefetched at /callback and kept for the webhook that follows
+# (see arcgis_prefetch.py)
+ARCGIS_PREFETCH_ENABLED = os.environ.get('ARCGIS_PREFETCH_ENABLED', 'true').lower() == 'true'
+ARCGIS_PREFETCH_TTL_SECONDS = int(os.environ.get('ARCGIS_PREFETCH_TTL_SECONDS', 300))
+ARCGIS_PREFETCH_QUEUE_SIZE = int(os.environ.get('ARCGIS_PREFETCH_QUEUE_SIZE', 100))
+ARCGIS_PREFETCH_WORKERS = int(os.environ.get('ARCGIS_PREFETCH_WORKERS', 2))
+
+# Webhook idempotency: how long a processed event / satisfied group assignment is remembered
+WEBHOOK_EVENT_TTL_SECONDS = int(os.environ.get('WEBHOOK_EVENT_TTL_SECONDS', 3600))
+USER_GROUP_ASSIGNMENT_TTL_SECONDS = int(os.environ.get('USER_GROUP_ASSIGNMENT_TTL_SECONDS', 86400))
+
+# Organization hierarchy used for group assignment (hot-reloaded, see reloadable_config.py)
+ORG_HIERARCHY_PATH = os.environ.get(
+    'ORG_HIERARCHY_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'org_hierarchy.json')
+)
+# Email domain -> org and USDA bypass rules (hot-reloaded, see email_policy.py)
+EMAIL_POLICY_PATH = os.environ.get(
+    'EMAIL_POLICY_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'email_policy.json')
+)
+# Codec for structured values written to Redis (json = legacy untagged, the default until every reader is
+# deployed; o1 = orjson, j1 = compact json)
+REDIS_CODEC = os.environ.get('REDIS_CODEC', 'json')
+# Also write user-auth-access / user-email-to-user-groups alongside user:<email> records; turn off
+# once no deployed pod reads the legacy keys, then run migrate_user_records.py --delete-legacy
+USER_RECORD_DUAL_WRITE = os.environ.get('USER_RECORD_DUAL_WRITE', 'true').lower() == 'true'
+# Server-side userinfo referenced by the signed `userinfo` cookie during login
+USERINFO_COOKIE_TTL_SECONDS = int(os.environ.get('USERINFO_COOKIE_TTL_SECONDS', 3600))
+# Cookies holding the userinfo JSON itself (issued before the signed handle) are accepted, and reissued
+# as handles, only until this ISO 8601 time (UTC unless it has an offset). Unset, they are rejected; set it
+# to the deploy time plus USERINFO_COOKIE_TTL_SECONDS at most, and unset it once that has passed.
+USERINFO_LEGACY_COOKIES_UNTIL = os.environ.get('USERINFO_LEGACY_COOKIES_UNTIL', '')
+# Lifetime of the access tokens /token hands to ArcGIS (expires_in)
+ACCESS_TOKEN_TTL_SECONDS = int(os.environ.get('ACCESS_TOKEN_TTL_SECONDS', 3600))
+# How long ArcGIS has to redeem the code /arcgis_callback hands it at /token; each code is redeemed once
+AUTH_CODE_TTL_SECONDS = int(os.environ.get('AUTH_CODE_TTL_SECONDS', 300))
+# Absolute lifetime of a login's rotating refresh tokens, counted from the login; 0 disables the refresh_token grant
+REFRESH_TOKEN_TTL_SECONDS = int(os.environ.get('REFRESH_TOKEN_TTL_SECONDS', 43200))
+# OIDC transaction (state, nonce, return target) kept between /auth and /callback
+OIDC_TRANSACTION_TTL_SECONDS = int(os.environ.get('OIDC_TRANSACTION_TTL_SECONDS', 600))
+
+# Admin endpoints (/admin/user_state, /admin/changes, /arcgis_webhook/stats) are off unless ADMIN_API_TOKEN is set
+ADMIN_API_TOKEN = os.environ.get('ADMIN_API_TOKEN')
+USER_STATE_BATCH_SIZE = int(os.environ.get('USER_STATE_BATCH_SIZE', 500))
+USER_STATE_MAX_QUERIES = int(os.environ.get('USER_STATE_MAX_QUERIES', 50000))
+
+# Per-request sampling profiler (see profiler.py); off unless a token or PROFILER_ENABLED is set
+PROFILER_TOKEN = os.environ.get('PROFILER_TOKEN')
+PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', 'false').lower() == 'true'
+PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', 0.01))
+PROFILER_INTERVAL_MS = float(os.environ.get('PROFILER_INTERVAL_MS', 5))
+PROFILER_DIR = os.environ.get('PROFILER_DIR', '/tmp/auth_profiles')
+PROFILER_KEEP = int(os.environ.get('PROFILER_KEEP', 50))
+
+# Request tracing (see tracing.py): comma-separated exporters, e.g. "file" or "file,otlp"
+TRACING_EXPORTERS = [name.strip() for name in os.environ.get('TRACING_EXPORTERS', '').split(',') if name.strip()]
+TRACING_FILE = os.environ.get('TRACING_FILE', './traces.jsonl')
+OTEL_EXPORTER_OTLP_ENDPOINT = os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT')
+OTEL_SERVICE_NAME = os.environ.get('OTEL_SERVICE_NAME', 'arcgis-auth-service')
+
+# Token-bucket admission control (see rate_limit.py). Limits are "<requests>/<seconds>": the bucket
+# holds <requests> tokens and refills at <requests>/<seconds> per second. An empty value disables it.
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() != 'false'
+RATE_LIMIT_AUTH_PER_IP = os.environ.get('RATE_LIMIT_AUTH_PER_IP', '30/60')
+RATE_LIMIT_AUTH_GLOBAL = os.environ.get('RATE_LIMIT_AUTH_GLOBAL', '3000/60')
+RATE_LIMIT_CALLBACK_PER_IP = os.environ.get('RATE_LIMIT_CALLBACK_PER_IP', '30/60')
+RATE_LIMIT_CALLBACK_GLOBAL = os.environ.get('RATE_LIMIT_CALLBACK_GLOBAL', '1200/60')
+# Proxies in front of the app that append to X-Forwarded-For (the ingress)
+RATE_LIMIT_TRUSTED_PROXIES = int(os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', 1))
 
-sys.path.insert(0, "/etc/config")
+# Single-flight coalescing of identical ArcGIS lookups (see singleflight.py). Callers in other pods
+# wait up to the lease for the leader's result; SINGLEFLIGHT_SHARED=false coalesces per process only.
+SINGLEFLIGHT_SHARED = os.environ.get('SINGLEFLIGHT_SHARED', 'true').lower() != 'false'
+SINGLEFLIGHT_LEASE_MS = int(os.environ.get('SINGLEFLIGHT_LEASE_MS', 10000))
+SINGLEFLIGHT_RESULT_TTL_MS = int(os.environ.get('SINGLEFLIGHT_RESULT_TTL_MS', 5000))
+SINGLEFLIGHT_POLL_MS = int(os.environ.get('SINGLEFLIGHT_POLL_MS', 20))
 
-from auth_config import AUTH
+# The service-account portal token is cached in Redis until this long before it expires, and the
+# scheduler replaces it once it has less than ARCGIS_TOKEN_REFRESH_BEFORE_SECONDS left
+ARCGIS_TOKEN_EXPIRY_MARGIN_SECONDS = int(os.environ.get('ARCGIS_TOKEN_EXPIRY_MARGIN_SECONDS', 120))
+ARCGIS_TOKEN_REFRESH_BEFORE_SECONDS = int(os.environ.get('ARCGIS_TOKEN_REFRESH_BEFORE_SECONDS', 900))
+
+# Background jobs (see scheduler.py). One process across all replicas holds the leader lease and
+# runs them; started from the gunicorn master when SCHEDULER_ENABLED, or with `python scheduler.py`.
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'true').lower() != 'false'
+SCHEDULER_LEASE_MS = int(os.environ.get('SCHEDULER_LEASE_MS', 30000))
+SCHEDULER_TICK_SECONDS = float(os.environ.get('SCHEDULER_TICK_SECONDS', 5))
+SCHEDULER_HISTORY = int(os.environ.get('SCHEDULER_HISTORY', 50))
+ARCGIS_TOKEN_REFRESH_INTERVAL_SECONDS = int(os.environ.get('ARCGIS_TOKEN_REFRESH_INTERVAL_SECONDS', 300))
+ARCGIS_GROUP_SYNC_INTERVAL_SECONDS = int(os.environ.get('ARCGIS_GROUP_SYNC_INTERVAL_SECONDS', 3600))
+REDIS_SWEEP_INTERVAL_SECONDS = int(os.environ.get('REDIS_SWEEP_INTERVAL_SECONDS', 3600))
+# Login token keys that were written without a TTL get this one from the sweep
+STALE_TOKEN_TTL_SECONDS = int(os.environ.get('STALE_TOKEN_TTL_SECONDS', 3600))
+
+# Change-data feed of user state and group assignments (see change_feed.py). The stream is capped
+# at about CHANGE_FEED_MAXLEN entries; consumers that fall further behind than that miss changes.
+CHANGE_FEED_ENABLED = os.environ.get('CHANGE_FEED_ENABLED', 'true').lower() != 'false'
+CHANGE_FEED_MAXLEN = int(os.environ.get('CHANGE_FEED_MAXLEN', 100000))
+CHANGE_FEED_READ_COUNT = int(os.environ.get('CHANGE_FEED_READ_COUNT', 1000))
+CHANGE_FEED_METRICS_INTERVAL_SECONDS = int(os.environ.get('CHANGE_FEED_METRICS_INTERVAL_SECONDS', 60))
+
+# ASGI mode (see asgi_app.py): connection limits of each worker's async Redis and HTTP clients
+ASYNC_REDIS_MAX_CONNECTIONS = int(os.environ.get('ASYNC_REDIS_MAX_CONNECTIONS', 100))
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.environ.get('ASYNC_HTTP_MAX_CONNECTIONS', 100))
+
+AUTH_CONFIG_DIR = os.environ.get('AUTH_CONFIG_DIR', '/etc/config')
 
 AUTH_PRIVATE_KEY = os.environ.get('AUTH_PRIVATE_KEY')
 
-# Initialize Redis client with SSL enabled
-redis_client = redis.Redis(
-    host=REDIS_SERVER,
-    port=6379,
-    db=0,
-    decode_responses=True,
-    ssl=True,  # Enable SSL explicitly
-    ssl_cert_reqs=None,  # Disable certificate verification (safe in AWS)
-    socket_timeout=10,  # Increase timeout for slow responses
-    socket_connect_timeout=10,
-    retry_on_timeout=True,
-    health_check_interval=30,  # Automatically check connection health
-)
+
+class LazyResource:
+    """
+    Proxy that builds the wrapped object on first use instead of at import time.
+
+    With ``per_process=True`` the object is rebuilt the first time it is used in a
+    new process, so clients created in the gunicorn master (``--preload``) are never
+    shared with forked workers. Methods are underscored so they never shadow
+    attributes of the wrapped object (e.g. ``redis_client.get``). When ``cls`` is given,
+    ``isinstance`` checks (Flask-Session requires a ``redis.Redis``) pass without
+    building the object.
+    """
+
+    def __init__(self, factory, per_process=False, cls=None):
+        self._factory = factory
+        self._per_process = per_process
+        self._cls = cls
+        self._lock = threading.Lock()
+        self._instance = None
+        self._pid = None
+
+    def _resolve(self):
+        pid = os.getpid() if self._per_process else None
+        if self._instance is None or self._pid != pid:
+            with self._lock:
+                if self._instance is None or self._pid != pid:
+                    self._instance = self._factory()
+                    self._pid = pid
+        return self._instance
+
+    def _reset(self):
+        """Drop the current instance so the next use builds a fresh one."""
+        with self._lock:
+            self._instance = None
+            self._pid = None
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    @property
+    def __class__(self):
+        return self._cls or type(self._resolve())
+
+    def __repr__(self):
+        return f"<LazyResource {self._factory.__name__} loaded={self._instance is not None}>"
+
+
+def _load_auth_config():
+    if AUTH_CONFIG_DIR not in sys.path:
+        sys.path.insert(0, AUTH_CONFIG_DIR)
+    from auth_config import AUTH as auth
+    return auth
+
+
+def _create_redis_client():
+    # Initialize Redis client with SSL enabled
+    return BreakerRedis(
+        breaker=redis_breaker,
+        host=REDIS_SERVER,
+        port=REDIS_PORT,
+        db=0,
+        decode_responses=True,
+        ssl=REDIS_SSL,  # Enable SSL explicitly
+        ssl_cert_reqs=None,  # Disable certificate verification (safe in AWS)
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        retry_on_timeout=True,
+        health_check_interval=30,  # Automatically check connection health
+    )
+
+
+def _create_async_redis_client():
+    # Same server and breaker as redis_client, for the async routes (see async_routes.py)
+    return BreakerAsyncRedis(
+        breaker=redis_breaker,
+        host=REDIS_SERVER,
+        port=REDIS_PORT,
+        db=0,
+        decode_responses=True,
+        ssl=REDIS_SSL,
+        ssl_cert_reqs=None,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        retry_on_timeout=True,
+        health_check_interval=30,
+        max_connections=ASYNC_REDIS_MAX_CONNECTIONS,
+    )
+
+
+def _create_http_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=20)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+AUTH = LazyResource(_load_auth_config)
+# One breaker per process, shared by every connection of that process's client
+redis_breaker = CircuitBreaker(REDIS_BREAKER_FAILURES, REDIS_BREAKER_WINDOW_SECONDS, REDIS_BREAKER_COOLDOWN_SECONDS)
+redis_client = LazyResource(_create_redis_client, per_process=True, cls=redis.Redis)
+http_session = LazyResource(_create_http_session, per_process=True, cls=requests.Session)
+async_redis_client = LazyResource(_create_async_redis_client, per_process=True, cls=redis.asyncio.Redis)
+
+
+def reset_process_resources():
+    """Discard connection pools inherited from a parent process (call after fork)."""
+    redis_client._reset()
+    http_session._reset()
+    async_redis_client._reset()
@@ -0,0 +1,238 @@
+"""
+Degraded mode while Redis is unreachable.
+
+The circuit breaker in redis_breaker.py decides when Redis is down; this module decides what the
+login and token paths do meanwhile:
+
+- Reads of /token, /userinfo and the userinfo cookie fall back to a bounded in-process cache of
+  the login writes this worker made (RecentCache), so users who logged in on this worker in the
+  last DEGRADED_CACHE_TTL_SECONDS (at most 5 minutes) keep working. The cache is consulted only
+  while degraded; when Redis is healthy it is always the source of truth, and a key Redis no longer
+  has (deleted, consumed or expired) is dropped from the cache when it is read. Deleting a user
+  evicts their keys on the worker that deletes them; the short TTL bounds how long another
+  worker's copy could still answer while Redis is down.
+- Login writes from /arcgis_callback go to a bounded write-behind buffer (WriteBehindBuffer) and
+  are replayed when the breaker closes again. When the buffer is full the oldest write is dropped.
+- Flask-Session neither reads nor writes sessions (DegradableRedisSessionInterface), so requests
+  do not wait on a session round trip that is bound to fail.
+
+The cache and the buffer are per worker process; a write buffered on one worker is not visible to
+another until it has been flushed. Transitions and buffered-write outcomes are exported as metrics.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+import redis
+from flask_session.defaults import Defaults
+from flask_session.redis import RedisSessionInterface
+
+from config import redis_breaker, DEGRADED_CACHE_SIZE, DEGRADED_CACHE_TTL_SECONDS, DEGRADED_WRITE_BUFFER_SIZE
+from metrics import REDIS_DEGRADED, REDIS_BREAKER_TRANSITIONS, DEGRADED_WRITES, DEGRADED_WRITE_BUFFER_DEPTH, \
+    DEGRADED_CACHE_READS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./degraded_mode.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+# Errors meaning Redis could not be reached (RedisUnavailable, raised by the open breaker, is a ConnectionError)
+UNAVAILABLE_ERRORS = (redis.ConnectionError, redis.TimeoutError)
+
+
+def redis_degraded():
+    return redis_breaker.is_open
+
+
+class RecentCache:
+    """Least-recently-used map of Redis key -> value, with entries expiring after `ttl` seconds."""
+
+    def __init__(self, maxsize=DEGRADED_CACHE_SIZE, ttl=DEGRADED_CACHE_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, key, value):
+        if not self.maxsize or value is None:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def fallback(self, key):
+        """
+        Cached value for `key` if Redis is degraded, else None; counted as a hit or miss. A healthy
+        Redis that did not have the key means it is gone, so the cached copy is dropped too.
+        """
+        if not redis_degraded():
+            self.discard(key)
+            return None
+        value = self.get(key)
+        DEGRADED_CACHE_READS.labels('hit' if value is not None else 'miss').inc()
+        return value
+
+    def discard(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class WriteBehindBuffer:
+    """Bounded FIFO of Redis writes deferred during an outage, replayed in order once Redis is back."""
+
+    def __init__(self, maxsize=DEGRADED_WRITE_BUFFER_SIZE):
+        self._writes = deque()
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._flushing = threading.Lock()
+
+    def __len__(self):
+        return len(self._writes)
+
+    def add(self, description, write, args):
+        with self._lock:
+            if self.maxsize and len(self._writes) >= self.maxsize:
+                dropped, _, _ = self._writes.popleft()
+                DEGRADED_WRITES.labels('dropped').inc()
+                logger.warning(f"Write buffer full, dropped {dropped}")
+            self._writes.append((description, write, args))
+            DEGRADED_WRITE_BUFFER_DEPTH.set(len(self._writes))
+        DEGRADED_WRITES.labels('buffered').inc()
+        logger.warning(f"Redis unavailable, buffered {description} ({len(self._writes)} pending)")
+
+    def flush(self):
+        """Replay buffered writes in order; stop (keeping the rest) if Redis fails again. Returns the count written."""
+        if not self._flushing.acquire(blocking=False):
+            return 0
+        flushed = 0
+        try:
+            while True:
+                with self._lock:
+                    if not self._writes:
+                        break
+                    description, write, args = self._writes.popleft()
+                try:
+                    write(*args)
+                except UNAVAILABLE_ERRORS as e:
+                    with self._lock:
+                        self._writes.appendleft((description, write, args))
+                    logger.warning(f"Redis unavailable again while flushing, {len(self._writes)} writes pending: {e}")
+                    break
+                except Exception as e:
+                    DEGRADED_WRITES.labels('failed').inc()
+                    logger.error(f"Error replaying buffered {description}: {e}")
+                    continue
+                flushed += 1
+                DEGRADED_WRITES.labels('flushed').inc()
+        finally:
+            DEGRADED_WRITE_BUFFER_DEPTH.set(len(self._writes))
+            self._flushing.release()
+        if flushed:
+            logger.info(f"Flushed {flushed} buffered writes to Redis")
+        return flushed
+
+    def clear(self):
+        with self._lock:
+            self._writes.clear()
+            DEGRADED_WRITE_BUFFER_DEPTH.set(0)
+
+
+recent_cache = RecentCache()
+write_buffer = WriteBehindBuffer()
+
+
+def write_or_buffer(description, write, *args):
+    """
+    Run write(*args) now, or queue it in the write-behind buffer if Redis is unavailable.
+    `write` must raise on failure. Other errors are logged and the write is not retried.
+    """
+    if redis_degraded():
+        write_buffer.add(description, write, args)
+        return
+    try:
+        write(*args)
+    except UNAVAILABLE_ERRORS:
+        write_buffer.add(description, write, args)
+        return
+    except Exception as e:
+        logger.error(f"Error writing {description} to Redis: {e}")
+        return
+    if len(write_buffer):
+        # A write failed without tripping the breaker; Redis answers again, so replay it now
+        write_buffer.flush()
+
+
+def _flush_in_background():
+    threading.Thread(target=write_buffer.flush, name='degraded-flush', daemon=True).start()
+
+
+def on_breaker_transition(old, new):
+    REDIS_BREAKER_TRANSITIONS.labels(new).inc()
+    REDIS_DEGRADED.set(0 if new == 'closed' else 1)
+    if old != 'closed' and new == 'closed':
+        logger.info(f"Redis is reachable again, leaving degraded mode ({len(write_buffer)} buffered writes)")
+        if len(write_buffer):
+            _flush_in_background()
+    elif old == 'closed':
+        logger.warning("Redis is unreachable, entering degraded mode")
+
+
+redis_breaker.add_listener(on_breaker_transition)
+
+
+class DegradableRedisSessionInterface(RedisSessionInterface):
+    """Flask-Session on Redis that leaves sessions alone while Redis is unavailable."""
+
+    def _retrieve_session_data(self, store_id):
+        if redis_degraded():
+            return None
+        try:
+            return super()._retrieve_session_data(store_id)
+        except UNAVAILABLE_ERRORS as e:
+            logger.warning(f"Session read skipped, Redis unavailable: {e}")
+            return None
+
+    def save_session(self, app, session, response):
+        # Not even the cookie: an empty session opened while degraded must not replace the user's session id
+        if redis_degraded():
+            return
+        try:
+            super().save_session(app, session, response)
+        except UNAVAILABLE_ERRORS as e:
+            logger.warning(f"Session write skipped, Redis unavailable: {e}")
+
+
+def init_degraded_mode(app):
+    """Replace the session interface installed by Session(app) with DegradableRedisSessionInterface."""
+    config = app.config
+    app.session_interface = DegradableRedisSessionInterface(
+        app,
+        client=config.get('SESSION_REDIS'),
+        key_prefix=config.get('SESSION_KEY_PREFIX', Defaults.SESSION_KEY_PREFIX),
+        use_signer=config.get('SESSION_USE_SIGNER', Defaults.SESSION_USE_SIGNER),
+        permanent=config.get('SESSION_PERMANENT', Defaults.SESSION_PERMANENT),
+        sid_length=config.get('SESSION_ID_LENGTH', Defaults.SESSION_ID_LENGTH),
+        serialization_format=config.get('SESSION_SERIALIZATION_FORMAT', Defaults.SESSION_SERIALIZATION_FORMAT),
+    )
@@ -0,0 +1,63 @@
+class DomainSuffixIndex:
+    """
+    Maps domains to values, matching whole DNS labels from the right.
+
+    'usda.gov' matches 'usda.gov' and 'fs.usda.gov' but not 'notusda.gov'. When several
+    rules match, the most specific (longest) one wins. Lookups cost O(number of labels).
+    """
+
+    _VALUE = object()
+
+    def __init__(self, rules=()):
+        self._root = {}
+        for domain, value in rules:
+            self.add(domain, value)
+
+    def add(self, domain, value):
+        node = self._root
+        for label in reversed(domain.lower().strip('.').split('.')):
+            node = node.setdefault(label, {})
+        node[self._VALUE] = value
+
+    def lookup(self, domain, default=None):
+        match = default
+        node = self._root
+        for label in reversed(domain.lower().split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            match = node.get(self._VALUE, match)
+        return match
+
+
+def email_domain(email):
+    if not email or '@' not in email:
+        return None
+    return email.rpartition('@')[2].lower()
+
+
+class EmailPolicy:
+    """Compiled allowed-org and USDA-bypass rules for email addresses."""
+
+    def __init__(self, org_domains, bypass_users, bypass_domains):
+        self.org_index = DomainSuffixIndex(org_domains.items())
+        self.bypass_users = frozenset(user.lower() for user in bypass_users)
+        self.bypass_index = DomainSuffixIndex((domain, True) for domain in bypass_domains)
+
+    def get_org(self, email):
+        """Return the org for an email's domain, or None if it is not in an allowed org."""
+        domain = email_domain(email)
+        return self.org_index.lookup(domain) if domain else None
+
+    def is_bypass(self, email):
+        """Check if the user is in the special bypass list or domain."""
+        if not email:
+            return False
+        if email.lower() in self.bypass_users:
+            return True
+        domain = email_domain(email)
+        return bool(domain and self.bypass_index.lookup(domain, False))
+
+
+def compile_email_policy(raw):
+    return EmailPolicy(raw['org_domains'], raw.get('bypass_users', []), raw.get('bypass_domains', []))
@@ -0,0 +1,64 @@
+# Gunicorn configuration. The app is imported once in the master (preload) so workers
+# share its code pages copy-on-write; Redis and HTTP pools are created in each worker.
+
+# Patch before the app is preloaded, otherwise locks and sockets created at import are
+# the blocking originals and a greenlet waiting on one stalls the whole gevent worker.
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import shutil
+
+import startup_report
+from config import WEBHOOK_DRAIN_TIMEOUT_SECONDS
+
+# Must be set before prometheus_client is imported by the app (preload imports it in the master)
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus_multiproc')
+# Start every deployment with empty per-worker metric files
+shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+startup_report.start_tracemalloc()
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:80')
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+worker_class = 'gevent'
+timeout = 120
+# Leaves a stopping worker time to drain its accepted webhook events (see worker_exit)
+graceful_timeout = WEBHOOK_DRAIN_TIMEOUT_SECONDS + 10
+preload_app = True
+
+
+def when_ready(server):
+    startup_report.report_process('master')
+    # Periodic jobs run in the master: one candidate per replica, the lease picks the leader
+    from config import SCHEDULER_ENABLED
+    if SCHEDULER_ENABLED:
+        from scheduler import scheduler
+        scheduler.start()
+
+
+def on_exit(server):
+    from scheduler import scheduler
+    scheduler.stop()
+
+
+def post_fork(server, worker):
+    # Never reuse sockets opened by the master
+    from config import reset_process_resources
+    reset_process_resources()
+
+
+def post_worker_init(worker):
+    startup_report.report_process(f'worker-{worker.age}')
+
+
+def worker_exit(server, worker):
+    # Refuse new webhook payloads (ArcGIS retries on 503) and finish the ones already answered 200
+    from webhook_processor import webhook_processor
+    webhook_processor.stop(timeout=WEBHOOK_DRAIN_TIMEOUT_SECONDS)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,427 @@
+"""
+End-to-end load test for the auth service, fully offline.
+
+Starts local stand-ins for login.gov and ArcGIS (see stubs.py), optionally a local
+redis-server, and the app under gunicorn, then drives
+/auth -> /callback -> /arcgis_callback -> /token -> /userinfo for many users plus
+bursts of webhook events, and reports throughput and p50/p95/p99 latency per step.
+
+With --renewals N each user then renews its access token N times with the refresh_token grant
+(each followed by /userinfo), as a user-day of N + 1 token lifetimes would, and the report compares
+the IdP calls made against signing in again for every lifetime.
+
+With --concurrency-steps the login flow is then repeated at each concurrency in turn, and the
+report gives the highest concurrency the app held: no failed step and every step's p95 within
+--slo-ms. Run it once with --mode sync (gunicorn, app:create_app()) and once with --mode async
+(hypercorn, asgi_app:app) to compare how many concurrent logins one pod holds in each mode.
+
+    python -m loadtest.run_load_test --users 500 --concurrency 50 --start-redis
+    python -m loadtest.run_load_test --app-url http://127.0.0.1:8000 --idp-latency 0.2
+    python -m loadtest.run_load_test --mode async --concurrency-steps 50,100,200,400 --idp-latency 0.2
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from prometheus_client.parser import text_string_to_metric_families
+
+from loadtest.stubs import StubServer, StubSettings, create_arcgis_stub, create_idp_stub
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOGIN_STEPS = ('auth', 'callback', 'arcgis_callback', 'token', 'userinfo', 'refresh', 'refresh_userinfo')
+
+AUTH_CONFIG_TEMPLATE = """from types import SimpleNamespace
+
+AUTH = SimpleNamespace(IDP=SimpleNamespace(
+    CLIENT_ID='urn:gov:gsa:openidconnect.profiles:sp:sso:loadtest',
+    BASE_URL='{idp_url}/',
+    AUTHORIZATION_ROUTE='openid_connect/authorize',
+    TOKEN_ROUTE='api/openid_connect/token',
+    USERINFO_ROUTE='api/openid_connect/userinfo',
+    ACR_VALUE='http://idmanagement.gov/ns/assurance/ial/1',
+    PROMPT='select_account',
+    REDIRECT_URI='{app_url}/callback',
+    RESPONSE_TYPE='code',
+    SCOPE='openid+email',
+    CLIENT_ASSERTION_TYPE='urn:ietf:params:oauth:client-assertion-type:jwt-bearer',
+))
+"""
+
+
+class Recorder:
+    """Thread-safe collection of per-step latencies and outcomes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def record(self, step, seconds, status, ok):
+        with self._lock:
+            self.samples[step].append(seconds)
+            self.statuses[step][status] += 1
+            if not ok:
+                self.errors[step] += 1
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def summarize(recorder, wall_seconds):
+    summary = {}
+    for step, values in recorder.samples.items():
+        values = sorted(values)
+        summary[step] = {
+            'count': len(values),
+            'errors': recorder.errors[step],
+            'throughput_per_s': round(len(values) / wall_seconds, 1) if wall_seconds else None,
+            'p50_ms': round(percentile(values, 0.50) * 1000, 1),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 1),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 1),
+            'statuses': dict(recorder.statuses[step]),
+        }
+    return summary
+
+
+def timed(recorder, step, func, expected_status):
+    start = time.perf_counter()
+    try:
+        response = func()
+    except requests.RequestException as e:
+        recorder.record(step, time.perf_counter() - start, type(e).__name__, False)
+        return None
+    recorder.record(step, time.perf_counter() - start, response.status_code, response.status_code == expected_status)
+    return response if response.status_code == expected_status else None
+
+
+def raw_cookie(response, name):
+    """Return `name=value` exactly as set by the app; the Secure cookies are not sent back over plain http."""
+    for header in response.raw.headers.getlist('Set-Cookie'):
+        pair = header.split(';', 1)[0]
+        if pair.startswith(f'{name}='):
+            return pair
+    return None
+
+
+def run_login(app_url, run_id, user_index, email_domain, recorder, renewals=0):
+    http = requests.Session()
+    email = f'loadtest{run_id}_{user_index}@{email_domain}'
+
+    response = timed(recorder, 'auth', lambda: http.get(f'{app_url}/auth', allow_redirects=False), 302)
+    if not response:
+        return
+    # Play the IdP's part of the redirect: hand state back, and the nonce to the stub via the code
+    authorize = parse_qs(urlparse(response.headers['Location']).query)
+    state, nonce = authorize.get('state', [''])[0], authorize.get('nonce', [''])[0]
+    binding_cookie = raw_cookie(response, 'oidc_binding')
+    response = timed(recorder, 'callback', lambda: http.get(
+        f'{app_url}/callback', params={'code': f'{email}|{nonce}', 'state': state},
+        headers={'Cookie': binding_cookie or ''}, allow_redirects=False), 302)
+    if not response:
+        return
+    userinfo_cookie = raw_cookie(response, 'userinfo')
+    response = timed(recorder, 'arcgis_callback', lambda: http.get(
+        f'{app_url}/arcgis_callback', headers={'Cookie': userinfo_cookie or ''}, allow_redirects=False), 302)
+    if not response:
+        return
+    code = parse_qs(urlparse(response.headers['Location']).query).get('code', [''])[0]
+    response = timed(recorder, 'token', lambda: http.post(f'{app_url}/token', data={'code': code}), 200)
+    if not response:
+        return
+    access_token, refresh_token = response.json()['access_token'], response.json().get('refresh_token')
+    timed(recorder, 'userinfo', lambda: http.get(
+        f'{app_url}/userinfo', headers={'Authorization': f'Bearer {access_token}'}), 200)
+
+    for _ in range(renewals if refresh_token else 0):
+        response = timed(recorder, 'refresh', lambda: http.post(
+            f'{app_url}/token', data={'grant_type': 'refresh_token', 'refresh_token': refresh_token}), 200)
+        if not response:
+            return
+        access_token, refresh_token = response.json()['access_token'], response.json()['refresh_token']
+        timed(recorder, 'refresh_userinfo', lambda: http.get(
+            f'{app_url}/userinfo', headers={'Authorization': f'Bearer {access_token}'}), 200)
+
+
+def run_webhook_burst(app_url, run_id, burst_index, burst_size, recorder):
+    events = [
+        {'operation': 'add', 'source': 'users', 'username': f'webhook{run_id}_{burst_index}_{i}',
+         'when': int(time.time() * 1000)}
+        for i in range(burst_size)
+    ]
+    timed(recorder, 'webhook', lambda: requests.post(f'{app_url}/arcgis_webhook', json={'events': events}), 200)
+
+
+def webhook_events_done(app_url):
+    """Webhook events the app has finished (processed or failed), summed over its workers by /metrics."""
+    response = requests.get(f'{app_url}/metrics', timeout=5)
+    response.raise_for_status()
+    done = 0
+    for family in text_string_to_metric_families(response.text):
+        if family.name == 'webhook_events':
+            done += sum(sample.value for sample in family.samples
+                        if sample.name == 'webhook_events_total' and sample.labels.get('outcome') in ('processed', 'failed'))
+    return int(done)
+
+
+def wait_for_webhook_events(app_url, done_before, expected, timeout):
+    """Wait until `expected` events are done on top of `done_before`; returns (done, seconds waited)."""
+    start = time.perf_counter()
+    while True:
+        done = webhook_events_done(app_url) - done_before
+        if done >= expected or time.perf_counter() - start >= timeout:
+            return done, round(time.perf_counter() - start, 1)
+        time.sleep(0.5)
+
+
+def wait_for_port(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def write_auth_config(directory, idp_url, app_url):
+    with open(os.path.join(directory, 'auth_config.py'), 'w') as f:
+        f.write(AUTH_CONFIG_TEMPLATE.format(idp_url=idp_url, app_url=app_url))
+
+
+def generate_private_key():
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode()
+
+
+def start_redis(port):
+    return subprocess.Popen(
+        ['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def start_app(args, workdir, idp_url, arcgis_url, port):
+    app_url = f'http://127.0.0.1:{port}'
+    write_auth_config(workdir, idp_url, app_url)
+    env = dict(
+        os.environ,
+        AUTH_CONFIG_DIR=workdir,
+        AUTH_PRIVATE_KEY=generate_private_key(),
+        AUTH_SERVICE_DOMAIN=f'127.0.0.1:{port}',
+        ARCGIS_CLIENT_URL=f'{arcgis_url}/portal/home/',
+        ARCGIS_CLIENT_ID='loadtest',
+        ARCGIS_CLIENT_SECRET='loadtest',
+        ARCGIS_OIDC_CLIENT_ID='loadtest',
+        ARCGIS_LOGIN_REDIRECT_URL=f'{arcgis_url}/portal/sharing/oauth2/oidc/callback',
+        FLASK_SECRET_KEY='loadtest',
+        REDIS_SERVER=args.redis_host,
+        REDIS_PORT=str(args.redis_port),
+        REDIS_SSL='false',
+        GUNICORN_BIND=f'127.0.0.1:{port}',
+        GUNICORN_WORKERS=str(args.workers),
+        PROMETHEUS_MULTIPROC_DIR=os.path.join(workdir, 'prometheus'),
+        # All simulated users share one IP; admission control is opt-in here (RATE_LIMIT_ENABLED=true)
+        RATE_LIMIT_ENABLED=os.environ.get('RATE_LIMIT_ENABLED', 'false'),
+    )
+    if args.mode == 'async':
+        # gunicorn.conf.py creates the metrics directory in sync mode
+        os.makedirs(env['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+        command = [sys.executable, '-m', 'hypercorn', '--workers', str(args.workers), '--bind', f'127.0.0.1:{port}',
+                   'asgi_app:app']
+    else:
+        command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO_ROOT, 'gunicorn.conf.py'),
+                   'app:create_app()']
+    process = subprocess.Popen(
+        command, cwd=workdir, env=dict(env, PYTHONPATH=REPO_ROOT),
+        stdout=open(os.path.join(workdir, 'server.log'), 'w'), stderr=subprocess.STDOUT
+    )
+    return process, app_url
+
+
+def idp_calls_per_user_day(recorder, idp_calls, users, renewals):
+    """IdP calls per user measured over the login phase, against one full login per token lifetime."""
+    renewed = recorder.statuses['refresh'][200]
+    with_refresh = idp_calls / users
+    relogin = with_refresh * (renewals + 1)
+    return {
+        'logins': users,
+        'renewals_ok': renewed,
+        'renewals_expected': users * renewals,
+        'with_refresh': round(with_refresh, 2),
+        'relogin_every_lifetime': round(relogin, 2),
+        'reduction_pct': round(100 * (1 - with_refresh / relogin), 1) if relogin else None,
+    }
+
+
+def run_capacity_ramp(app_url, run_id, args):
+    """Login flows at each of args.concurrency_steps until one misses the SLO; returns the steps and the last held."""
+    steps, held = [], 0
+    for concurrency in args.concurrency_steps:
+        recorder = Recorder()
+        step_run_id = f'{run_id}c{concurrency}'
+        wall = run_phase(lambda i: run_login(app_url, step_run_id, i, args.email_domain, recorder),
+                         range(concurrency * args.flows_per_step), concurrency)
+        summary = summarize(recorder, wall)
+        errors = sum(stats['errors'] for stats in summary.values())
+        worst_p95 = max(stats['p95_ms'] for stats in summary.values())
+        ok = errors == 0 and worst_p95 <= args.slo_ms
+        steps.append({'concurrency': concurrency, 'errors': errors, 'worst_p95_ms': worst_p95, 'held': ok,
+                      'flows_per_s': round(recorder.statuses['userinfo'][200] / wall, 1)})
+        print(f"concurrency {concurrency:>5}: {steps[-1]['flows_per_s']:>7} flows/s, worst p95 {worst_p95} ms, "
+              f"{errors} errors -> {'held' if ok else 'not held'}")
+        if not ok:
+            break
+        held = concurrency
+    return {'steps': steps, 'held': held}
+
+
+def run_phase(func, jobs, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(func, job) for job in jobs]:
+            future.result()
+    return time.perf_counter() - start
+
+
+def print_report(title, summary, wall_seconds):
+    print(f"\n{title} ({wall_seconds:.1f}s)")
+    print(f"{'step':<16}{'count':>7}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}  statuses")
+    for step, stats in summary.items():
+        print(f"{step:<16}{stats['count']:>7}{stats['errors']:>8}{stats['throughput_per_s']:>9}"
+              f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}  {stats['statuses']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200, help='number of full login flows')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--webhook-bursts', type=int, default=20)
+    parser.add_argument('--burst-size', type=int, default=10, help='events per webhook payload')
+    parser.add_argument('--renewals', type=int, default=0,
+                        help='refresh_token renewals per user after login (11 ~ a 12 hour day of 1 hour tokens)')
+    parser.add_argument('--email-domain', default='usgs.gov')
+    parser.add_argument('--idp-latency', type=float, default=0.05, help='seconds added to every IdP call')
+    parser.add_argument('--arcgis-latency', type=float, default=0.05, help='seconds added to every ArcGIS call')
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--idp-error-rate', type=float, default=0.0)
+    parser.add_argument('--arcgis-error-rate', type=float, default=0.0)
+    parser.add_argument('--concurrency-steps', type=lambda value: [int(step) for step in value.split(',')],
+                        help='comma separated concurrencies to ramp the login flow through, e.g. 50,100,200')
+    parser.add_argument('--flows-per-step', type=int, default=3, help='login flows per concurrent user in each step')
+    parser.add_argument('--slo-ms', type=float, default=1000, help='p95 every login step must stay within')
+    parser.add_argument('--app-url', help='drive an already running app instead of starting one')
+    parser.add_argument('--mode', choices=('sync', 'async'), default='sync',
+                        help='serve the app with gunicorn (sync) or hypercorn and asgi_app.py (async)')
+    parser.add_argument('--workers', type=int, default=4, help='server workers when starting the app')
+    parser.add_argument('--redis-host', default='127.0.0.1')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument('--start-redis', action='store_true', help='start a throwaway redis-server on --redis-port')
+    parser.add_argument('--drain-timeout', type=float, default=30, help='seconds to wait for webhook processing')
+    parser.add_argument('--json-out', help='write the report as JSON to this path')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    idp_settings = StubSettings(args.idp_latency, args.jitter, args.idp_error_rate, args.email_domain)
+    arcgis_settings = StubSettings(args.arcgis_latency, args.jitter, args.arcgis_error_rate, args.email_domain)
+    idp = StubServer(create_idp_stub(idp_settings)).start()
+    arcgis = StubServer(create_arcgis_stub(arcgis_settings)).start()
+
+    processes = []
+    workdir = tempfile.mkdtemp(prefix='iipp-auth-loadtest-')
+    try:
+        if args.start_redis:
+            processes.append(start_redis(args.redis_port))
+            if not wait_for_port(args.redis_host, args.redis_port):
+                sys.exit('redis-server did not start')
+
+        app_url = args.app_url
+        if not app_url:
+            port = free_port()
+            process, app_url = start_app(args, workdir, idp.url, arcgis.url, port)
+            processes.append(process)
+            if not wait_for_port('127.0.0.1', port):
+                sys.exit(f'app did not start, see {workdir}/server.log')
+
+        # Unique per run so idempotency markers left in Redis by earlier runs do not short-circuit this one
+        run_id = int(time.time())
+        report = {'config': vars(args), 'run_id': run_id}
+
+        login_recorder = Recorder()
+        wall = run_phase(lambda i: run_login(app_url, run_id, i, args.email_domain, login_recorder, args.renewals),
+                         range(args.users), args.concurrency)
+        report['login'] = summarize(login_recorder, wall)
+        report['login']['flows_per_s'] = round(login_recorder.statuses['userinfo'][200] / wall, 1)
+        print_report(f"Login flows: {args.users} users, concurrency {args.concurrency}",
+                     {step: report['login'][step] for step in LOGIN_STEPS if step in report['login']}, wall)
+        print(f"Completed flows per second: {report['login']['flows_per_s']}")
+        if args.renewals:
+            report['idp_calls'] = idp_calls_per_user_day(
+                login_recorder, sum(idp_settings.calls.values()), args.users, args.renewals)
+            print(f"IdP calls per user-day ({args.renewals + 1} token lifetimes): "
+                  f"{report['idp_calls']['with_refresh']} with refresh tokens, "
+                  f"{report['idp_calls']['relogin_every_lifetime']} signing in again "
+                  f"({report['idp_calls']['reduction_pct']}% fewer)")
+
+        if args.concurrency_steps:
+            print(f"\nConcurrency ramp ({args.mode} mode, p95 SLO {args.slo_ms:g} ms)")
+            report['capacity'] = run_capacity_ramp(app_url, run_id, args)
+            print(f"Concurrent logins held: {report['capacity']['held']}")
+
+        webhook_recorder = Recorder()
+        events_done_before = webhook_events_done(app_url)
+        wall = run_phase(lambda i: run_webhook_burst(app_url, run_id, i, args.burst_size, webhook_recorder),
+                         range(args.webhook_bursts), args.concurrency)
+        report['webhook'] = summarize(webhook_recorder, wall)
+        print_report(f"Webhook bursts: {args.webhook_bursts} x {args.burst_size} events", report['webhook'], wall)
+
+        # Webhook events are processed after the 200; wait until every accepted event is done
+        accepted = webhook_recorder.statuses['webhook'][200] * args.burst_size
+        done, waited = wait_for_webhook_events(app_url, events_done_before, accepted, args.drain_timeout)
+        report['webhook_events'] = {'accepted': accepted, 'done': done, 'drain_seconds': waited}
+        print(f"Webhook events done: {done}/{accepted} after {waited}s"
+              + ('' if done >= accepted else f" (gave up after --drain-timeout {args.drain_timeout:g}s)"))
+        report['stub_calls'] = {'idp': dict(idp_settings.calls), 'arcgis': dict(arcgis_settings.calls)}
+        print(f"\nStub calls: {json.dumps(report['stub_calls'], indent=2)}")
+
+        if args.json_out:
+            with open(args.json_out, 'w') as f:
+                json.dump(report, f, indent=2, default=str)
+        return report
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(timeout=30)
+        idp.stop()
+        arcgis.stop()
+
+
+if __name__ == '__main__':
+    main()
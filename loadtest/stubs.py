@@ -0,0 +1,136 @@
+"""
+Local stand-ins for login.gov and the ArcGIS portal REST API used by the load tests.
+
+Both stubs are stateless: the IdP derives the user's email and the login nonce from the
+authorization code it is given (the load driver sends `email|nonce` as the code), and
+ArcGIS derives emails from usernames. Latency and error rate are configurable per stub.
+"""
+import logging
+import random
+import secrets
+import threading
+import time
+from collections import Counter
+
+import jwt
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+ARCGIS_PREFIX = '/portal/sharing/rest'
+
+# Per-request access logs from the stub servers would drown out the report
+logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+
+class StubSettings:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, email_domain='usgs.gov'):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.email_domain = email_domain
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] += 1
+
+
+def _install_fault_injection(app, settings):
+    @app.before_request
+    def inject_latency_and_errors():
+        settings.count(request.endpoint)
+        delay = settings.latency + random.uniform(0, settings.jitter)
+        if delay:
+            time.sleep(delay)
+        if settings.error_rate and random.random() < settings.error_rate:
+            settings.count('injected_error')
+            return jsonify({'error': 'injected_error', 'error_description': 'Injected by load test'}), 500
+
+
+def create_idp_stub(settings):
+    app = Flask('idp_stub')
+    _install_fault_injection(app, settings)
+
+    @app.route('/openid_connect/authorize')
+    def authorize():
+        return 'OK'
+
+    @app.route('/api/openid_connect/token', methods=['POST'])
+    def token():
+        email, _, nonce = request.form.get('code', '').partition('|')
+        return jsonify({
+            'access_token': f"{email}|{secrets.token_urlsafe(8)}",
+            'token_type': 'Bearer',
+            'expires_in': 900,
+            'id_token': jwt.encode({'sub': f"sub-{email.split('@')[0]}", 'nonce': nonce}, 'idp-stub-signing-key-for-load-tests', algorithm='HS256'),
+        })
+
+    @app.route('/api/openid_connect/userinfo')
+    def userinfo():
+        access_token = request.headers.get('Authorization', '')[7:]
+        email = access_token.split('|', 1)[0]
+        local_part = email.split('@')[0]
+        return jsonify({
+            'sub': f'sub-{local_part}',
+            'iss': 'http://idp.stub/',
+            'email': email,
+            'email_verified': True,
+            'given_name': local_part.title(),
+            'family_name': 'Loadtest',
+        })
+
+    return app
+
+
+def create_arcgis_stub(settings):
+    app = Flask('arcgis_stub')
+    _install_fault_injection(app, settings)
+
+    @app.route(f'{ARCGIS_PREFIX}/generateToken', methods=['POST'])
+    def generate_token():
+        return jsonify({'token': secrets.token_urlsafe(16), 'expires': int(time.time() * 1000) + 3600000, 'ssl': False})
+
+    @app.route(f'{ARCGIS_PREFIX}/community/users')
+    def search_users():
+        query = request.args.get('q', '')
+        if query.startswith('email:'):
+            email = query[len('email:'):]
+            return jsonify({'total': 1, 'results': [{'username': email.split('@')[0], 'email': email}]})
+        return jsonify({'total': 0, 'results': []})
+
+    @app.route(f'{ARCGIS_PREFIX}/community/users/<username>')
+    def get_user(username):
+        return jsonify({'username': username, 'email': f'{username}@{settings.email_domain}'})
+
+    @app.route(f'{ARCGIS_PREFIX}/community/groups')
+    def search_groups():
+        title = request.args.get('q', '').replace('title:', '', 1)
+        return jsonify({'total': 1, 'results': [{'id': f'group-{title.lower()}', 'title': title}]})
+
+    @app.route(f'{ARCGIS_PREFIX}/community/groups/<group_id>/addUsers', methods=['POST'])
+    def add_users(group_id):
+        return jsonify({'notAdded': []})
+
+    return app
+
+
+class StubServer:
+    """Run a stub app on a background thread."""
+
+    def __init__(self, app, host='127.0.0.1', port=0):
+        self._server = make_server(host, port, app, threaded=True)
+        self.host = host
+        self.port = self._server.server_port
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
@@ -0,0 +1,180 @@
+"""
+Decisions of the login routes, shared by the Flask routes (routes.py) and their async variants
+(async_routes.py). Nothing here touches Redis or the network: the caller reads what a decision
+needs with its own clients, asks for the decision, and carries it out.
+"""
+import logging
+from urllib import parse
+
+from config import ARCGIS_CLIENT_URL, ARCGIS_OIDC_CLIENT_ID, ARCGIS_LOGIN_CALLBACK_URL, ARCGIS_LOGIN_REDIRECT_URL, \
+    AUTH_SERVICE_DOMAIN, ACCESS_TOKEN_TTL_SECONDS, REFRESH_TOKEN_TTL_SECONDS, SELF_SELECT_GROUP_FORM_URL, USER_NOT_IN_ALLOWED_AGENCY_URL
+from manage_arcgis_user_groups_helper_functions import is_usda_user, is_user_org_in_allowed_orgs
+from metrics import TOKEN_GRANTS
+from redis_helpers import get_email_to_user_groups, get_user_auth_access, split_refresh_token
+from token_generation import generate_auth_code, generate_jwt_token, generate_refresh_token, \
+    parse_auth_access, parse_x509_subject
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./login_flow.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+NEW_USER_AUTH_ACCESS = {'is_disallowed': False, 'has_selected_group': False}
+
+
+# /auth
+
+def login_return_target(return_to):
+    """Only return to pages of this service after login; anything else is an open redirect."""
+    if return_to:
+        target = parse.urlparse(return_to)
+        if target.scheme == 'https' and target.netloc == AUTH_SERVICE_DOMAIN:
+            return return_to
+        logger.warning(f"Ignoring login return target outside {AUTH_SERVICE_DOMAIN}: {return_to}")
+    return ARCGIS_LOGIN_CALLBACK_URL
+
+
+# /callback
+
+def complete_userinfo(userinfo):
+    """Fill in given_name, family_name and organizations from the x509 subject or the email."""
+    x509_subject = userinfo.get('x509_subject')
+    user_email = userinfo.get('email')
+    if x509_subject:
+        given_name, family_name, organizations = parse_x509_subject(x509_subject)
+        userinfo['organizations'] = organizations
+    else:
+        logger.info(f'No x509 subject found, using email to set names for {user_email}')
+        given_name = userinfo.get('given_name', user_email.split('@')[0])
+        family_name = userinfo.get('family_name', user_email.split('@')[1].split('.')[-2])
+    userinfo['given_name'] = given_name
+    userinfo['family_name'] = family_name
+    return userinfo
+
+
+def should_prefetch(user_email, user_record):
+    """
+    A user without a known portal username is about to get an account and its `add` webhook;
+    the lookups that webhook makes are warmed while the user is still signing in to ArcGIS.
+    """
+    allowed = is_usda_user(user_email) or is_user_org_in_allowed_orgs(user_email)
+    return allowed and not (user_record or {}).get('username')
+
+
+def callback_decision(userinfo, user_record, return_to):
+    """
+    Where /callback sends a user whose stored record is `user_record` (None for a new user).
+
+    Returns (location, set_userinfo_cookie, auth_access): auth_access is the value to store
+    with put_user_auth_access before redirecting, or None.
+    """
+    user_email = userinfo.get('email')
+    user_permission_data = get_user_auth_access(user_email, record=user_record or {})
+    auth_access = None
+
+    # ✅ Apply Bypass Check
+    # this isn't really the bypass as its inside really just inside of is_usda_user
+    if is_usda_user(user_email):
+        logger.info(f"Bypass activated for {user_email} - forcing USDA access.")
+        user_is_usda = True
+        user_is_in_allowed_orgs = True
+        user_has_selected_group = get_email_to_user_groups(user_email, record=user_record or {}) is not None
+    else:
+        user_is_usda = False
+        user_is_in_allowed_orgs = is_user_org_in_allowed_orgs(user_email)
+        user_has_selected_group = False
+
+    # this is if users have logged in before and have data in redis
+    if user_permission_data is not None:
+        (user_is_disallowed,
+         user_previous_selected_group) = parse_auth_access(user_permission_data.get('auth_access'))
+
+        if user_is_disallowed is True:
+            logger.warning(f'User {user_email} is disallowed. Checking for USDA and selected group.')
+            if user_is_usda is True and user_previous_selected_group is not None:
+                if get_email_to_user_groups(user_email, record=user_record):
+                    logger.info(f'User {user_email} is allowed to re-select group {user_previous_selected_group}')
+                    user_is_disallowed = False
+                    user_has_selected_group = False
+                    auth_access = dict(NEW_USER_AUTH_ACCESS)
+                else:
+                    logger.warning(
+                        f'User {user_email} not allowed to select group {user_previous_selected_group}. Redirecting.')
+                    return USER_NOT_IN_ALLOWED_AGENCY_URL, False, None
+
+        if user_is_disallowed is False:
+            if user_is_usda is False:
+                logger.debug(f'User {user_email} is not USDA, redirecting to {return_to}')
+                return return_to, True, auth_access
+            if user_has_selected_group is True:
+                logger.info(f'User {user_email} is USDA and has selected a group, redirecting.')
+                return return_to, True, auth_access
+
+    # if the user has never logged in, is not usda and is not in allowed orgs
+    if not user_is_in_allowed_orgs:
+        logger.warning(
+            f'User {user_email} is not in allowed organizations, redirecting to {USER_NOT_IN_ALLOWED_AGENCY_URL}')
+        return USER_NOT_IN_ALLOWED_AGENCY_URL, False, auth_access
+
+    given_name, family_name = userinfo.get('given_name'), userinfo.get('family_name')
+    logger.info(f'User first name: {given_name}, last name: {family_name}')
+
+    # this section is for entirely new users that have no data in redis
+    # or for users that have logged in before but have not selected a group
+    if user_is_usda and user_has_selected_group is False:
+        logger.info(f'User {user_email} is USDA and has not selected a group, redirecting to self-select form.')
+        self_select_form_url = parse.urljoin(SELF_SELECT_GROUP_FORM_URL,
+                                             f"?email={user_email}&firstname={given_name}&lastname={family_name}")
+        return self_select_form_url, True, auth_access
+
+    logger.debug(f'Creating user data for {user_email} and redirecting to {return_to}')
+    if user_record is None or 'auth_access' not in user_record:
+        auth_access = dict(NEW_USER_AUTH_ACCESS)
+    return return_to, True, auth_access
+
+
+# /arcgis_callback
+
+def new_login_tokens():
+    """(auth code, access token, refresh token or None) handed to ArcGIS for one login."""
+    return (generate_auth_code(), generate_jwt_token(ARCGIS_CLIENT_URL, ARCGIS_OIDC_CLIENT_ID),
+            generate_refresh_token() if REFRESH_TOKEN_TTL_SECONDS else None)
+
+
+def arcgis_login_redirect(auth_code):
+    return f'{ARCGIS_LOGIN_REDIRECT_URL}?code={auth_code}'
+
+
+# /token
+
+def token_response(access_token, refresh_token=None):
+    response = {
+        "access_token": access_token,
+        "token_type": "Bearer",
+        "expires_in": ACCESS_TOKEN_TTL_SECONDS,
+    }
+    if refresh_token:
+        response['refresh_token'] = refresh_token
+    return response
+
+
+def prepare_refresh_grant(refresh_token):
+    """
+    (new access token, next refresh token of the same family) for a refresh_token grant, or None
+    when the grant is disabled or the token is malformed; the caller then redeems it with one
+    rotate_refresh_token call.
+    """
+    parts = split_refresh_token(refresh_token)
+    if not REFRESH_TOKEN_TTL_SECONDS or not parts:
+        TOKEN_GRANTS.labels('refresh_token', 'invalid').inc()
+        return None
+    return generate_jwt_token(ARCGIS_CLIENT_URL, ARCGIS_OIDC_CLIENT_ID), generate_refresh_token(parts[0])
+
+
+def record_refresh_outcome(refresh_token, outcome, email):
+    TOKEN_GRANTS.labels('refresh_token', outcome).inc()
+    if outcome == 'reused':
+        logger.warning(f"Refresh token reuse for {email}, family {split_refresh_token(refresh_token)[0]} revoked")
+    return outcome == 'ok'
@@ -5,15 +5,21 @@ import redis
 import json
 import arcgis_api
 import re
-from config import redis_client, ARCGIS_GROUPS_KEY
-from redis_helpers import get_email_to_user_groups, get_username_to_email, delete_username_to_email, \
-    delete_user_auth_access, delete_email_to_user_groups, get_arcgis_groups
+import webhook_idempotency
+from config import redis_client, ARCGIS_GROUPS_KEY, ORG_HIERARCHY_PATH, EMAIL_POLICY_PATH
+from email_policy import compile_email_policy
+from org_hierarchy import compile_hierarchy
+from reloadable_config import ReloadableConfig
+from metrics import ARCGIS_PREFETCH_LOOKUPS
+from redis_helpers import get_email_to_user_groups, get_username_to_email, delete_user_record, \
+    get_arcgis_groups, put_username_to_email, delete_user_group_assignment, put_arcgis_prefetch, \
+    get_arcgis_prefetch, get_prefetched_arcgis_user
 
 # Set up logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-file_handler = logging.FileHandler('./add_users_to_group.log')
+file_handler = logging.FileHandler('./add_users_to_group.log', delay=True)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 file_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
@@ -35,6 +41,20 @@ proper_group_names = {
 
 allowed_domains = [f'{name}.gov' for name in allowed_orgs]
 
+# Users and domains that are treated as USDA regardless of their email domain
+SPECIAL_USDA_USERS = {
+    "andrea_borghi@ios.doi.gov",
+    "john_gillham@ios.doi.gov",
+    "satish_bobburi@ios.doi.gov"
+}
+
+SPECIAL_USDA_DOMAINS = {
+    # "specialagency.gov",
+    # "examplemilitary.mil",
+    "contractor.usgs.gov",
+    "usda.gov"
+}
+
 parent_groups = {
     'all_government': ['usda', 'doi', 'doc'],
     'usda': ['ars', 'fas', 'fpac', 'fsa', 'nass', 'nrcs', 'usfs', 'usgs', 'fws'],
@@ -43,29 +63,34 @@ parent_groups = {
 }
 
 
+# Email rules are read from EMAIL_POLICY_PATH when present; the constants above are the fallback
+email_policy = ReloadableConfig(EMAIL_POLICY_PATH, compile_email_policy, default={
+    'org_domains': {domain: domain.replace(".gov", "") for domain in allowed_domains},
+    'bypass_users': sorted(SPECIAL_USDA_USERS),
+    'bypass_domains': sorted(SPECIAL_USDA_DOMAINS),
+})
+
 def get_user_group(user_email):
     """Determine user's group based on email domain."""
-    for domain in allowed_domains:
-        if user_email.endswith(domain):
-            return domain.replace(".gov", "")
-    return None
+    return email_policy.get().get_org(user_email)
+
+def is_usda_user(user_email):
+    """Check if the user is in the special bypass list or domain."""
+    return email_policy.get().is_bypass(user_email)
+
+# The hierarchy is read from ORG_HIERARCHY_PATH when present; the constants above are the fallback
+org_hierarchy = ReloadableConfig(ORG_HIERARCHY_PATH, compile_hierarchy, default={
+    'groups': group_names,
+    'parent_groups': parent_groups,
+    'proper_group_names': proper_group_names,
+})
 
 def get_parent_group(child_group):
-  for parent, children in parent_groups.items():
-    if child_group in children:
-      return parent
-  return False
+  parents = org_hierarchy.get().parents.get(child_group)
+  return parents[0] if parents else False
 
 def get_parent_groups(user_group):
-  matched_parent_groups = []
-  for search_attempt in range(len(parent_groups)):
-    match_group = get_parent_group(user_group)
-    if match_group in group_names:
-      matched_parent_groups.append(match_group)
-      user_group = match_group
-    else:
-      break
-  return matched_parent_groups
+  return list(org_hierarchy.get().get_parent_groups(user_group))
 
 # -------------------------
 # ✅ Authorization & Group Validation (Fully Integrated)
@@ -85,7 +110,12 @@ def get_arcgis_group_titles():
         groups_data = redis_client.get(ARCGIS_GROUPS_KEY)
         logger.info(f"Fetched group titles from Redis: {groups_data}")
         if groups_data:
-            titles = re.findall(r"'([^']+)'", groups_data)
+            try:
+                # Written by store_arcgis_group_titles as {"Titles": [...]}
+                titles = json.loads(groups_data)['Titles']
+            except (ValueError, KeyError, TypeError):
+                # Older values were stored as a Python repr with single quotes
+                titles = re.findall(r"'([^']+)'", groups_data)
             logger.info(f"Converted group titles to list: {titles}")
             return titles
         else:
@@ -139,6 +169,25 @@ def remove_arcgis_group_title(title_to_remove):
     logger.info(f"Group title '{title_to_remove}' not found.")
     return False
 
+def sync_arcgis_group_titles():
+    """
+    Re-read which of the org hierarchy's groups exist in the portal and store their titles
+    (scheduler job). The stored list is left alone if none can be found.
+    """
+    hierarchy = org_hierarchy.get()
+    wanted = [hierarchy.proper_group_names[group] for group in hierarchy.groups if group in hierarchy.proper_group_names]
+    titles = []
+    for title in wanted:
+        group = arcgis_api.get_group_by_title(title)
+        if group:
+            titles.append(group['title'])
+    if not titles:
+        raise RuntimeError(f"None of {len(wanted)} ArcGIS groups found; keeping the stored titles")
+    if sorted(titles) != sorted(get_arcgis_group_titles()):
+        store_arcgis_group_titles(titles)
+    logger.info(f"Synced ArcGIS group titles: {len(titles)} of {len(wanted)} found")
+    return len(titles)
+
 # Main Logic for Assigning Users to Groups
 
 def arcgis_webhook_assign_user_to_groups(username):
@@ -165,47 +214,139 @@ def arcgis_webhook_assign_user_to_self_selected_group(username, user_groups_list
     logger.info(f"Added user {user_email} to groups {all_groups}")
 
 def get_user_groups(base_user_group):
-    parent_groups = get_parent_groups(base_user_group)
-    all_groups = parent_groups[:]
-    all_groups.append(base_user_group)
-    new_groups = [proper_group_names.get(g) for g in all_groups]
-    logger.info(f"Found groups {all_groups} for user group {base_user_group}")
+    new_groups = org_hierarchy.get().get_group_titles(base_user_group)
+    logger.info(f"Found groups {new_groups} for user group {base_user_group}")
     return new_groups
 
-def add_user_to_groups(data):
+def target_group_titles(user_email):
+    """Titles of the groups a new portal account is added to: the self-selected group or the email's org."""
+    selected_group = get_email_to_user_groups(user_email)
+    user_group = selected_group['user_groups'] if selected_group else get_user_group(user_email)
+    logger.info(f'Attempting to assign user group: {user_group}')
+    return get_user_groups(user_group)
+
+# Login-time prefetch. /callback runs seconds before the portal creates the account and sends the
+# `add` webhook, so the portal lookups that webhook needs are made then (see arcgis_prefetch.py).
+
+def prefetch_arcgis_lookups(user_email):
+    """Resolve the user's target groups and any existing portal user, and store them for the webhook."""
+    group_titles = target_group_titles(user_email)
+    groups = {}
+    for title in group_titles:
+        group = arcgis_api.get_group_by_title(title)
+        if group:
+            groups[title] = {'id': group['id'], 'title': group['title']}
+    user = arcgis_api.get_user_by_email(user_email)
+    put_arcgis_prefetch(user_email, {'group_titles': group_titles, 'groups': groups, 'user': user})
+    logger.info(f"Prefetched {len(groups)} of {len(group_titles)} groups for {user_email}, "
+                f"portal user {'found' if user else 'not found'}")
+
+def prefetched_groups(user_email, group_titles):
+    """Groups resolved at login for `group_titles`; titles missing here are looked up in the portal."""
+    prefetch = get_arcgis_prefetch(user_email) or {}
+    groups = {title: group for title, group in (prefetch.get('groups') or {}).items() if title in group_titles}
+    ARCGIS_PREFETCH_LOOKUPS.labels('group', 'hit').inc(len(groups))
+    ARCGIS_PREFETCH_LOOKUPS.labels('group', 'miss').inc(len(set(group_titles)) - len(groups))
+    return groups
+
+def get_new_portal_user(username):
+    """The portal user for an `add` event, from the login-time prefetch when the account already existed then."""
+    user = get_prefetched_arcgis_user(username)
+    ARCGIS_PREFETCH_LOOKUPS.labels('user', 'hit' if user else 'miss').inc()
+    return user or arcgis_api.get_user_from_username(username)
+
+def get_event_user_key(event):
+    """Return the user an event refers to (user events carry `username`, deletes carry `id`)."""
+    return event.get('username') or event.get('id')
+
+def is_user_event(event):
+    operation = event.get('operation')
+    source = event.get('source')
+    return (operation in ('add', 'update') and source == 'users') or (operation == 'delete' and source == 'user')
+
+def group_events_by_user(data):
     """
-    This function processes the incoming user data and assigns them to appropriate ArcGIS groups.
+    Group every event in a webhook payload by user, preserving per-user order.
+    An update is dropped when a later add/update for the same user follows it, since
+    the later event refreshes the same username-to-email mapping.
+    Returns (list of (user_key, events), number of events collapsed).
+    """
+    events_by_user = {}
+    collapsed = 0
+    for event in (data or {}).get('events') or []:
+        if not is_user_event(event):
+            logger.info(f"Ignoring webhook event: {event}")
+            continue
+        user_events = events_by_user.setdefault(get_event_user_key(event), [])
+        if user_events and user_events[-1]['operation'] == 'update' and event['operation'] in ('add', 'update'):
+            user_events.pop()
+            collapsed += 1
+        user_events.append(event)
+    return list(events_by_user.items()), collapsed
+
+def process_webhook_event(event):
     """
-    operation = data['events'][0]['operation']
-    source = data['events'][0]['source']
+    Handle a single ArcGIS webhook event: store the username-to-email mapping and assign
+    groups for created users, or remove a deleted user's data from Redis.
+    Duplicate deliveries are skipped before any portal call.
+    """
+    if not webhook_idempotency.claim_event(event):
+        return
+    try:
+        _handle_webhook_event(event)
+    except Exception:
+        webhook_idempotency.release_event(event)
+        raise
+
+def _handle_webhook_event(event):
+    operation = event['operation']
+    source = event['source']
     user_was_created = operation == 'add' and source == 'users'
     user_was_updated = operation == 'update' and source == 'users'
+    user_was_deleted = operation == 'delete' and source == 'user'
 
-    if user_was_updated or user_was_created:
-        username = data['events'][0]['username']
-        user = arcgis_api.get_user_from_username(username)
+    # Handle user creation or update
+    if user_was_created or user_was_updated:
+        username = event.get('username')
+        # An update may change the user's email, so only a new account can use the login-time copy
+        user = get_new_portal_user(username) if user_was_created else arcgis_api.get_user_from_username(username)
         user_email = user.get('email')
-        # Store mapping from username to email in Redis
-        add_arcgis_group_title(user_email)  # Ensure the email is stored correctly as a title or group
 
+        # Store username-to-email mapping in Redis
+        put_username_to_email(username, user_email)
+
+        # Handle group assignment for created user
         if user_was_created:
-            user_groups = get_email_to_user_groups(user_email)
-            if user_groups:
-                # Assign user to their self-selected groups
-                arcgis_webhook_assign_user_to_self_selected_group(
-                    username, json.loads(user_groups['user_groups'])
-                )
-            else:
-                # If no groups selected, assign user to default groups
-                arcgis_webhook_assign_user_to_groups(username)
+            group_titles = target_group_titles(user_email)
+            if not webhook_idempotency.is_assignment_satisfied(username, group_titles):
+                not_applied = arcgis_api.add_user_to_groups(user, group_titles,
+                                                            groups=prefetched_groups(user_email, group_titles))
+                if not_applied:
+                    # Raising releases the event claim, so a redelivery retries the assignment
+                    raise RuntimeError(f"Groups not applied for {username}: {not_applied}")
+                webhook_idempotency.mark_assignment_satisfied(username, group_titles)
 
-    user_was_deleted = operation == 'delete' and source == 'user'
-    if user_was_deleted:
-        username = data['events'][0]['id']
-        user_email = get_username_to_email(username)
-        # Remove user mappings and access
-        delete_username_to_email(username)
-        delete_user_auth_access(user_email)
-        delete_email_to_user_groups(user_email)
+    # Handle user deletion
+    elif user_was_deleted:
+        username = event.get('id')
+        user = get_username_to_email(username)
+        user_email = user.get('user_email')
+
+        logger.info(f'Deleting user-related data for {user_email}')
+
+        # Delete the user's record, username alias and any legacy keys in one call
+        delete_user_record(user_email, username)
+        delete_user_group_assignment(username)
+
+def add_user_to_groups(data):
+    """
+    This function processes every event in the incoming webhook payload and assigns users to appropriate ArcGIS groups.
+    """
+    user_events, collapsed = group_events_by_user(data)
+    if collapsed:
+        logger.info(f"Collapsed {collapsed} superseded update events")
+    for user_key, events in user_events:
+        for event in events:
+            process_webhook_event(event)
 
     return 'OK', 200
@@ -0,0 +1,198 @@
+import functools
+import os
+import time
+from contextlib import contextmanager
+
+from flask import Blueprint, Response, request, g
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess
+)
+
+from tracing import start_span
+
+# Metrics from every gunicorn worker are aggregated through PROMETHEUS_MULTIPROC_DIR
+# (set in gunicorn.conf.py before the app is imported).
+MULTIPROCESS_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Latency of requests handled by the auth service',
+    ['route', 'method', 'status'], buckets=LATENCY_BUCKETS
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'http_requests_in_flight', 'Requests currently being handled', multiprocess_mode='livesum'
+)
+OUTBOUND_LATENCY = Histogram(
+    'outbound_request_duration_seconds', 'Latency of calls to ArcGIS and the identity provider',
+    ['dependency', 'operation', 'outcome'], buckets=LATENCY_BUCKETS
+)
+REDIS_LATENCY = Histogram(
+    'redis_command_duration_seconds', 'Latency of Redis commands by key family',
+    ['command', 'key_family', 'outcome'], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 10)
+)
+WEBHOOK_EVENTS = Counter(
+    'webhook_events_total', 'ArcGIS webhook events by outcome', ['outcome']
+)
+WEBHOOK_EVENT_LATENCY = Histogram(
+    'webhook_event_duration_seconds', 'Time from webhook receipt to event completion', buckets=LATENCY_BUCKETS
+)
+WEBHOOK_QUEUE_DEPTH = Gauge(
+    'webhook_queue_depth', 'Webhook work items waiting to be processed', multiprocess_mode='livesum'
+)
+WEBHOOK_WORKERS_BUSY = Gauge(
+    'webhook_workers_busy', 'Webhook workers currently processing events', multiprocess_mode='livesum'
+)
+REDIS_POOL_IN_USE = Gauge(
+    'redis_pool_connections_in_use', 'Redis connections checked out of the pool', multiprocess_mode='livesum'
+)
+RATE_LIMIT_DECISIONS = Counter(
+    'rate_limit_decisions_total', 'Admission decisions by route and the bucket that rejected', ['route', 'outcome']
+)
+RATE_LIMIT_HEADROOM = Gauge(
+    'rate_limit_headroom_ratio', 'Fraction of the global bucket still available after the last request',
+    ['route'], multiprocess_mode='livemin'
+)
+SINGLEFLIGHT_CALLS = Counter(
+    'singleflight_calls_total', 'Coalesced lookups by role: leader ran it, local/remote waited on a leader, '
+    'fallback ran it after the leader was lost', ['name', 'role']
+)
+SCHEDULER_JOB_DURATION = Histogram(
+    'scheduler_job_duration_seconds', 'Duration of background job runs', ['job', 'outcome'], buckets=LATENCY_BUCKETS
+)
+SCHEDULER_JOB_LAST_SUCCESS = Gauge(
+    'scheduler_job_last_success_timestamp_seconds', 'When each background job last succeeded', ['job'],
+    multiprocess_mode='max'
+)
+SCHEDULER_LEADER = Gauge(
+    'scheduler_leader', 'Processes currently holding the scheduler lease', multiprocess_mode='livesum'
+)
+ARCGIS_PREFETCH = Counter(
+    'arcgis_prefetch_total', 'Login-time ArcGIS prefetches by outcome', ['outcome']
+)
+ARCGIS_PREFETCH_LOOKUPS = Counter(
+    'arcgis_prefetch_lookups_total', 'Webhook portal lookups answered by a prefetch (hit) or the portal (miss)',
+    ['kind', 'outcome']
+)
+REDIS_DEGRADED = Gauge(
+    'redis_degraded', 'Workers serving in degraded mode because Redis is unreachable', multiprocess_mode='livesum'
+)
+REDIS_BREAKER_TRANSITIONS = Counter(
+    'redis_breaker_transitions_total', 'Redis circuit breaker transitions by the state entered', ['state']
+)
+DEGRADED_WRITES = Counter(
+    'degraded_writes_total', 'Redis writes deferred during an outage, by outcome '
+    '(buffered, flushed, dropped when the buffer was full, failed on replay)', ['outcome']
+)
+DEGRADED_WRITE_BUFFER_DEPTH = Gauge(
+    'degraded_write_buffer_depth', 'Deferred Redis writes waiting to be flushed', multiprocess_mode='livesum'
+)
+DEGRADED_CACHE_READS = Counter(
+    'degraded_cache_reads_total', 'Reads served from the in-process cache while Redis was unreachable', ['outcome']
+)
+TOKEN_GRANTS = Counter(
+    'token_grants_total', 'Token endpoint grants by grant type and outcome (ok, invalid, reused)', ['grant', 'outcome']
+)
+CHANGE_FEED_LENGTH = Gauge(
+    'change_feed_length', 'Entries in the change-data feed stream', multiprocess_mode='mostrecent'
+)
+CHANGE_FEED_CONSUMER_LAG = Gauge(
+    'change_feed_consumer_lag_seconds', 'Age of the oldest change each named consumer has not committed yet '
+    '(0 when caught up)', ['consumer'], multiprocess_mode='mostrecent'
+)
+HTTP_POOL_CONNECTIONS = Gauge(
+    'http_pool_connections', 'Outbound HTTP connection pools held by the shared session', multiprocess_mode='livesum'
+)
+
+metrics_blueprint = Blueprint("metrics", __name__)
+
+
+def key_family(key):
+    """Collapse a Redis key to its family, e.g. 'user-auth-access:a@b.gov' -> 'user-auth-access'."""
+    return str(key).split(':', 1)[0] if ':' in str(key) else str(key)
+
+
+@contextmanager
+def observe_outbound(dependency, operation):
+    start = time.perf_counter()
+    outcome = 'ok'
+    try:
+        with start_span(f"{dependency} {operation}", **{'peer.service': dependency}):
+            yield
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        OUTBOUND_LATENCY.labels(dependency, operation, outcome).observe(time.perf_counter() - start)
+
+
+def timed_dependency(dependency):
+    """Decorator recording the latency of an outbound call, labeled with the function name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with observe_outbound(dependency, func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def observe_redis(command, key):
+    start = time.perf_counter()
+    outcome = 'ok'
+    try:
+        with start_span(f"redis {command} {key_family(key)}", **{'db.system': 'redis'}):
+            yield
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        REDIS_LATENCY.labels(command, key_family(key), outcome).observe(time.perf_counter() - start)
+
+
+def update_pool_gauges():
+    """Refresh utilization gauges for this worker (called after each request)."""
+    from config import redis_client, http_session
+    from webhook_processor import webhook_processor
+
+    WEBHOOK_QUEUE_DEPTH.set(webhook_processor.queue_depth())
+    WEBHOOK_WORKERS_BUSY.set(webhook_processor.busy_workers())
+    if redis_client._instance is not None:
+        REDIS_POOL_IN_USE.set(len(getattr(redis_client.connection_pool, '_in_use_connections', ())))
+    if http_session._instance is not None:
+        HTTP_POOL_CONNECTIONS.set(sum(len(adapter.poolmanager.pools) for adapter in http_session.adapters.values()))
+
+
+def init_metrics(app):
+    """Register request instrumentation and the /metrics endpoint on the app."""
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+
+    @app.after_request
+    def record_request_latency(response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            REQUEST_LATENCY.labels(route, request.method, response.status_code).observe(time.perf_counter() - start)
+        update_pool_gauges()
+        return response
+
+    @app.teardown_request
+    def finish_request(exc):
+        REQUESTS_IN_FLIGHT.dec()
+
+    app.register_blueprint(metrics_blueprint)
+
+
+@metrics_blueprint.route('/metrics')
+def metrics_route():
+    if MULTIPROCESS_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,118 @@
+"""
+Backfill the consolidated user:<email> records from the legacy per-user keys.
+
+The app already migrates a user lazily the first time it reads them (see
+redis_helpers.get_user_record); this sweeps everyone else so the legacy keys can be dropped.
+Safe to run while the app is serving traffic and to rerun: records already marked migrated are
+left alone, and a record holding only some fields (e.g. written by the username alias) gets the
+missing ones filled in.
+
+    python migrate_user_records.py --dry-run
+    python migrate_user_records.py
+    python migrate_user_records.py --delete-legacy   # once every pod reads the new records and
+                                                     # USER_RECORD_DUAL_WRITE is off
+"""
+import argparse
+import logging
+import sys
+from collections import Counter
+
+from config import redis_client
+from redis_helpers import (
+    USER_AUTH_ACCESS_KEY, USER_EMAIL_TO_USER_GROUPS_KEY, USERNAME_TO_EMAIL_KEY, USERNAME_ALIAS_KEY,
+    decode_fields, legacy_user_keys, migrate_user_record, needs_migration, redis_get, user_record_key,
+    username_alias_key
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./migrate_user_records.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+SCAN_COUNT = 500
+# Per-login copies that are now a field of the record; nothing to backfill, only to delete
+STALE_KEY_PATTERNS = ('*:userinfo:*', '*:has_selected_group')
+
+
+def legacy_emails():
+    """Yield each email that has legacy auth-access or user-groups keys, once."""
+    seen = set()
+    for family in (USER_AUTH_ACCESS_KEY, USER_EMAIL_TO_USER_GROUPS_KEY):
+        for key in redis_client.scan_iter(match=f"{family}:*", count=SCAN_COUNT):
+            email = key.split(':', 1)[1]
+            if email not in seen:
+                seen.add(email)
+                yield email
+
+
+def migrate_users(dry_run=False, delete_legacy=False):
+    counts = Counter()
+    for email in legacy_emails():
+        record = decode_fields(redis_get(user_record_key(email)))
+        if not needs_migration(record):
+            counts['already_migrated'] += 1
+        elif dry_run:
+            counts['would_migrate'] += 1
+            continue
+        else:
+            migrate_user_record(email, record)
+            counts['migrated'] += 1
+        if delete_legacy and not dry_run:
+            redis_client.delete(*legacy_user_keys(email=email))
+            counts['legacy_deleted'] += 1
+    return counts
+
+
+def migrate_usernames(dry_run=False, delete_legacy=False):
+    counts = Counter()
+    for key in redis_client.scan_iter(match=f"{USERNAME_TO_EMAIL_KEY}:*", count=SCAN_COUNT):
+        username = key.split(':', 1)[1]
+        if redis_client.exists(username_alias_key(username)):
+            counts['alias_exists'] += 1
+        elif dry_run:
+            counts['would_alias'] += 1
+            continue
+        else:
+            legacy = redis_get(key) or {}
+            if legacy.get('user_email'):
+                redis_client.set(username_alias_key(username), legacy['user_email'])
+                redis_client.hset(user_record_key(legacy['user_email']), 'username', username)
+                counts['aliased'] += 1
+        if delete_legacy and not dry_run:
+            redis_client.delete(key)
+            counts['legacy_deleted'] += 1
+    return counts
+
+
+def delete_stale_keys(dry_run=False):
+    counts = Counter()
+    for pattern in STALE_KEY_PATTERNS:
+        for key in redis_client.scan_iter(match=pattern, count=SCAN_COUNT):
+            if not dry_run:
+                redis_client.delete(key)
+            counts[pattern] += 1
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run', action='store_true', help='count what would be migrated without writing')
+    parser.add_argument('--delete-legacy', action='store_true', help='delete legacy keys once migrated')
+    args = parser.parse_args(argv)
+
+    users = migrate_users(args.dry_run, args.delete_legacy)
+    usernames = migrate_usernames(args.dry_run, args.delete_legacy)
+    stale = delete_stale_keys(args.dry_run) if args.delete_legacy else Counter()
+    logger.info(f"Migration finished - Users: {dict(users)}, {USERNAME_ALIAS_KEY}: {dict(usernames)}, "
+                f"Stale: {dict(stale)}")
+    print(f"users: {dict(users)}")
+    print(f"usernames: {dict(usernames)}")
+    if args.delete_legacy:
+        print(f"stale keys {'found' if args.dry_run else 'deleted'}: {dict(stale)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+from collections import deque
+
+
+class OrgHierarchy:
+    """
+    Organization hierarchy compiled into an ancestor-closure table.
+
+    An org may be listed under several parents (e.g. usgs under both usda and doi); all of them
+    are followed. Ancestors are ordered nearest first, in declaration order, and only groups in
+    `groups` are assigned or traversed. Lookups are single dict accesses.
+    """
+
+    def __init__(self, groups, parent_groups, proper_group_names):
+        self.groups = list(groups)
+        self.children = {parent: list(children) for parent, children in parent_groups.items()}
+        self.proper_group_names = dict(proper_group_names)
+
+        self.parents = {}
+        for parent, children in self.children.items():
+            for child in children:
+                self.parents.setdefault(child, []).append(parent)
+
+        check_for_cycles(self.parents)
+
+        assignable = set(self.groups)
+        nodes = set(self.parents) | set(self.children) | assignable
+        self.ancestors = {org: self._closure(org, assignable) for org in nodes}
+        self.group_titles = {
+            org: tuple(self.proper_group_names.get(group) for group in ancestors + [org])
+            for org, ancestors in self.ancestors.items()
+        }
+
+    def _closure(self, org, assignable):
+        ancestors = []
+        seen = {org}
+        pending = deque([org])
+        while pending:
+            for parent in self.parents.get(pending.popleft(), []):
+                if parent in seen or parent not in assignable:
+                    continue
+                seen.add(parent)
+                ancestors.append(parent)
+                pending.append(parent)
+        return ancestors
+
+    def get_parent_groups(self, org):
+        return self.ancestors.get(org, [])
+
+    def get_group_titles(self, org):
+        """Proper ArcGIS group titles for an org: its ancestors followed by the org itself."""
+        titles = self.group_titles.get(org)
+        return list(titles) if titles is not None else [self.proper_group_names.get(org)]
+
+
+def check_for_cycles(parents):
+    """Raise ValueError if following parent links ever returns to the starting org."""
+    visiting, done = set(), set()
+
+    def visit(org, path):
+        if org in done:
+            return
+        if org in visiting:
+            raise ValueError(f"Cycle in organization hierarchy: {' -> '.join(path + [org])}")
+        visiting.add(org)
+        for parent in parents.get(org, []):
+            visit(parent, path + [org])
+        visiting.discard(org)
+        done.add(org)
+
+    for org in list(parents):
+        visit(org, [])
+
+
+def compile_hierarchy(raw):
+    return OrgHierarchy(raw['groups'], raw['parent_groups'], raw['proper_group_names'])
@@ -0,0 +1,258 @@
+"""
+On-demand statistical profiling of individual requests.
+
+A request is profiled when it carries `X-Profile: <PROFILER_TOKEN>`, or when PROFILER_ENABLED is
+set and it falls in the PROFILER_SAMPLE_RATE fraction. A sampler OS thread records the request's
+stack every PROFILER_INTERVAL_MS, including while it waits on login.gov, ArcGIS or Redis, so the
+result is wall-clock time. Under gevent the request greenlet's own stack is sampled, so other
+requests sharing the worker do not show up in it.
+
+Profiles are written to PROFILER_DIR in speedscope format (https://www.speedscope.app) and can be
+listed and fetched, also as collapsed stacks for flamegraph.pl, from /admin/profiles with the same
+token. With no token and PROFILER_ENABLED unset no hooks are registered at all.
+"""
+import hmac
+import importlib
+import json
+import logging
+import os
+import random
+import sys
+import time
+import uuid
+from collections import Counter
+
+from flask import Blueprint, Response, abort, g, jsonify, request
+
+from config import PROFILER_DIR, PROFILER_ENABLED, PROFILER_INTERVAL_MS, PROFILER_KEEP, PROFILER_SAMPLE_RATE, \
+    PROFILER_TOKEN
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./profiler.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_SUFFIX = '.speedscope.json'
+MAX_STACK_DEPTH = 128
+
+profiler_blueprint = Blueprint('profiler', __name__)
+
+
+def _original(module, name):
+    """The unpatched stdlib function, so the sampler is a real thread even under gevent."""
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched(module):
+            return monkey.get_original(module, name)
+    except ImportError:
+        pass
+    return getattr(importlib.import_module(module), name)
+
+
+def _current_greenlet():
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            import greenlet
+            return greenlet.getcurrent()
+    except ImportError:
+        pass
+    return None
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _stack(frame):
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return tuple(reversed(names))
+
+
+class RequestSampler:
+    """Samples one thread's (or greenlet's) stack at a fixed interval from a background OS thread."""
+
+    def __init__(self, interval_ms=PROFILER_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.samples = Counter()
+        self.started = None
+        self.duration = 0.0
+        self._thread_id = _original('_thread', 'get_ident')()
+        self._greenlet = _current_greenlet()
+        self._sleep = _original('time', 'sleep')
+        self._running = False
+        self._done = _original('_thread', 'allocate_lock')()
+
+    def _target_frame(self):
+        # A suspended greenlet keeps its stack in gr_frame; a running one is the thread's current stack
+        if self._greenlet is not None and self._greenlet.gr_frame is not None:
+            return self._greenlet.gr_frame
+        return sys._current_frames().get(self._thread_id)
+
+    def _run(self):
+        try:
+            while self._running:
+                frame = self._target_frame()
+                if frame is not None:
+                    self.samples[_stack(frame)] += 1
+                self._sleep(self.interval)
+        finally:
+            self._done.release()
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._running = True
+        self._done.acquire()
+        _original('_thread', 'start_new_thread')(self._run, ())
+
+    def stop(self):
+        self._running = False
+        self._done.acquire()
+        self._done.release()
+        self.duration = time.perf_counter() - self.started
+
+    def to_speedscope(self, name):
+        frames, index, samples, weights = [], {}, [], []
+        interval_ms = self.interval * 1000
+        for stack, count in self.samples.items():
+            ids = []
+            for frame_name in stack:
+                if frame_name not in index:
+                    index[frame_name] = len(frames)
+                    frames.append({'name': frame_name})
+                ids.append(index[frame_name])
+            samples.append(ids)
+            weights.append(count * interval_ms)
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'exporter': 'auth-service profiler',
+            'shared': {'frames': frames},
+            'profiles': [{
+                'type': 'sampled', 'name': name, 'unit': 'milliseconds',
+                'startValue': 0, 'endValue': sum(weights), 'samples': samples, 'weights': weights,
+            }],
+        }
+
+
+def to_collapsed(profile):
+    """speedscope sampled profile -> 'a;b;c <milliseconds>' lines (flamegraph.pl input)."""
+    frames = [frame['name'] for frame in profile['shared']['frames']]
+    sampled = profile['profiles'][0]
+    lines = []
+    for ids, weight in zip(sampled['samples'], sampled['weights']):
+        lines.append(f"{';'.join(frames[i] for i in ids)} {round(weight)}")
+    return '\n'.join(lines) + '\n'
+
+
+def _token_matches(value):
+    return bool(PROFILER_TOKEN) and bool(value) and hmac.compare_digest(value, PROFILER_TOKEN)
+
+
+def should_profile():
+    if _token_matches(request.headers.get(PROFILE_HEADER)):
+        return True
+    return PROFILER_ENABLED and random.random() < PROFILER_SAMPLE_RATE
+
+
+def save_profile(sampler, response):
+    profile_id = f"{int(time.time() * 1000)}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    route = request.url_rule.rule if request.url_rule else request.path
+    name = f"{request.method} {route} {response.status_code} {sampler.duration * 1000:.0f}ms"
+    profile = sampler.to_speedscope(name)
+    profile['metadata'] = {
+        'id': profile_id, 'route': route, 'method': request.method, 'status': response.status_code,
+        'duration_ms': round(sampler.duration * 1000, 1), 'samples': sum(sampler.samples.values()),
+        'pid': os.getpid(), 'timestamp': time.time(),
+    }
+    os.makedirs(PROFILER_DIR, exist_ok=True)
+    with open(os.path.join(PROFILER_DIR, profile_id + PROFILE_SUFFIX), 'w') as f:
+        json.dump(profile, f)
+    prune_profiles()
+    logger.info(f"Saved profile {profile_id}: {name}")
+    return profile_id
+
+
+def _profile_paths():
+    if not os.path.isdir(PROFILER_DIR):
+        return []
+    paths = [os.path.join(PROFILER_DIR, name) for name in os.listdir(PROFILER_DIR) if name.endswith(PROFILE_SUFFIX)]
+    return sorted(paths, reverse=True)
+
+
+def prune_profiles(keep=PROFILER_KEEP):
+    for path in _profile_paths()[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def init_profiler(app):
+    """Register the profiling hooks and admin routes, unless profiling is entirely switched off."""
+    if not PROFILER_TOKEN and not PROFILER_ENABLED:
+        return
+
+    @app.before_request
+    def start_profile():
+        if should_profile():
+            g.profiler = RequestSampler()
+            g.profiler.start()
+
+    @app.after_request
+    def finish_profile(response):
+        sampler = g.pop('profiler', None)
+        if sampler is not None:
+            sampler.stop()
+            try:
+                response.headers['X-Profile-Id'] = save_profile(sampler, response)
+            except Exception as e:
+                logger.error(f"Error saving profile: {e}")
+        return response
+
+    @app.teardown_request
+    def stop_abandoned_profile(exc):
+        # after_request is skipped when a view raises; never leave a sampler thread running
+        sampler = g.pop('profiler', None)
+        if sampler is not None:
+            sampler.stop()
+
+    app.register_blueprint(profiler_blueprint)
+
+
+def _require_token():
+    if not _token_matches(request.headers.get(PROFILE_HEADER)):
+        abort(403)
+
+
+@profiler_blueprint.route('/admin/profiles')
+def list_profiles():
+    _require_token()
+    profiles = []
+    for path in _profile_paths():
+        try:
+            with open(path) as f:
+                profiles.append(json.load(f)['metadata'])
+        except (OSError, ValueError, KeyError):
+            continue
+    return jsonify(profiles)
+
+
+@profiler_blueprint.route('/admin/profiles/<profile_id>')
+def get_profile(profile_id):
+    _require_token()
+    path = os.path.join(PROFILER_DIR, os.path.basename(profile_id) + PROFILE_SUFFIX)
+    if not os.path.exists(path):
+        abort(404)
+    with open(path) as f:
+        profile = json.load(f)
+    if request.args.get('format') == 'collapsed':
+        return Response(to_collapsed(profile), mimetype='text/plain')
+    return jsonify(profile)
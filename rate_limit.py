@@ -0,0 +1,113 @@
+"""
+Distributed token-bucket admission control for the expensive login routes.
+
+/auth signs a JWT and /callback makes two login.gov calls plus several Redis writes, so both are
+limited per client IP and globally per route. The buckets live in Redis and are charged by one
+atomic script call (redis_helpers.take_rate_limit_tokens). A rejection costs that single round
+trip: it happens before the view runs and the session is not written. It returns 429 with
+Retry-After. The global bucket's remaining fraction is exported as rate_limit_headroom_ratio so
+limits can be kept inside the IdP quota. When Redis is unreachable requests are let through.
+"""
+import logging
+import math
+
+from flask import g, request
+
+from config import RATE_LIMIT_AUTH_GLOBAL, RATE_LIMIT_AUTH_PER_IP, RATE_LIMIT_CALLBACK_GLOBAL, \
+    RATE_LIMIT_CALLBACK_PER_IP, RATE_LIMIT_ENABLED, RATE_LIMIT_TRUSTED_PROXIES
+from metrics import RATE_LIMIT_DECISIONS, RATE_LIMIT_HEADROOM
+from redis_helpers import rate_limit_key, take_rate_limit_tokens
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./rate_limit.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+def parse_limit(value):
+    """'30/60' -> (capacity 30, refill 0.5 tokens/s); empty -> None."""
+    if not value:
+        return None
+    requests_allowed, seconds = value.split('/')
+    capacity = float(requests_allowed)
+    return capacity, capacity / float(seconds)
+
+
+# route -> (per-IP limit, global limit)
+ROUTE_LIMITS = {
+    '/auth': (parse_limit(RATE_LIMIT_AUTH_PER_IP), parse_limit(RATE_LIMIT_AUTH_GLOBAL)),
+    '/callback': (parse_limit(RATE_LIMIT_CALLBACK_PER_IP), parse_limit(RATE_LIMIT_CALLBACK_GLOBAL)),
+}
+
+
+def client_ip(trusted_proxies=RATE_LIMIT_TRUSTED_PROXIES):
+    """The address the outermost trusted proxy saw; earlier X-Forwarded-For entries are client-controlled."""
+    return forwarded_client_ip(request.headers.get('X-Forwarded-For', ''), request.remote_addr, trusted_proxies)
+
+
+def forwarded_client_ip(forwarded_for, remote_addr, trusted_proxies=RATE_LIMIT_TRUSTED_PROXIES):
+    forwarded = [hop.strip() for hop in forwarded_for.split(',') if hop.strip()]
+    if trusted_proxies and forwarded:
+        return forwarded[max(0, len(forwarded) - trusted_proxies)]
+    return remote_addr or 'unknown'
+
+
+def route_buckets(route, ip):
+    per_ip, global_limit = ROUTE_LIMITS[route]
+    buckets, scopes = [], []
+    if per_ip:
+        buckets.append((rate_limit_key(route.strip('/'), 'ip', ip), *per_ip))
+        scopes.append('ip')
+    if global_limit:
+        buckets.append((rate_limit_key(route.strip('/'), 'global'), *global_limit))
+        scopes.append('global')
+    return buckets, scopes
+
+
+def check_rate_limit():
+    """before_request hook: a 429 response when the route's buckets are empty, otherwise None."""
+    route = request.url_rule.rule if request.url_rule else None
+    if route not in ROUTE_LIMITS:
+        return None
+    ip = client_ip()
+    buckets, scopes = route_buckets(route, ip)
+    if not buckets:
+        return None
+    try:
+        result = take_rate_limit_tokens(buckets)
+    except Exception as e:
+        return rate_limiter_unavailable(route, e)
+    response = rate_limit_decision(route, ip, buckets, scopes, result)
+    if response:
+        g.rate_limited = True
+    return response
+
+
+def rate_limiter_unavailable(route, error):
+    # Fail open: an unavailable limiter must not take logins down with it
+    logger.error(f"Rate limiter unavailable, admitting request: {error}")
+    RATE_LIMIT_DECISIONS.labels(route, 'error').inc()
+    return None
+
+
+def rate_limit_decision(route, ip, buckets, scopes, result):
+    """None to admit the request, or the 429 response, for the result of take_rate_limit_tokens (sync or async)."""
+    allowed, retry_after_ms, tokens_left = result
+    for (_, capacity, _), scope, tokens in zip(buckets, scopes, tokens_left):
+        if scope == 'global':
+            RATE_LIMIT_HEADROOM.labels(route).set(max(0.0, tokens) / capacity)
+    if allowed:
+        RATE_LIMIT_DECISIONS.labels(route, 'allowed').inc()
+        return None
+
+    rejected_by = next((scope for scope, tokens in zip(scopes, tokens_left) if tokens < 1), scopes[-1])
+    RATE_LIMIT_DECISIONS.labels(route, f'rejected_{rejected_by}').inc()
+    logger.warning(f"Rate limited {route} for {ip} by the {rejected_by} bucket, retry in {retry_after_ms} ms")
+    return 'Too Many Requests', 429, {'Retry-After': str(max(1, math.ceil(retry_after_ms / 1000)))}
+
+
+def init_rate_limits(app):
+    if RATE_LIMIT_ENABLED:
+        app.before_request(check_rate_limit)
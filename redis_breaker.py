@@ -0,0 +1,177 @@
+"""
+Circuit breaker in front of every Redis command.
+
+After REDIS_BREAKER_FAILURES connection errors or timeouts within REDIS_BREAKER_WINDOW_SECONDS the
+breaker opens, and commands fail at once with RedisUnavailable instead of waiting out the socket
+timeout, so a failover does not pin every worker for seconds per request. After
+REDIS_BREAKER_COOLDOWN_SECONDS one command is let through as a probe: if Redis answers the
+breaker closes, otherwise it stays open for another cooldown. While it is not closed the service
+runs in degraded mode (see degraded_mode.py).
+
+This module sits below config.py, so it imports nothing from the app; observers subscribe with
+CircuitBreaker.add_listener.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+import redis
+import redis.asyncio
+from redis.client import Pipeline
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./redis_breaker.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class RedisUnavailable(redis.ConnectionError):
+    """Raised without touching the network while the breaker is open."""
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold, window_seconds, cooldown_seconds):
+        self.failure_threshold = failure_threshold
+        self.window_seconds = window_seconds
+        self.cooldown_seconds = cooldown_seconds
+        self.state = CLOSED
+        self.opened_at = None
+        self._failures = deque()
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    @property
+    def is_open(self):
+        """True while Redis is considered unavailable (open or probing)."""
+        return self.state != CLOSED
+
+    def add_listener(self, listener):
+        """listener(old_state, new_state) is called after every transition."""
+        self._listeners.append(listener)
+
+    def allow(self):
+        if self.state == CLOSED:
+            return True
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown_seconds:
+                self._transition(HALF_OPEN)
+                return True
+            return False
+
+    def record_success(self):
+        if self.state == CLOSED and not self._failures:
+            return
+        with self._lock:
+            self._failures.clear()
+            if self.state != CLOSED:
+                self._transition(CLOSED)
+
+    def record_failure(self):
+        now = time.monotonic()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.opened_at = now
+                self._transition(OPEN)
+                return
+            self._failures.append(now)
+            while self._failures and now - self._failures[0] > self.window_seconds:
+                self._failures.popleft()
+            if self.state == CLOSED and len(self._failures) >= self.failure_threshold:
+                self.opened_at = now
+                self._transition(OPEN)
+
+    def _transition(self, state):
+        old, self.state = self.state, state
+        logger.warning(f"Redis circuit breaker {old} -> {state}")
+        for listener in self._listeners:
+            try:
+                listener(old, state)
+            except Exception as e:
+                logger.error(f"Error in circuit breaker listener: {e}")
+
+
+def _guarded(breaker, command):
+    if not breaker.allow():
+        raise RedisUnavailable('Redis circuit breaker is open')
+    try:
+        result = command()
+    except (redis.ConnectionError, redis.TimeoutError):
+        breaker.record_failure()
+        raise
+    except redis.RedisError:
+        # Redis answered (e.g. a script or type error), so it is reachable
+        breaker.record_success()
+        raise
+    breaker.record_success()
+    return result
+
+
+class BreakerPipeline(Pipeline):
+
+    def __init__(self, breaker, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker
+
+    def execute(self, raise_on_error=True):
+        return _guarded(self.breaker, lambda: super(BreakerPipeline, self).execute(raise_on_error))
+
+
+class BreakerRedis(redis.Redis):
+    """redis.Redis whose commands, pipelines and scripts go through a CircuitBreaker."""
+
+    def __init__(self, *args, breaker, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker
+
+    def execute_command(self, *args, **options):
+        return _guarded(self.breaker, lambda: super(BreakerRedis, self).execute_command(*args, **options))
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return BreakerPipeline(self.breaker, self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+async def _guarded_async(breaker, command):
+    if not breaker.allow():
+        raise RedisUnavailable('Redis circuit breaker is open')
+    try:
+        result = await command()
+    except (redis.ConnectionError, redis.TimeoutError):
+        breaker.record_failure()
+        raise
+    except redis.RedisError:
+        breaker.record_success()
+        raise
+    breaker.record_success()
+    return result
+
+
+class BreakerAsyncPipeline(redis.asyncio.client.Pipeline):
+
+    def __init__(self, breaker, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker
+
+    async def execute(self, raise_on_error=True):
+        return await _guarded_async(self.breaker, lambda: super(BreakerAsyncPipeline, self).execute(raise_on_error))
+
+
+class BreakerAsyncRedis(redis.asyncio.Redis):
+    """redis.asyncio.Redis sharing the process's CircuitBreaker with the sync client (see async_routes.py)."""
+
+    def __init__(self, *args, breaker, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker
+
+    async def execute_command(self, *args, **options):
+        return await _guarded_async(self.breaker, lambda: super(BreakerAsyncRedis, self).execute_command(*args, **options))
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return BreakerAsyncPipeline(self.breaker, self.connection_pool, self.response_callbacks, transaction, shard_hint)
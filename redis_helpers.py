@@ -1,13 +1,21 @@
 import redis
+import hashlib
 import json
+import time
 import logging
 
 # Initialize Redis client
-from config import redis_client
+from config import redis_client, WEBHOOK_EVENT_TTL_SECONDS, USER_GROUP_ASSIGNMENT_TTL_SECONDS, \
+    USERINFO_COOKIE_TTL_SECONDS, OIDC_TRANSACTION_TTL_SECONDS, ARCGIS_PREFETCH_TTL_SECONDS, REFRESH_TOKEN_TTL_SECONDS, \
+    CHANGE_FEED_ENABLED, CHANGE_FEED_MAXLEN, CHANGE_FEED_READ_COUNT, USER_RECORD_DUAL_WRITE, ACCESS_TOKEN_TTL_SECONDS, \
+    AUTH_CODE_TTL_SECONDS
+from metrics import observe_redis
+from codec import encode, decode
+from degraded_mode import recent_cache, write_or_buffer
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler('./redis.log')
+file_handler = logging.FileHandler('./redis.log', delay=True)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 file_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
@@ -19,11 +27,46 @@ USERNAME_TO_EMAIL_KEY = 'username-to-email'
 USER_AUTH_ACCESS_KEY = 'user-auth-access'
 USER_EMAIL_TO_USER_GROUPS_KEY = 'user-email-to-user-groups'
 ARCGIS_USER_GROUPS = 'arcgis_groups'
+WEBHOOK_EVENT_KEY = 'webhook-event'
+USER_GROUP_ASSIGNMENT_KEY = 'user-group-assignment'
+BULK_ONBOARD_CHECKPOINT_KEY = 'bulk-onboard-checkpoint'
+LOGIN_USERINFO_KEY = 'login-userinfo'
+# Consolidated per-user record (user:<email>) and its username alias (user-username:<username>)
+USER_RECORD_KEY = 'user'
+USERNAME_ALIAS_KEY = 'user-username'
+USER_RECORD_VERSION = 1
+# Set on a record once the legacy keys have been folded into it; until then reads fill in missing fields
+USER_RECORD_MIGRATED_FIELD = 'migrated'
+LEGACY_RECORD_FIELDS = ('auth_access', 'user_groups')
+# Set of every token/code key issued to a user (user-tokens:<email>), purged on account deletion
+USER_TOKEN_INDEX_KEY = 'user-tokens'
+IDP_ACCESS_TOKEN_KEY = 'access_token'  # written by token_generation.handle_idp_token_response
+IDP_ACCESS_TOKEN_TTL_SECONDS = 3600
+# One hash per login (refresh-token:<family>) holding the digest of its current refresh token
+REFRESH_TOKEN_KEY = 'refresh-token'
+RATE_LIMIT_KEY = 'rate-limit'
+# One per login in flight (oidc-transaction:<state>), written by /auth and consumed by /callback
+OIDC_TRANSACTION_KEY = 'oidc-transaction'
+# Cross-pod single-flight leases (singleflight:<name>:<digest>) and their results (...:<owner>)
+SINGLEFLIGHT_KEY = 'singleflight'
+# Scheduler leader lease, per-job state hashes (scheduler-job:<name>) and run history lists
+SCHEDULER_LEADER_KEY = 'scheduler-leader'
+SCHEDULER_JOB_KEY = 'scheduler-job'
+SCHEDULER_RUNS_KEY = 'scheduler-runs'
+# Service-account portal token shared by all workers (see arcgis_api.get_token)
+ARCGIS_TOKEN_KEY = 'arcgis-token'
+# Login-time portal lookups for the webhook that follows (see arcgis_prefetch.py)
+ARCGIS_PREFETCH_KEY = 'arcgis-prefetch'
+ARCGIS_PREFETCH_USER_KEY = 'arcgis-prefetch-user'
+# Change-data feed stream and the offsets its consumers have committed (see change_feed.py)
+CHANGE_FEED_KEY = 'change-feed'
+CHANGE_FEED_OFFSETS_KEY = 'change-feed-offsets'
 
 # Helper function to set data in Redis 
 def redis_set(key, item):
     try:
-        redis_client.hmset(key, item)  # Use hash mapping for structured data
+        with observe_redis('hmset', key):
+            redis_client.hmset(key, item)  # Use hash mapping for structured data
         logger.info(f"Item inserted in Redis: {item}")
     except Exception as e:
         logger.error(f"Error writing to Redis: {e}")
@@ -31,7 +74,8 @@ def redis_set(key, item):
 # Helper function to get data from Redis
 def redis_get(key):
     try:
-        item = redis_client.hgetall(key)
+        with observe_redis('hgetall', key):
+            item = redis_client.hgetall(key)
         if item:
             logger.info(f"Item retrieved from Redis: {item}")
             return item
@@ -45,11 +89,22 @@ def redis_get(key):
 # Helper function to delete data from Redis
 def redis_delete(key):
     try:
-        redis_client.delete(key)
+        with observe_redis('delete', key):
+            redis_client.delete(key)
         logger.info(f"Item deleted from Redis: {key}")
     except Exception as e:
         logger.error(f"Error deleting from Redis: {e}")
 
+# Hash fields holding structured values; written with codec.encode and decoded on read
+ENCODED_FIELDS = ('userinfo', 'auth_access', 'user_groups')
+
+def decode_fields(item):
+    if item:
+        for field in ENCODED_FIELDS:
+            if field in item:
+                item[field] = decode(item[field])
+    return item
+
 # Functions
 
 def put_auth_code_to_access_token(auth_code, access_token):
@@ -63,61 +118,55 @@ def put_auth_code_to_access_token(auth_code, access_token):
 def put_access_token_to_userinfo(access_token, userinfo):
     item = {
         'access_token': access_token,
-        'userinfo': userinfo
+        'userinfo': encode(userinfo)
     }
     redis_set(f"{ACCESS_TOKEN_TO_USERINFO_KEY}:{access_token}", item)
     logger.info(f"put_access_token_to_userinfo - Access Token: {access_token}, User Info: {userinfo}")
 
-def put_username_to_email(username, email):
-    item = {
-        'username': username,
-        'user_email': email
-    }
-    redis_set(f"{USERNAME_TO_EMAIL_KEY}:{username}", item)
-    logger.info(f"put_username_to_email - Username: {username}, Email: {email}")
-
-def put_user_auth_access(email, auth_access):
-    item = {
-        'user_email': email,
-        'auth_access': json.dumps(auth_access)  # Store as JSON string
-    }
-    redis_set(f"{USER_AUTH_ACCESS_KEY}:{email}", item)
-    logger.info(f"put_user_auth_access - Email: {email}, Auth Access: {auth_access}")
-
-def put_email_to_user_groups(email, user_groups):
-    item = {
-        'user_email': email,
-        'user_groups': json.dumps(user_groups)  # Store as JSON string
-    }
-    redis_set(f"{USER_EMAIL_TO_USER_GROUPS_KEY}:{email}", item)
-    logger.info(f"put_email_to_user_groups - Email: {email}, User Groups: {user_groups}")
-
 # Functions to get data from Redis
 
 def get_auth_code_to_access_token(auth_code):
-    response = redis_get(f"{AUTH_CODE_TO_ACCESS_TOKEN_KEY}:{auth_code}")
+    key = f"{AUTH_CODE_TO_ACCESS_TOKEN_KEY}:{auth_code}"
+    response = cached_read(key, redis_get(key))
     logger.info(f"get_auth_code_to_access_token - Response: {response}")
     return response
 
-def get_access_token_to_userinfo(access_token):
-    response = redis_get(f"{ACCESS_TOKEN_TO_USERINFO_KEY}:{access_token}")
-    logger.info(f"get_access_token_to_userinfo - Response: {response}")
+def redeem_auth_code(auth_code):
+    """
+    The code's record, deleted in the same transaction so a code (and the refresh token it carries)
+    is handed out once. None if the code is unknown, expired or already redeemed.
+    """
+    key = f"{AUTH_CODE_TO_ACCESS_TOKEN_KEY}:{auth_code}"
+    try:
+        with observe_redis('multi', AUTH_CODE_TO_ACCESS_TOKEN_KEY):
+            pipe = redis_client.pipeline(transaction=True)
+            pipe.hgetall(key)
+            pipe.delete(key)
+            item, _ = pipe.execute()
+    except Exception as e:
+        logger.error(f"Error reading from Redis: {e}")
+        item = None
+    response = redeemed(key, item)
+    logger.info(f"redeem_auth_code - Key: {key}, Found: {response is not None}")
     return response
 
-def get_username_to_email(username):
-    response = redis_get(f"{USERNAME_TO_EMAIL_KEY}:{username}")
-    logger.info(f"get_username_to_email - Response: {response}")
+def redeemed(key, item):
+    """A redeemed code's record, falling back to this worker's copy while degraded; the copy is single-use too."""
+    response = cached_read(key, item or None)
+    recent_cache.discard(key)
     return response
 
-def get_user_auth_access(email):
-    response = redis_get(f"{USER_AUTH_ACCESS_KEY}:{email}")
-    logger.info(f"get_user_auth_access - Response: {response}")
+def get_access_token_to_userinfo(access_token):
+    key = f"{ACCESS_TOKEN_TO_USERINFO_KEY}:{access_token}"
+    response = cached_read(key, decode_fields(redis_get(key)))
+    logger.info(f"get_access_token_to_userinfo - Response: {response}")
     return response
 
-def get_email_to_user_groups(email):
-    response = redis_get(f"{USER_EMAIL_TO_USER_GROUPS_KEY}:{email}")
-    logger.info(f"get_email_to_user_groups - Response: {response}")
-    return response
+def cached_read(key, response):
+    """Answer a failed login read from this worker's recent login writes (see degraded_mode.py)."""
+    if response is not None:
+        return response
+    return recent_cache.fallback(key)
 
 def get_arcgis_groups():
     response = redis_get(ARCGIS_USER_GROUPS)
@@ -134,18 +183,888 @@ def delete_access_token_to_userinfo(access_token):
     redis_delete(f"{ACCESS_TOKEN_TO_USERINFO_KEY}:{access_token}")
     logger.info(f"delete_access_token_to_userinfo - Access Token: {access_token}")
 
+# Change-data feed. Changes to user state and group assignments are appended to a capped stream,
+# on the same pipeline as the write they describe. Entries are flat strings so any Redis client can
+# read them; the fields in CHANGE_JSON_FIELDS hold plain JSON.
+
+CHANGE_JSON_FIELDS = ('fields', 'auth_access', 'user_groups', 'groups', 'usernames')
+
+def change_entry(op, **fields):
+    entry = {'op': op}
+    for name, value in fields.items():
+        if value is not None:
+            entry[name] = json.dumps(value, separators=(',', ':')) if name in CHANGE_JSON_FIELDS else str(value)
+    return entry
+
+def queue_change(pipe, op, **fields):
+    """Queue the change-feed entry for a write queued on `pipe` (sync or redis.asyncio)."""
+    if CHANGE_FEED_ENABLED:
+        pipe.xadd(CHANGE_FEED_KEY, change_entry(op, **fields), maxlen=CHANGE_FEED_MAXLEN, approximate=True)
+
+def record_change(op, **fields):
+    """Append a change that has no Redis write of its own, e.g. users added to a portal group."""
+    if not CHANGE_FEED_ENABLED:
+        return
+    try:
+        with observe_redis('xadd', CHANGE_FEED_KEY):
+            redis_client.xadd(CHANGE_FEED_KEY, change_entry(op, **fields), maxlen=CHANGE_FEED_MAXLEN, approximate=True)
+    except Exception as e:
+        logger.error(f"Error writing to Redis: {e}")
+
+def decode_change(change_id, entry):
+    change = {'id': change_id}
+    change.update({name: json.loads(value) if name in CHANGE_JSON_FIELDS else value for name, value in entry.items()})
+    return change
+
+def read_change_feed(after=None, count=CHANGE_FEED_READ_COUNT):
+    """Up to `count` changes after the id `after` (the oldest kept when None), oldest first. Raises on Redis errors."""
+    with observe_redis('xrange', CHANGE_FEED_KEY):
+        entries = redis_client.xrange(CHANGE_FEED_KEY, min=f"({after}" if after else '-', count=count)
+    return [decode_change(change_id, entry) for change_id, entry in entries]
+
+def get_change_feed_bounds():
+    """(length, oldest id, newest id) of the feed in one round trip; the ids are None while it is empty."""
+    with observe_redis('pipeline', CHANGE_FEED_KEY):
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.xlen(CHANGE_FEED_KEY)
+        pipe.xrange(CHANGE_FEED_KEY, count=1)
+        pipe.xrevrange(CHANGE_FEED_KEY, count=1)
+        length, oldest, newest = pipe.execute()
+    return length, oldest[0][0] if oldest else None, newest[0][0] if newest else None
+
+def get_next_change_ids(offsets):
+    """For each offset, the id of the first change after it, or None when there is none; one round trip."""
+    with observe_redis('pipeline', CHANGE_FEED_KEY):
+        pipe = redis_client.pipeline(transaction=False)
+        for offset in offsets:
+            pipe.xrange(CHANGE_FEED_KEY, min=f"({offset}", count=1)
+        return [entries[0][0] if entries else None for entries in pipe.execute()]
+
+def get_change_feed_offsets():
+    """consumer -> id of the last change it committed."""
+    with observe_redis('hgetall', CHANGE_FEED_OFFSETS_KEY):
+        return redis_client.hgetall(CHANGE_FEED_OFFSETS_KEY)
+
+def get_change_feed_offset(consumer):
+    with observe_redis('hget', CHANGE_FEED_OFFSETS_KEY):
+        return redis_client.hget(CHANGE_FEED_OFFSETS_KEY, consumer)
+
+def put_change_feed_offset(consumer, change_id):
+    with observe_redis('hset', CHANGE_FEED_OFFSETS_KEY):
+        redis_client.hset(CHANGE_FEED_OFFSETS_KEY, consumer, change_id)
+    logger.info(f"put_change_feed_offset - Consumer: {consumer}, Offset: {change_id}")
+
+# Per-user record. One hash per user replaces the username-to-email, user-auth-access,
+# user-email-to-user-groups, {email}:userinfo:{token} and {email}:has_selected_group keys.
+# Reads fall back to the legacy keys and backfill whichever fields the record lacks (see
+# migrate_user_records.py); while USER_RECORD_DUAL_WRITE is on, writes also update the legacy keys
+# so pods that only read those still see them.
+
+def user_record_key(email):
+    return f"{USER_RECORD_KEY}:{email}"
+
+def username_alias_key(username):
+    return f"{USERNAME_ALIAS_KEY}:{username}"
+
+def legacy_user_keys(email=None, username=None):
+    keys = []
+    if email:
+        keys += [f"{USER_AUTH_ACCESS_KEY}:{email}", f"{USER_EMAIL_TO_USER_GROUPS_KEY}:{email}",
+                 f"{email}:has_selected_group"]
+    if username:
+        keys.append(f"{USERNAME_TO_EMAIL_KEY}:{username}")
+    return keys
+
+def user_record_item(email, **fields):
+    """The hash fields update_user_record writes; auth_access, user_groups and userinfo are codec-encoded."""
+    item = {name: encode(value) if name in ENCODED_FIELDS else value for name, value in fields.items()}
+    item.update({'version': USER_RECORD_VERSION, 'email': email})
+    return item
+
+def update_user_record(email, **fields):
+    """Set fields on user:<email> with a single HSET; auth_access, user_groups and userinfo are codec-encoded."""
+    _write_user_record(email, fields, 'user.update')
+
+def queue_user_update(pipe, email, fields, op='user.update'):
+    """Queue the HSET of `fields` and its change-feed entry, which names the fields and carries auth_access and user_groups."""
+    pipe.hset(user_record_key(email), mapping=user_record_item(email, **fields))
+    if USER_RECORD_DUAL_WRITE:
+        queue_legacy_user_update(pipe, email, fields)
+    queue_change(pipe, op, email=email, fields=sorted(fields),
+                 **{name: fields[name] for name in ('auth_access', 'user_groups') if name in fields})
+
+def queue_legacy_user_update(pipe, email, fields):
+    """Queue the legacy user-auth-access / user-email-to-user-groups writes for `fields`, in their untagged JSON."""
+    if 'auth_access' in fields:
+        pipe.hset(f"{USER_AUTH_ACCESS_KEY}:{email}",
+                  mapping={'user_email': email, 'auth_access': json.dumps(fields['auth_access'])})
+    if 'user_groups' in fields:
+        pipe.hset(f"{USER_EMAIL_TO_USER_GROUPS_KEY}:{email}",
+                  mapping={'user_email': email, 'user_groups': json.dumps(fields['user_groups'])})
+
+def _write_user_record(email, fields, op):
+    try:
+        with observe_redis('multi', USER_RECORD_KEY):
+            pipe = redis_client.pipeline(transaction=True)
+            queue_user_update(pipe, email, fields, op)
+            pipe.execute()
+        logger.info(f"update_user_record - Email: {email}, Fields: {sorted(fields)}")
+    except Exception as e:
+        logger.error(f"Error writing to Redis: {e}")
+
+def get_user_record(email):
+    """Return the decoded user record, backfilling it from the legacy keys on first read. None if unknown."""
+    record = decode_fields(redis_get(user_record_key(email)))
+    if needs_migration(record):
+        record = migrate_user_record(email, record)
+    return record
+
+def needs_migration(record):
+    """
+    True for a record that may still lack legacy fields: none at all, or one written by a partial
+    writer (the username alias, a single-field update) before the user was migrated.
+    """
+    return record is None or (USER_RECORD_MIGRATED_FIELD not in record
+                              and any(field not in record for field in LEGACY_RECORD_FIELDS))
+
+def migrate_user_record(email, record=None):
+    """
+    Fill the fields user:<email> (currently `record`) lacks from the legacy per-user keys and mark it
+    migrated. Returns the merged record, or None if there was neither a record nor legacy keys.
+    """
+    auth_item = decode_fields(redis_get(f"{USER_AUTH_ACCESS_KEY}:{email}"))
+    groups_item = decode_fields(redis_get(f"{USER_EMAIL_TO_USER_GROUPS_KEY}:{email}"))
+    if record is None and auth_item is None and groups_item is None:
+        return None
+
+    fields = {name: value for name, value in legacy_record_fields(auth_item, groups_item).items()
+              if record is None or name not in record}
+    try:
+        with observe_redis('multi', USER_RECORD_KEY):
+            pipe = redis_client.pipeline(transaction=True)
+            queue_user_migration(pipe, email, fields)
+            pipe.execute()
+        logger.info(f"migrate_user_record - Email: {email}, Fields: {sorted(fields)}")
+    except Exception as e:
+        logger.error(f"Error writing to Redis: {e}")
+    return {'version': str(USER_RECORD_VERSION), 'email': email, **(record or {}), **fields,
+            USER_RECORD_MIGRATED_FIELD: '1'}
+
+def queue_user_migration(pipe, email, fields):
+    """
+    Queue the backfill of `fields` into user:<email>. HSETNX leaves any field a concurrent write set
+    since the record was read, so a stale legacy value never overwrites a newer one.
+    """
+    key = user_record_key(email)
+    for name, value in user_record_item(email, **fields).items():
+        pipe.hsetnx(key, name, value)
+    pipe.hset(key, USER_RECORD_MIGRATED_FIELD, 1)
+    queue_change(pipe, 'user.migrate', email=email, fields=sorted(fields),
+                 **{name: fields[name] for name in LEGACY_RECORD_FIELDS if name in fields})
+
+def legacy_record_fields(auth_item, groups_item):
+    """User record fields from decoded legacy user-auth-access and user-email-to-user-groups hashes."""
+    fields = {}
+    if auth_item is not None:
+        auth_access = dict(auth_item.get('auth_access') or {})
+        # Fields written one by one by the old update_auth_access() sit next to the JSON blob
+        auth_access.update({k: v for k, v in auth_item.items() if k not in ('user_email', 'auth_access')})
+        fields['auth_access'] = auth_access
+    if groups_item is not None and 'user_groups' in groups_item:
+        fields['user_groups'] = groups_item['user_groups']
+    return fields
+
+# Bulk reads (see user_state.py). One pipelined round trip per key family for a whole batch; unlike
+# the per-user getters these raise on Redis errors, so a bulk answer is never silently incomplete.
+
+def get_user_records_bulk(emails):
+    """
+    Decoded user records for `emails`, None where unknown. Fields of users not migrated yet are read
+    from the legacy keys (their record then has 'legacy': True); nothing is written.
+    """
+    with observe_redis('pipeline', USER_RECORD_KEY):
+        pipe = redis_client.pipeline(transaction=False)
+        for email in emails:
+            pipe.hgetall(user_record_key(email))
+        records = [decode_fields(item) or None for item in pipe.execute()]
+
+    missing = [i for i, record in enumerate(records) if needs_migration(record)]
+    if missing:
+        with observe_redis('pipeline', USER_AUTH_ACCESS_KEY):
+            pipe = redis_client.pipeline(transaction=False)
+            for i in missing:
+                pipe.hgetall(f"{USER_AUTH_ACCESS_KEY}:{emails[i]}")
+                pipe.hgetall(f"{USER_EMAIL_TO_USER_GROUPS_KEY}:{emails[i]}")
+            items = pipe.execute()
+        for n, i in enumerate(missing):
+            auth_item, groups_item = (decode_fields(item) or None for item in items[2 * n:2 * n + 2])
+            if auth_item is not None or groups_item is not None:
+                legacy = legacy_record_fields(auth_item, groups_item)
+                records[i] = {'email': emails[i], **legacy, **(records[i] or {}), 'legacy': True}
+    return records
+
+def get_username_emails_bulk(usernames):
+    """Emails for portal usernames, None where unknown, with the legacy username-to-email fallback."""
+    with observe_redis('pipeline', USERNAME_ALIAS_KEY):
+        pipe = redis_client.pipeline(transaction=False)
+        for username in usernames:
+            pipe.get(username_alias_key(username))
+        emails = pipe.execute()
+
+    missing = [i for i, email in enumerate(emails) if email is None]
+    if missing:
+        with observe_redis('pipeline', USERNAME_TO_EMAIL_KEY):
+            pipe = redis_client.pipeline(transaction=False)
+            for i in missing:
+                pipe.hget(f"{USERNAME_TO_EMAIL_KEY}:{usernames[i]}", 'user_email')
+            for i, email in zip(missing, pipe.execute()):
+                emails[i] = email
+    return emails
+
+def delete_user_record(email, username=None):
+    """
+    Delete the user's record, username alias, legacy keys and every indexed token with one DEL.
+    The token index is WATCHed, so a login indexing a token between the read and the DEL makes the
+    transaction retry rather than leave that token behind.
+    """
+    index_key = user_token_index_key(email)
+    keys = [user_record_key(email), index_key] + legacy_user_keys(email, username)
+    if username:
+        keys.append(username_alias_key(username))
+    revoked = []
+
+    def delete(pipe):
+        token_keys = pipe.smembers(index_key)
+        pipe.multi()
+        pipe.delete(*keys, *token_keys)
+        queue_change(pipe, 'user.delete', email=email, username=username)
+        revoked[:] = token_keys
+
+    try:
+        with observe_redis('multi', USER_RECORD_KEY):
+            redis_client.transaction(delete, index_key)
+        # Deleted tokens must not keep answering from this worker's degraded-mode cache
+        recent_cache.discard(*revoked)
+        logger.info(f"delete_user_record - Email: {email}, Username: {username}, Tokens revoked: {len(revoked)}")
+    except Exception as e:
+        logger.error(f"Error deleting from Redis: {e}")
+
+# Per-user token index. Keys are added in the same MULTI that creates them, so a token can
+# never exist without being revocable, and the index lives as long as its longest-lived member.
+
+def user_token_index_key(email):
+    return f"{USER_TOKEN_INDEX_KEY}:{email}"
+
+# Extends a key's TTL to ARGV[1] seconds but never shortens it, so a short-lived member never cuts
+# a longer one short. Same as EXPIRE NX plus EXPIRE GT, which need Redis 7.
+EXTEND_TTL_SCRIPT = """
+local ttl = redis.call('TTL', KEYS[1])
+if ttl < tonumber(ARGV[1]) then
+    return redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+def queue_index_keys(pipe, email, keys, ttl):
+    """Queue indexing `keys`, which expire within `ttl` seconds, under the user (sync or redis.asyncio pipe)."""
+    index_key = user_token_index_key(email)
+    pipe.sadd(index_key, *keys)
+    # Plain EVAL: a registered script would be bound to one client, and this runs in sync and async pipes
+    pipe.eval(EXTEND_TTL_SCRIPT, 1, index_key, ttl)
+
+def put_login_tokens(email, auth_code, access_token, userinfo, traceparent=None, refresh_token=None):
+    """
+    Store auth code -> access token and access token -> userinfo, indexed under the user, atomically.
+    With a refresh token, its family record is written in the same transaction and the token is
+    kept on the code record, which lives AUTH_CODE_TTL_SECONDS, so /token can return it once.
+    """
+    if not email:
+        raise ValueError("put_login_tokens needs the user's email to index the tokens")
+    args = login_token_items(email, auth_code, access_token, userinfo, traceparent, refresh_token)
+    write_or_buffer(f"put_login_tokens {email}", _write_login_tokens, *args)
+
+def login_token_items(email, auth_code, access_token, userinfo, traceparent=None, refresh_token=None):
+    """Arguments of queue_login_tokens for one login; the code and token are also kept in the recent cache."""
+    code_key = f"{AUTH_CODE_TO_ACCESS_TOKEN_KEY}:{auth_code}"
+    token_key = f"{ACCESS_TOKEN_TO_USERINFO_KEY}:{access_token}"
+    code_item = {'auth_code': auth_code, 'access_token': access_token}
+    if traceparent:
+        # Lets the server-side /token call join the browser's login trace
+        code_item['traceparent'] = traceparent
+    family_key = family_item = None
+    if refresh_token:
+        family, secret = split_refresh_token(refresh_token)
+        code_item['refresh_token'] = refresh_token
+        family_key = refresh_token_key(family)
+        family_item = {'current': refresh_token_digest(secret), 'email': email, 'userinfo': encode(userinfo),
+                       'generation': 0, 'created': int(time.time())}
+    recent_cache.put(code_key, code_item)
+    recent_cache.put(token_key, {'access_token': access_token, 'userinfo': userinfo})
+    return (email, code_key, code_item, token_key, {'access_token': access_token, 'userinfo': encode(userinfo)},
+            family_key, family_item)
+
+def queue_login_tokens(pipe, email, code_key, code_item, token_key, token_item, family_key=None, family_item=None):
+    """Queue the login token writes on `pipe` (sync or redis.asyncio)."""
+    pipe.hset(code_key, mapping=code_item)
+    pipe.expire(code_key, AUTH_CODE_TTL_SECONDS)
+    pipe.hset(token_key, mapping=token_item)
+    pipe.expire(token_key, ACCESS_TOKEN_TTL_SECONDS)
+    ttl = max(AUTH_CODE_TTL_SECONDS, ACCESS_TOKEN_TTL_SECONDS)
+    if family_key:
+        pipe.hset(family_key, mapping=family_item)
+        pipe.expire(family_key, REFRESH_TOKEN_TTL_SECONDS)
+        queue_index_keys(pipe, email, [code_key, token_key, family_key], max(ttl, REFRESH_TOKEN_TTL_SECONDS))
+    else:
+        queue_index_keys(pipe, email, [code_key, token_key], ttl)
+
+def _write_login_tokens(email, code_key, code_item, token_key, token_item, family_key=None, family_item=None):
+    with observe_redis('multi', USER_TOKEN_INDEX_KEY):
+        pipe = redis_client.pipeline(transaction=True)
+        queue_login_tokens(pipe, email, code_key, code_item, token_key, token_item, family_key, family_item)
+        pipe.execute()
+    logger.info(f"put_login_tokens - Email: {email}, Code Key: {code_key}")
+
+def index_user_keys(email, *keys, ttl=IDP_ACCESS_TOKEN_TTL_SECONDS):
+    """Index keys written before the user's email was known (e.g. the login.gov token response)."""
+    try:
+        with observe_redis('multi', USER_TOKEN_INDEX_KEY):
+            pipe = redis_client.pipeline(transaction=True)
+            queue_index_keys(pipe, email, keys, ttl)
+            pipe.execute()
+    except Exception as e:
+        logger.error(f"Error writing to Redis: {e}")
+
+def get_user_token_keys(email):
+    try:
+        with observe_redis('smembers', USER_TOKEN_INDEX_KEY):
+            return redis_client.smembers(user_token_index_key(email))
+    except Exception as e:
+        logger.error(f"Error reading from Redis: {e}")
+        return set()
+
+# Typed accessors over the user record
+
+def put_username_to_email(username, email):
+    try:
+        with observe_redis('pipeline', USERNAME_ALIAS_KEY):
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.set(username_alias_key(username), email)
+            pipe.hset(user_record_key(email), mapping={'version': USER_RECORD_VERSION, 'email': email,
+                                                       'username': username})
+            queue_change(pipe, 'user.username', email=email, username=username)
+            pipe.execute()
+        logger.info(f"put_username_to_email - Username: {username}, Email: {email}")
+    except Exception as e:
+        logger.error(f"Error writing to Redis: {e}")
+
+def get_username_to_email(username):
+    try:
+        with observe_redis('get', USERNAME_ALIAS_KEY):
+            email = redis_client.get(username_alias_key(username))
+    except Exception as e:
+        logger.error(f"Error reading from Redis: {e}")
+        email = None
+    if email is None:
+        legacy = redis_get(f"{USERNAME_TO_EMAIL_KEY}:{username}")
+        if not legacy:
+            return None
+        email = legacy['user_email']
+        put_username_to_email(username, email)
+    response = {'username': username, 'user_email': email}
+    logger.info(f"get_username_to_email - Response: {response}")
+    return response
+
+def put_user_auth_access(email, auth_access):
+    update_user_record(email, auth_access=auth_access)
+    logger.info(f"put_user_auth_access - Email: {email}, Auth Access: {auth_access}")
+
+def get_user_auth_access(email, record=None):
+    record = record if record is not None else get_user_record(email)
+    response = {'user_email': email, 'auth_access': record['auth_access']} if record and 'auth_access' in record else None
+    logger.info(f"get_user_auth_access - Response: {response}")
+    return response
+
+def put_email_to_user_groups(email, user_groups):
+    update_user_record(email, user_groups=user_groups)
+    logger.info(f"put_email_to_user_groups - Email: {email}, User Groups: {user_groups}")
+
+def get_email_to_user_groups(email, record=None):
+    record = record if record is not None else get_user_record(email)
+    response = {'user_email': email, 'user_groups': record['user_groups']} if record and 'user_groups' in record else None
+    logger.info(f"get_email_to_user_groups - Response: {response}")
+    return response
+
 def delete_username_to_email(username):
-    redis_delete(f"{USERNAME_TO_EMAIL_KEY}:{username}")
-    logger.info(f"delete_username_to_email - Username: {username}")
+    try:
+        with observe_redis('pipeline', USERNAME_ALIAS_KEY):
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.delete(username_alias_key(username), *legacy_user_keys(username=username))
+            queue_change(pipe, 'username.delete', username=username)
+            pipe.execute()
+        logger.info(f"delete_username_to_email - Username: {username}")
+    except Exception as e:
+        logger.error(f"Error deleting from Redis: {e}")
 
 def delete_user_auth_access(email):
-    redis_delete(f"{USER_AUTH_ACCESS_KEY}:{email}")
+    _delete_user_record_field(email, 'auth_access', f"{USER_AUTH_ACCESS_KEY}:{email}")
     logger.info(f"delete_user_auth_access - Email: {email}")
 
 def delete_email_to_user_groups(email):
-    redis_delete(f"{USER_EMAIL_TO_USER_GROUPS_KEY}:{email}")
+    _delete_user_record_field(email, 'user_groups', f"{USER_EMAIL_TO_USER_GROUPS_KEY}:{email}")
     logger.info(f"delete_email_to_user_groups - Email: {email}")
 
+def _delete_user_record_field(email, field, legacy_key):
+    try:
+        with observe_redis('pipeline', USER_RECORD_KEY):
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.hdel(user_record_key(email), field)
+            pipe.delete(legacy_key)
+            queue_change(pipe, 'user.delete_field', email=email, fields=[field])
+            pipe.execute()
+    except Exception as e:
+        logger.error(f"Error deleting from Redis: {e}")
+
+# Functions for webhook idempotency
+
+def put_webhook_event_if_absent(event_key, ttl=WEBHOOK_EVENT_TTL_SECONDS):
+    """Atomically claim a webhook event (SET NX). Returns False if it was already claimed."""
+    try:
+        with observe_redis('set', WEBHOOK_EVENT_KEY):
+            claimed = redis_client.set(f"{WEBHOOK_EVENT_KEY}:{event_key}", 1, nx=True, ex=ttl)
+        logger.info(f"put_webhook_event_if_absent - Event: {event_key}, Claimed: {bool(claimed)}")
+        return bool(claimed)
+    except Exception as e:
+        # Fail open: processing an event twice is safer than dropping it
+        logger.error(f"Error claiming webhook event in Redis: {e}")
+        return True
+
+def delete_webhook_event(event_key):
+    redis_delete(f"{WEBHOOK_EVENT_KEY}:{event_key}")
+    logger.info(f"delete_webhook_event - Event: {event_key}")
+
+def put_user_group_assignment(username, group_titles, ttl=USER_GROUP_ASSIGNMENT_TTL_SECONDS):
+    try:
+        with observe_redis('pipeline', USER_GROUP_ASSIGNMENT_KEY):
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.setex(f"{USER_GROUP_ASSIGNMENT_KEY}:{username}", ttl, encode(sorted(group_titles)))
+            queue_change(pipe, 'group_assignment.put', username=username, groups=sorted(group_titles))
+            pipe.execute()
+        logger.info(f"put_user_group_assignment - Username: {username}, Groups: {group_titles}")
+    except Exception as e:
+        logger.error(f"Error writing to Redis: {e}")
+
+def get_user_group_assignment(username):
+    try:
+        with observe_redis('get', USER_GROUP_ASSIGNMENT_KEY):
+            response = redis_client.get(f"{USER_GROUP_ASSIGNMENT_KEY}:{username}")
+        logger.info(f"get_user_group_assignment - Response: {response}")
+        return decode(response)
+    except Exception as e:
+        logger.error(f"Error reading from Redis: {e}")
+        return None
+
+def delete_user_group_assignment(username):
+    try:
+        with observe_redis('pipeline', USER_GROUP_ASSIGNMENT_KEY):
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.delete(f"{USER_GROUP_ASSIGNMENT_KEY}:{username}")
+            queue_change(pipe, 'group_assignment.delete', username=username)
+            pipe.execute()
+        logger.info(f"delete_user_group_assignment - Username: {username}")
+    except Exception as e:
+        logger.error(f"Error deleting from Redis: {e}")
+
+# Functions for the login userinfo referenced by the userinfo cookie
+
+def put_login_userinfo(handle, userinfo, ttl=USERINFO_COOKIE_TTL_SECONDS):
+    key = f"{LOGIN_USERINFO_KEY}:{handle}"
+    recent_cache.put(key, userinfo)
+    write_or_buffer(f"put_login_userinfo {handle}", _write_login_userinfo, key, userinfo, ttl)
+
+def queue_login_userinfo(pipe, key, userinfo, ttl=USERINFO_COOKIE_TTL_SECONDS):
+    pipe.setex(key, ttl, encode(userinfo))
+    if userinfo.get('email'):
+        queue_index_keys(pipe, userinfo['email'], [key], ttl)
+
+def _write_login_userinfo(key, userinfo, ttl):
+    with observe_redis('multi', LOGIN_USERINFO_KEY):
+        pipe = redis_client.pipeline(transaction=True)
+        queue_login_userinfo(pipe, key, userinfo, ttl)
+        pipe.execute()
+    logger.info(f"put_login_userinfo - Key: {key}")
+
+def get_login_userinfo(handle):
+    key = f"{LOGIN_USERINFO_KEY}:{handle}"
+    try:
+        with observe_redis('get', LOGIN_USERINFO_KEY):
+            response = redis_client.get(key)
+        logger.info(f"get_login_userinfo - Handle: {handle}, Found: {response is not None}")
+        return cached_read(key, decode(response))
+    except Exception as e:
+        logger.error(f"Error reading from Redis: {e}")
+        return recent_cache.fallback(key)
+
+# Functions for the login-time ArcGIS prefetch
+
+def put_arcgis_prefetch(email, prefetch, ttl=ARCGIS_PREFETCH_TTL_SECONDS):
+    """Store the prefetch under the email, and the portal user (if found) under its username."""
+    try:
+        with observe_redis('pipeline', ARCGIS_PREFETCH_KEY):
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.setex(f"{ARCGIS_PREFETCH_KEY}:{email}", ttl, encode(prefetch))
+            user = prefetch.get('user')
+            if user and user.get('username'):
+                pipe.setex(f"{ARCGIS_PREFETCH_USER_KEY}:{user['username']}", ttl, encode(user))
+            pipe.execute()
+        logger.info(f"put_arcgis_prefetch - Email: {email}, Groups: {sorted(prefetch.get('groups') or {})}")
+    except Exception as e:
+        logger.error(f"Error writing to Redis: {e}")
+
+def get_arcgis_prefetch(email):
+    try:
+        with observe_redis('get', ARCGIS_PREFETCH_KEY):
+            return decode(redis_client.get(f"{ARCGIS_PREFETCH_KEY}:{email}"))
+    except Exception as e:
+        logger.error(f"Error reading from Redis: {e}")
+        return None
+
+def get_prefetched_arcgis_user(username):
+    try:
+        with observe_redis('get', ARCGIS_PREFETCH_USER_KEY):
+            return decode(redis_client.get(f"{ARCGIS_PREFETCH_USER_KEY}:{username}"))
+    except Exception as e:
+        logger.error(f"Error reading from Redis: {e}")
+        return None
+
+def put_oidc_transaction(state, transaction, ttl=OIDC_TRANSACTION_TTL_SECONDS):
+    """Returns False if the transaction could not be stored, in which case /callback could not accept the login."""
+    try:
+        with observe_redis('setex', OIDC_TRANSACTION_KEY):
+            redis_client.setex(f"{OIDC_TRANSACTION_KEY}:{state}", ttl, encode(transaction))
+        logger.info(f"put_oidc_transaction - State: {state}")
+        return True
+    except Exception as e:
+        logger.error(f"Error writing to Redis: {e}")
+        return False
+
+def pop_oidc_transaction(state):
+    """Return and delete the transaction for `state` in one command, so each state is accepted once."""
+    try:
+        with observe_redis('getdel', OIDC_TRANSACTION_KEY):
+            response = redis_client.getdel(f"{OIDC_TRANSACTION_KEY}:{state}")
+        logger.info(f"pop_oidc_transaction - State: {state}, Found: {response is not None}")
+        return decode(response)
+    except Exception as e:
+        logger.error(f"Error reading from Redis: {e}")
+        return None
+
+# Token-bucket rate limiting. All buckets for a request are checked and charged in one atomic
+# script call: either every bucket has `cost` tokens and all are charged, or none is. Time comes
+# from the Redis server so pods with skewed clocks share one view of the buckets.
+
+TOKEN_BUCKET_SCRIPT = """
+local now = redis.call('TIME')
+local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local cost = tonumber(ARGV[1])
+local tokens = {}
+local wait_ms = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i])
+    local rate = tonumber(ARGV[2 * i + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now_ms
+    available = math.min(capacity, available + math.max(0, now_ms - ts) * rate / 1000)
+    tokens[i] = available
+    if available < cost then
+        wait_ms = math.max(wait_ms, math.ceil((cost - available) * 1000 / rate))
+    end
+end
+local result = {wait_ms == 0 and 1 or 0, wait_ms}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i])
+    local rate = tonumber(ARGV[2 * i + 1])
+    if wait_ms == 0 then
+        tokens[i] = tokens[i] - cost
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens[i]), 'ts', now_ms)
+    redis.call('PEXPIRE', key, math.ceil(capacity * 1000 / rate) + 1000)
+    result[i + 2] = tostring(tokens[i])
+end
+return result
+"""
+_token_bucket = None
+
+def rate_limit_key(*parts):
+    return ':'.join((RATE_LIMIT_KEY,) + parts)
+
+def take_rate_limit_tokens(buckets, cost=1):
+    """
+    buckets: list of (key, capacity, refill_per_second). Returns (allowed, retry_after_ms, tokens_left)
+    with tokens_left in bucket order. Raises on Redis errors so the caller decides how to fail.
+    """
+    global _token_bucket
+    if _token_bucket is None:
+        _token_bucket = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+    keys, args = token_bucket_arguments(buckets, cost)
+    with observe_redis('evalsha', RATE_LIMIT_KEY):
+        # Pass the client explicitly: the lazy proxy resolves to this worker's connection after fork
+        result = _token_bucket(keys=keys, args=args, client=redis_client)
+    return token_bucket_result(result)
+
+def token_bucket_arguments(buckets, cost=1):
+    args = [cost]
+    for _, capacity, rate in buckets:
+        args += [capacity, rate]
+    return [key for key, _, _ in buckets], args
+
+def token_bucket_result(result):
+    return bool(int(result[0])), int(result[1]), [float(tokens) for tokens in result[2:]]
+
+# Single-flight leases (see singleflight.py). The first caller takes the lease and later publishes
+# its result under a key named after its owner token; concurrent callers poll for that key. Results
+# are never served to callers that arrive after the flight, so this coalesces but does not cache.
+
+ACQUIRE_FLIGHT_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return {1, ARGV[1]}
+end
+return {0, redis.call('GET', KEYS[1])}
+"""
+PUBLISH_FLIGHT_SCRIPT = """
+redis.call('SET', KEYS[2], ARGV[2], 'PX', ARGV[3])
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+return 1
+"""
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_scripts = {}
+
+def _script(source):
+    if source not in _scripts:
+        _scripts[source] = redis_client.register_script(source)
+    return _scripts[source]
+
+def flight_key(name, digest):
+    return f"{SINGLEFLIGHT_KEY}:{name}:{digest}"
+
+def acquire_flight(key, owner, lease_ms):
+    """Take the lease on `key`. Returns (acquired, current owner); the owner is None if just released."""
+    with observe_redis('evalsha', SINGLEFLIGHT_KEY):
+        acquired, current = _script(ACQUIRE_FLIGHT_SCRIPT)(
+            keys=[key], args=[owner, lease_ms], client=redis_client)
+    return bool(int(acquired)), current
+
+def publish_flight_result(key, owner, result, ttl_ms):
+    """Store the leader's encoded result for its followers and release the lease, atomically."""
+    with observe_redis('evalsha', SINGLEFLIGHT_KEY):
+        _script(PUBLISH_FLIGHT_SCRIPT)(
+            keys=[key, f"{key}:{owner}"], args=[owner, encode(result), ttl_ms], client=redis_client)
+
+def release_flight(key, owner):
+    with observe_redis('evalsha', SINGLEFLIGHT_KEY):
+        _script(RELEASE_LEASE_SCRIPT)(keys=[key], args=[owner], client=redis_client)
+
+def poll_flight(key, owner):
+    """Returns (published, result, current owner). `published` is False while the flight is running."""
+    with observe_redis('mget', SINGLEFLIGHT_KEY):
+        encoded, current = redis_client.mget(f"{key}:{owner}", key)
+    if encoded is None:
+        return False, None, current
+    return True, decode(encoded), current
+
+# Scheduler leader election and run history (see scheduler.py)
+
+LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+def hold_scheduler_lease(owner, lease_ms):
+    """Take or renew the leader lease. Returns True while `owner` is the leader; raises on Redis errors."""
+    with observe_redis('evalsha', SCHEDULER_LEADER_KEY):
+        held = _script(LEASE_SCRIPT)(keys=[SCHEDULER_LEADER_KEY], args=[owner, lease_ms], client=redis_client)
+    return bool(int(held))
+
+def release_scheduler_lease(owner):
+    with observe_redis('evalsha', SCHEDULER_LEADER_KEY):
+        _script(RELEASE_LEASE_SCRIPT)(keys=[SCHEDULER_LEADER_KEY], args=[owner], client=redis_client)
+
+def get_scheduler_leader():
+    with observe_redis('get', SCHEDULER_LEADER_KEY):
+        return redis_client.get(SCHEDULER_LEADER_KEY)
+
+def scheduler_job_key(name):
+    return f"{SCHEDULER_JOB_KEY}:{name}"
+
+def get_scheduler_job(name):
+    with observe_redis('hgetall', SCHEDULER_JOB_KEY):
+        return redis_client.hgetall(scheduler_job_key(name))
+
+def update_scheduler_job(name, **fields):
+    with observe_redis('hset', SCHEDULER_JOB_KEY):
+        redis_client.hset(scheduler_job_key(name), mapping={k: '' if v is None else v for k, v in fields.items()})
+
+def record_scheduler_run(name, run, history):
+    """Append a finished run to the job's history (newest first, `history` kept) and update its state."""
+    fields = {'last_finished': run['finished'], 'last_outcome': run['outcome'], 'last_duration': run['duration'],
+              'last_error': run.get('error') or ''}
+    if run['outcome'] == 'ok':
+        fields['last_success'] = run['finished']
+    runs_key = f"{SCHEDULER_RUNS_KEY}:{name}"
+    with observe_redis('pipeline', SCHEDULER_RUNS_KEY):
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(scheduler_job_key(name), mapping=fields)
+        pipe.lpush(runs_key, encode(run))
+        pipe.ltrim(runs_key, 0, history - 1)
+        pipe.execute()
+
+def get_scheduler_runs(name, count=20):
+    with observe_redis('lrange', SCHEDULER_RUNS_KEY):
+        return [decode(run) for run in redis_client.lrange(f"{SCHEDULER_RUNS_KEY}:{name}", 0, count - 1)]
+
+# Rotating refresh tokens. A token is `<family>.<secret>`; the family record keeps only a digest of
+# the current secret. Redeeming it swaps in the next secret and stores the new access token in one
+# script call. Presenting a superseded secret means the token was copied, so the family is deleted
+# and every refresh token of that login stops working (reuse detection).
+
+ROTATE_REFRESH_SCRIPT = """
+local family = redis.call('HMGET', KEYS[1], 'current', 'email', 'userinfo')
+if not family[1] then
+    return {'invalid', false}
+end
+if family[1] ~= ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    return {'reused', family[2]}
+end
+redis.call('HSET', KEYS[1], 'current', ARGV[2], 'rotated_at', ARGV[5])
+redis.call('HINCRBY', KEYS[1], 'generation', 1)
+redis.call('HSET', KEYS[2], 'access_token', ARGV[3], 'userinfo', family[3])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+if family[2] then
+    -- Index the new token under the user (see queue_index_keys) so account deletion revokes it
+    local index_key = ARGV[6] .. ':' .. family[2]
+    redis.call('SADD', index_key, KEYS[2])
+    if redis.call('TTL', index_key) < tonumber(ARGV[4]) then
+        redis.call('EXPIRE', index_key, ARGV[4])
+    end
+end
+return {'ok', family[2]}
+"""
+
+def refresh_token_key(family):
+    return f"{REFRESH_TOKEN_KEY}:{family}"
+
+def refresh_token_digest(secret):
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+def split_refresh_token(refresh_token):
+    """(family, secret) of a refresh token, or None if it is malformed."""
+    family, _, secret = (refresh_token or '').partition('.')
+    return (family, secret) if family and secret else None
+
+def rotate_refresh_token(refresh_token, new_refresh_token, access_token, access_token_ttl):
+    """
+    Redeem `refresh_token` for `new_refresh_token` and store `access_token` -> the login's userinfo
+    for `access_token_ttl` seconds. Returns (outcome, email): 'ok', 'reused' (the family is now
+    revoked) or 'invalid' (unknown, expired or revoked family).
+    """
+    call = rotate_refresh_arguments(refresh_token, new_refresh_token, access_token, access_token_ttl)
+    if call is None:
+        return 'invalid', None
+    keys, args = call
+    with observe_redis('evalsha', REFRESH_TOKEN_KEY):
+        outcome, email = _script(ROTATE_REFRESH_SCRIPT)(keys=keys, args=args, client=redis_client)
+    logger.info(f"rotate_refresh_token - Key: {keys[0]}, Outcome: {outcome}")
+    return outcome, email or None
+
+def rotate_refresh_arguments(refresh_token, new_refresh_token, access_token, access_token_ttl):
+    """(keys, args) of ROTATE_REFRESH_SCRIPT, or None when the tokens are not of one family."""
+    parts, new_parts = split_refresh_token(refresh_token), split_refresh_token(new_refresh_token)
+    if not parts or not new_parts or parts[0] != new_parts[0]:
+        return None
+    return ([refresh_token_key(parts[0]), f"{ACCESS_TOKEN_TO_USERINFO_KEY}:{access_token}"],
+            [refresh_token_digest(parts[1]), refresh_token_digest(new_parts[1]), access_token,
+             access_token_ttl, int(time.time()), USER_TOKEN_INDEX_KEY])
+
+# Shared ArcGIS service-account token
+
+def get_cached_arcgis_token():
+    """Returns (token, remaining_ms); (None, 0) when nothing is cached or Redis is unavailable."""
+    try:
+        with observe_redis('pipeline', ARCGIS_TOKEN_KEY):
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.get(ARCGIS_TOKEN_KEY)
+            pipe.pttl(ARCGIS_TOKEN_KEY)
+            token, remaining_ms = pipe.execute()
+        return (token, remaining_ms) if token else (None, 0)
+    except Exception as e:
+        logger.error(f"Error reading from Redis: {e}")
+        return None, 0
+
+def put_cached_arcgis_token(token, ttl_ms):
+    try:
+        with observe_redis('set', ARCGIS_TOKEN_KEY):
+            redis_client.set(ARCGIS_TOKEN_KEY, token, px=ttl_ms)
+    except Exception as e:
+        logger.error(f"Error writing to Redis: {e}")
+
+# Stale key sweeps
+
+def prune_user_token_indexes(scan_count=500):
+    """Drop index members whose token key has expired; a set whose members are all gone disappears."""
+    counts = {'indexes': 0, 'pruned': 0}
+    for index_key in redis_client.scan_iter(match=f"{USER_TOKEN_INDEX_KEY}:*", count=scan_count):
+        members = list(redis_client.smembers(index_key))
+        counts['indexes'] += 1
+        if not members:
+            continue
+        pipe = redis_client.pipeline(transaction=False)
+        for member in members:
+            pipe.exists(member)
+        expired = [member for member, exists in zip(members, pipe.execute()) if not exists]
+        if expired:
+            redis_client.srem(index_key, *expired)
+            counts['pruned'] += len(expired)
+    return counts
+
+def expire_unbounded_keys(families, ttl_seconds, scan_count=500):
+    """Give keys of `families` that were written without a TTL one, so they age out; returns the count."""
+    expired = 0
+    for family in families:
+        for key in redis_client.scan_iter(match=f"{family}:*", count=scan_count):
+            if redis_client.ttl(key) == -1:
+                redis_client.expire(key, ttl_seconds)
+                expired += 1
+    return expired
+
+# Functions for bulk onboarding checkpoints
+
+def put_bulk_onboard_checkpoint(job_id, checkpoint):
+    redis_set(f"{BULK_ONBOARD_CHECKPOINT_KEY}:{job_id}", checkpoint)
+    logger.info(f"put_bulk_onboard_checkpoint - Job: {job_id}, Checkpoint: {checkpoint}")
+
+def get_bulk_onboard_checkpoint(job_id):
+    response = redis_get(f"{BULK_ONBOARD_CHECKPOINT_KEY}:{job_id}")
+    logger.info(f"get_bulk_onboard_checkpoint - Response: {response}")
+    return response
+
+def delete_bulk_onboard_checkpoint(job_id):
+    redis_delete(f"{BULK_ONBOARD_CHECKPOINT_KEY}:{job_id}")
+    logger.info(f"delete_bulk_onboard_checkpoint - Job: {job_id}")
+
 # Functions to check things
 
 def does_user_exist(email):
@@ -164,9 +1083,8 @@ def has_user_selected_group(auth_access):
     return auth_access.get('has_selected_group') if auth_access else None
 
 def update_auth_access(email, field_name, new_value):
-    key = f"{USER_AUTH_ACCESS_KEY}:{email}"
-    try:
-        redis_client.hset(key, field_name, new_value)
-        logger.info(f"update_auth_access - Email: {email}, Field: {field_name}, New Value: {new_value}")
-    except Exception as e:
-        logger.error(f"Error updating item in Redis: {e}")
+    record = get_user_record(email) or {}
+    auth_access = dict(record.get('auth_access') or {})
+    auth_access[field_name] = new_value
+    update_user_record(email, auth_access=auth_access)
+    logger.info(f"update_auth_access - Email: {email}, Field: {field_name}, New Value: {new_value}")
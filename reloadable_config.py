@@ -0,0 +1,66 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./config_reload.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+CONFIG_RELOAD_INTERVAL_SECONDS = float(os.environ.get('CONFIG_RELOAD_INTERVAL_SECONDS', 5))
+
+
+class ReloadableConfig:
+    """
+    A JSON config file compiled into a lookup structure and recompiled when the file changes.
+
+    `get()` returns the compiled object. At most once per `check_interval` seconds it stats the
+    file and, if the mtime changed, loads and compiles it again. A file that is missing or fails
+    to compile leaves the last good version (initially the compiled `default`) in place.
+    """
+
+    def __init__(self, path, compile_func, default, check_interval=CONFIG_RELOAD_INTERVAL_SECONDS):
+        self.path = path
+        self.compile_func = compile_func
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._compiled = compile_func(default)
+        self._mtime = None
+        self._next_check = 0.0
+
+    def get(self):
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._reload_if_changed(now)
+        return self._compiled
+
+    def _reload_if_changed(self, now):
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.check_interval
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                return
+            if mtime == self._mtime:
+                return
+            try:
+                with open(self.path) as f:
+                    compiled = self.compile_func(json.load(f))
+            except Exception as e:
+                logger.error(f"Keeping previous config, failed to load {self.path}: {e}")
+                self._mtime = mtime
+                return
+            self._compiled = compiled
+            self._mtime = mtime
+            logger.info(f"Loaded config from {self.path}")
+
+    def reload(self):
+        """Force a check of the file on the next `get()`."""
+        self._next_check = 0.0
+        self._mtime = None
@@ -6,12 +6,12 @@ import logging
 import requests
 import time
 import redis
-from threading import Thread
 
-from config import (redis_client, ARCGIS_CLIENT_URL, ARCGIS_OIDC_CLIENT_ID, ARCGIS_LOGIN_REDIRECT_URL, \
+from config import (redis_client, http_session, ARCGIS_CLIENT_URL, ARCGIS_OIDC_CLIENT_ID, ARCGIS_LOGIN_REDIRECT_URL, \
                     ARCGIS_LOGIN_CALLBACK_URL, USER_NOT_IN_ALLOWED_AGENCY_REDIRECT_DELAY_SECONDS, PUBLIC_URL,
                     AUTH_SERVICE_DOMAIN,
-                    USER_NOT_IN_ALLOWED_AGENCY_URL, SELF_SELECT_GROUP_FORM_URL)
+                    USER_NOT_IN_ALLOWED_AGENCY_URL, SELF_SELECT_GROUP_FORM_URL, USERINFO_COOKIE_TTL_SECONDS,
+                    ACCESS_TOKEN_TTL_SECONDS)
 
 from token_generation import (
     generate_auth_code,
@@ -21,13 +21,15 @@ from token_generation import (
     get_auth_code_from_idp,
     construct_idp_userinfo_get,
     construct_idp_token_post,
-    handle_idp_token_response, handle_userinfo_response, parse_x509_subject, parse_auth_access
+    handle_idp_token_response, handle_userinfo_response, parse_x509_subject, parse_auth_access,
+    oidc_binding_matches, OIDC_BINDING_COOKIE
 )
 from manage_arcgis_user_groups_helper_functions import (
     get_arcgis_group_titles,
     is_user_group_in_arcgis,
     get_user_groups,
-    is_user_org_in_allowed_orgs, parent_groups, get_user_group
+    is_user_org_in_allowed_orgs, org_hierarchy, get_user_group, is_usda_user,
+    add_user_to_groups as handle_webhook_payload
 )
 from redis_helpers import (
     get_username_to_email,
@@ -37,17 +39,26 @@ from redis_helpers import (
     delete_user_auth_access,
     delete_email_to_user_groups,
     get_access_token_to_userinfo,
-    get_auth_code_to_access_token, get_user_auth_access, put_user_auth_access, create_user,
-    put_auth_code_to_access_token, put_access_token_to_userinfo, put_email_to_user_groups
+    redeem_auth_code, get_user_auth_access, put_user_auth_access,
+    get_user_record, update_user_record, put_login_tokens, index_user_keys, pop_oidc_transaction, IDP_ACCESS_TOKEN_KEY,
+    put_auth_code_to_access_token, put_access_token_to_userinfo, put_email_to_user_groups,
+    rotate_refresh_token
 )
-from arcgis_api import (
-    get_user_from_username, add_user_to_groups
+from login_flow import (
+    arcgis_login_redirect, callback_decision, complete_userinfo, login_return_target, new_login_tokens,
+    prepare_refresh_grant, record_refresh_outcome, should_prefetch, token_response
 )
+from user_state import require_admin_token
+from webhook_processor import webhook_processor
+from arcgis_prefetch import arcgis_prefetcher
+from userinfo_cookie import issue_userinfo_cookie, is_legacy_userinfo_cookie, load_userinfo_cookie
+from metrics import observe_outbound, TOKEN_GRANTS
+from tracing import adopt_traceparent, current_traceparent, set_attribute
 
 # Initialize logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler('./routes.log')
+file_handler = logging.FileHandler('./routes.log', delay=True)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 file_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
@@ -61,21 +72,24 @@ routes_blueprint = Blueprint("routes", __name__)
 def arcgis_callback():
     try:
         logger.info("Starting arcgis_callback route")
-        arcgis_auth_code = generate_auth_code()
-        arcgis_access_token = generate_jwt_token(ARCGIS_CLIENT_URL, ARCGIS_OIDC_CLIENT_ID)
+        arcgis_auth_code, arcgis_access_token, refresh_token = new_login_tokens()
 
-        put_auth_code_to_access_token(arcgis_auth_code, arcgis_access_token)
-
-        userinfo = request.cookies.get('userinfo') or redis_client.get(f"userinfo:{arcgis_access_token}")
-        if userinfo:
-            userinfo = json.loads(userinfo)
-        else:
+        userinfo_cookie = request.cookies.get('userinfo')
+        userinfo = load_userinfo_cookie(userinfo_cookie)
+        if not userinfo:
             return "Error: UID missing in user info", 400
+        if not userinfo.get('email'):
+            return "Error: Email missing in user info", 400
+        if is_legacy_userinfo_cookie(userinfo_cookie):
+            userinfo_cookie = issue_userinfo_cookie(userinfo)
+        set_attribute('enduser.id', userinfo.get('email'))
 
-        put_access_token_to_userinfo(arcgis_access_token, json.dumps(userinfo))
+        # Code, token and refresh token family are indexed under the user so account deletion revokes them
+        put_login_tokens(userinfo.get('email'), arcgis_auth_code, arcgis_access_token, userinfo,
+                         traceparent=current_traceparent(), refresh_token=refresh_token)
 
-        response = make_response(redirect(f'{ARCGIS_LOGIN_REDIRECT_URL}?code={arcgis_auth_code}'))
-        response.set_cookie("userinfo", json.dumps(userinfo), httponly=True, secure=True, max_age=3600)
+        response = make_response(redirect(arcgis_login_redirect(arcgis_auth_code)))
+        response.set_cookie("userinfo", userinfo_cookie, httponly=True, secure=True, max_age=USERINFO_COOKIE_TTL_SECONDS)
 
         return response
     except Exception as e:
@@ -174,7 +188,7 @@ def select_user_groups():
         user_last_name = request.args.get('last_name', '')
         select_group_options = ""
 
-        for usda_subgroup in parent_groups['usda']:
+        for usda_subgroup in org_hierarchy.get().children.get('usda', []):
             select_group_options += f'<option value="{usda_subgroup}">{usda_subgroup.upper()}</option>'
 
         redis_client.setex("usda_group_options", 86400, select_group_options)
@@ -262,6 +276,8 @@ def select_user_groups():
             return "Invalid submission", 400
 
         put_email_to_user_groups(user_email, selected_group)
+        # The selection changes the groups the webhook will assign
+        arcgis_prefetcher.submit(user_email)
         return redirect(ARCGIS_LOGIN_CALLBACK_URL)
 
 # -------------------------
@@ -269,7 +285,7 @@ def select_user_groups():
 # -------------------------
 @routes_blueprint.route('/auth')
 def auth():
-    response = make_response(get_auth_code_from_idp())
+    response = make_response(get_auth_code_from_idp(login_return_target(request.args.get('return_to'))))
 
     # Clear old session coookies
     response.set_cookie("session", "", expires=0)
@@ -286,53 +302,11 @@ def auth():
 def add_user_to_groups_route():
     """
     Route to add users to groups based on the event data.
-    Handles user creation, update, and deletion events.
+    Handles user creation, update, and deletion events for every event in the payload.
     """
     data = request.get_json()
-    event = data['events'][0]
-    operation = event['operation']
-    source = event['source']
-
-    logger.info(f"Received webhook event: {event}")
-
-    user_was_created = operation == 'add' and source == 'users'
-    user_was_updated = operation == 'update' and source == 'users'
-    user_was_deleted = operation == 'delete' and source == 'user'
-
-
-
-    # Handle user creation or update
-    if user_was_created or user_was_updated:
-        username = event.get('username')
-        user = get_user_from_username(username)
-        user_email = user.get('email')
-
-        # Store username-to-email mapping in Redis
-        put_username_to_email(username, user_email)
-
-        # Handle group assignment for created user
-        if user_was_created:
-            selected_group = get_email_to_user_groups(user_email)
-            user_group = json.loads(selected_group['user_groups']) if selected_group else get_user_group(user_email)
-            logger.info(f'Attempting to assign user group: {user_group}')
-            group_titles = get_user_groups(user_group)
-            add_user_to_groups(user, group_titles)
-
-
-    # Handle user deletion
-    elif user_was_deleted:
-        username = event.get('id')
-        user = get_username_to_email(username)
-        user_email = user.get('user_email')
-
-        logger.info(f'Deleting user-related data for {user_email}')
-
-        # Delete user-related data from Redis and other systems
-        delete_username_to_email(username)
-        delete_user_auth_access(user_email)
-        delete_email_to_user_groups(user_email)
-
-    return 'OK', 200
+    logger.info(f"Received webhook events: {data.get('events')}")
+    return handle_webhook_payload(data)
 
 # -------------------------
 # ✅ User Info Route
@@ -342,10 +316,10 @@ def userinfo_route():
     auth_header = request.headers.get('Authorization')
     arcgis_access_token = auth_header[7:]
     try:
-        userinfo = get_access_token_to_userinfo(arcgis_access_token)['userinfo']
+        userinfo = (get_access_token_to_userinfo(arcgis_access_token) or {}).get('userinfo')
         if not userinfo:
             return jsonify({"error": "Token invalid or expired"}), 401
-        return jsonify(json.loads(userinfo))
+        return jsonify(userinfo)
     except KeyError:
         return 'Unauthorized', 401
 
@@ -355,14 +329,42 @@ def userinfo_route():
 # -------------------------
 @routes_blueprint.route('/token', methods=['POST'])
 def token():
+    if request.form.get('grant_type') == 'refresh_token':
+        return refresh_token_grant()
+
     arcgis_auth_code = request.form.get('code')
-    arcgis_access_token = get_auth_code_to_access_token(arcgis_auth_code)['access_token']
+    auth_code_record = redeem_auth_code(arcgis_auth_code) if arcgis_auth_code else None
+    if not auth_code_record:
+        TOKEN_GRANTS.labels('authorization_code', 'invalid').inc()
+        return jsonify({"error": "invalid_grant"}), 400
+    adopt_traceparent(auth_code_record.get('traceparent'))
+    arcgis_access_token = auth_code_record['access_token']
+    TOKEN_GRANTS.labels('authorization_code', 'ok').inc()
+
+    return jsonify(token_response(arcgis_access_token, auth_code_record.get('refresh_token')))
+
+def refresh_token_grant():
+    """
+    Renew an access token without a new federated login: one signature and one Redis script call.
+    The refresh token rotates on every use; replaying a used one revokes the whole login.
+    """
+    refresh_token = request.form.get('refresh_token')
+    grant = prepare_refresh_grant(refresh_token)
+    if not grant:
+        return jsonify({"error": "invalid_grant"}), 400
+
+    arcgis_access_token, new_refresh_token = grant
+    try:
+        outcome, email = rotate_refresh_token(refresh_token, new_refresh_token, arcgis_access_token,
+                                              ACCESS_TOKEN_TTL_SECONDS)
+    except redis.RedisError as e:
+        logger.error(f"Refresh token grant failed: {e}")
+        return jsonify({"error": "temporarily_unavailable"}), 503
+    if not record_refresh_outcome(refresh_token, outcome, email):
+        return jsonify({"error": "invalid_grant"}), 400
 
-    return jsonify({
-        "access_token": arcgis_access_token,
-        "token_type": "Bearer",
-        "expires_in": 3600,
-    })
+    set_attribute('enduser.id', email)
+    return jsonify(token_response(arcgis_access_token, new_refresh_token))
 
 # -------------------------
 # ✅ ArcGIS Webhook Route
@@ -372,33 +374,17 @@ def webhook():
     data = request.get_json()
     if data.get('events') is None:
         return 'OK', 200
-    Thread(target=lambda: requests.post(f'https://{AUTH_SERVICE_DOMAIN}/add_user_to_groups', json=data)).start()
+    accepted, event_count = webhook_processor.submit(data)
+    if not accepted:
+        status = 503 if not webhook_processor.running else 429
+        logger.warning(f"Rejected webhook with {event_count} events, responding {status}")
+        return 'Busy', status, {'Retry-After': '5'}
     return 'OK', 200
 
-# -------------------------
-# ✅ Special Bypass Users & Groups
-# -------------------------
-SPECIAL_USDA_USERS = {
-    "andrea_borghi@ios.doi.gov",
-    "john_gillham@ios.doi.gov",
-    "satish_bobburi@ios.doi.gov"
-}
-
-SPECIAL_USDA_DOMAINS = {
-    # "specialagency.gov",
-    # "examplemilitary.mil",
-    "contractor.usgs.gov",
-    "usda.gov"
-}
-
-def is_usda_user(user_email):
-    """Check if the user is in the special bypass list or domain."""
-    if user_email in SPECIAL_USDA_USERS:
-        return True
-    for domain in SPECIAL_USDA_DOMAINS:
-        if user_email.endswith(domain):
-            return True
-    return False
+@routes_blueprint.route('/arcgis_webhook/stats')
+def webhook_stats():
+    require_admin_token()
+    return jsonify(webhook_processor.stats())
 
 # -------------------------
 # ✅ Authentication Functions
@@ -420,130 +406,57 @@ def callback():
     if not auth_code:
         return 'Authorization code missing', 400
 
+    # The transaction written by /auth; consuming it makes each state single-use
+    state = request.args.get('state')
+    transaction = pop_oidc_transaction(state) if state else None
+    if not transaction:
+        logger.warning(f'Callback with unknown or expired OIDC state: {state}')
+        return 'Login expired or invalid, please sign in again', 400
+    if not oidc_binding_matches(transaction, request.cookies.get(OIDC_BINDING_COOKIE)):
+        logger.warning(f'Callback with OIDC state {state} from a browser that did not start the login')
+        return 'Login expired or invalid, please sign in again', 400
+    return_to = transaction.get('return_to') or ARCGIS_LOGIN_CALLBACK_URL
+
     token_url, headers, data = construct_idp_token_post(auth_code)
     logger.debug(f'Requesting token with URL: {token_url}')
-    idp_token_response = requests.post(token_url, headers=headers, data=data)
+    with observe_outbound('login.gov', 'token'):
+        idp_token_response = http_session.post(token_url, headers=headers, data=data)
 
-    access_token = handle_idp_token_response(idp_token_response)
+    access_token = handle_idp_token_response(idp_token_response, nonce=transaction.get('nonce'))
+    if isinstance(access_token, tuple):
+        return access_token
     logger.debug(f'Access token received: {access_token}')
 
     userinfo_url, headers = construct_idp_userinfo_get(access_token)
     logger.debug(f'Requesting user info from {userinfo_url}')
 
-    userinfo_response = requests.get(userinfo_url, headers=headers)
+    with observe_outbound('login.gov', 'userinfo'):
+        userinfo_response = http_session.get(userinfo_url, headers=headers)
     userinfo = handle_userinfo_response(userinfo_response)
 
     if not userinfo:
         return "Error: Userinfo missing", 400
 
-    x509_subject = userinfo.get('x509_subject')
     user_email = userinfo.get('email')
+    set_attribute('enduser.id', user_email)
+    complete_userinfo(userinfo)
 
-    if x509_subject:
-        given_name, family_name, organizations = parse_x509_subject(x509_subject)
-        userinfo['organizations'] = organizations
-    else:
-        logger.info(f'No x509 subject found, using email to set names for {user_email}')
-        # given_name = user_email.split('@')[0]
-        # family_name = user_email.split('@')[1].split('.')[-2]
-        given_name = userinfo.get('given_name', user_email.split('@')[0])
-        family_name = userinfo.get('family_name', user_email.split('@')[1].split('.')[-2])
-
-    userinfo['given_name'] = given_name
-    userinfo['family_name'] = family_name
-
-    # is this referenced later?
-    redis_client.set(f"{user_email}:userinfo:{access_token}", json.dumps(userinfo))
+    # Everything known about the user lives in one record, read once per login
+    user_record = get_user_record(user_email)
+    update_user_record(user_email, userinfo=userinfo)
+    index_user_keys(user_email, f"{IDP_ACCESS_TOKEN_KEY}:{access_token}")
 
     logger.info(f'User info processed for email: {user_email}')
-    # I don't see how this is never None since the put doesn't happen unless this is None?
-    user_permission_data = get_user_auth_access(user_email)
-
-    # ✅ Apply Bypass Check
-    # this isn't really the bypass as its inside really just inside of is_usda_user
-    if is_usda_user(user_email):
-        logger.info(f"Bypass activated for {user_email} - forcing USDA access.")
-        user_is_usda = True
-        user_is_in_allowed_orgs = True
-        user_has_selected_group = True if get_email_to_user_groups(user_email) is not None else False
-    else:
-        user_is_usda = False
-        user_is_in_allowed_orgs = is_user_org_in_allowed_orgs(user_email)
-        user_has_selected_group = False
-
-    # this is if users have logged in before and have data in redis
-    if user_permission_data is not None:
-        (user_is_disallowed,
-         user_previous_selected_group) = parse_auth_access(user_permission_data.get('auth_access'))
-
-        if user_is_disallowed is True:
-
-            logger.warning(f'User {user_email} is disallowed. Checking for USDA and selected group.')
-            if user_is_usda is True and user_previous_selected_group is not None:
-                is_previous_selected_group_in_arcgis_groups = True if get_email_to_user_groups(user_email) else False
-                if is_previous_selected_group_in_arcgis_groups:
-                    logger.info(f'User {user_email} is allowed to re-select group {user_previous_selected_group}')
-                    user_is_disallowed = False
-                    user_has_selected_group = False
-                    # user_previous_selected_group = None
-                    user_permission_data = {
-                        'is_disallowed': user_is_disallowed,
-                        'has_selected_group': user_has_selected_group,
-                    }
-
-                    put_user_auth_access(user_email, user_permission_data)
-
-                    # Update Redis cache with updated `has_selected_group`
-
-                    redis_client.set(f"{user_email}:has_selected_group", user_has_selected_group)
-
-                else:
-                    logger.warning(
-                        f'User {user_email} not allowed to select group {user_previous_selected_group}. Redirecting.')
-                    return redirect(USER_NOT_IN_ALLOWED_AGENCY_URL)
-
-        if user_is_disallowed is False:
-            resp = redirect(ARCGIS_LOGIN_CALLBACK_URL)
-            resp.set_cookie('userinfo', json.dumps(userinfo))
-
-            if user_is_usda is False:
-                logger.debug(f'User {user_email} is not USDA, redirecting to {ARCGIS_LOGIN_CALLBACK_URL}')
-                return resp
-
-            if user_is_usda is True and user_has_selected_group is True:
-                logger.info(f'User {user_email} is USDA and has selected a group, redirecting.')
-                return resp
-
-    # if the user has never logged in, is not usda and is not in allowed orgs
-    if not user_is_in_allowed_orgs:
-        logger.warning(
-            f'User {user_email} is not in allowed organizations, redirecting to {USER_NOT_IN_ALLOWED_AGENCY_URL}')
-
-        return redirect(USER_NOT_IN_ALLOWED_AGENCY_URL)
-
-
-    logger.info(f'User first name: {given_name}, last name: {family_name}')
-
-    # this section is for entirely new users that have no data in redis
-    # or for users that have logged in before but have not selected a group
-    if user_is_usda and user_has_selected_group is False:
-        logger.info(f'User {user_email} is USDA and has not selected a group, redirecting to self-select form.')
-
-        self_select_form_url = parse.urljoin(SELF_SELECT_GROUP_FORM_URL,
-                                                    f"?email={user_email}&firstname={given_name}&lastname={family_name}")
-
-        resp = redirect(self_select_form_url)
-        resp.set_cookie('userinfo', json.dumps(userinfo))
-        return resp
-
-
-    logger.debug(f'Creating user data for {user_email} and redirecting to {ARCGIS_LOGIN_CALLBACK_URL}')
-    user_permission_data = {
-        'is_disallowed': False,
-        'has_selected_group': False
-    }
-
-    create_user(user_email, user_permission_data)
-    resp = redirect(ARCGIS_LOGIN_CALLBACK_URL)
-    resp.set_cookie('userinfo', json.dumps(userinfo))
+    userinfo_cookie = issue_userinfo_cookie(userinfo)
+
+    if should_prefetch(user_email, user_record):
+        arcgis_prefetcher.submit(user_email)
+
+    location, set_userinfo_cookie, auth_access = callback_decision(userinfo, user_record, return_to)
+    if auth_access is not None:
+        put_user_auth_access(user_email, auth_access)
+    resp = redirect(location)
+    resp.delete_cookie(OIDC_BINDING_COOKIE, path='/callback')
+    if set_userinfo_cookie:
+        resp.set_cookie('userinfo', userinfo_cookie)
     return resp
@@ -0,0 +1,261 @@
+"""
+Leader-elected scheduler for the service's periodic jobs.
+
+Every candidate process runs the loop below: the gunicorn master of each replica (when
+SCHEDULER_ENABLED) or a standalone `python scheduler.py`. Only the holder of the scheduler-leader
+lease in Redis starts jobs, so each job runs once per interval across all replicas and workers.
+The leader renews the lease every tick; if it stops, another candidate takes over once the lease
+expires (SCHEDULER_LEASE_MS).
+
+Each job's next run time is stored in Redis (scheduler-job:<name>), so a new leader carries on the
+schedule rather than starting every job at once. Intervals are jittered by +/-10%. A job runs in
+its own thread; a run that outlives its timeout is recorded as timed out, and the job is not
+started again until that run returns. The last SCHEDULER_HISTORY runs of each job are kept, and
+durations and last-success times are exported as metrics. Jobs must be idempotent: a leader change
+in the middle of a run can start the job a second time.
+
+    python scheduler.py                      # run as a standalone candidate
+    python scheduler.py --status             # leader, job state and recent runs
+    python scheduler.py --run sweep_redis    # run one job now, in the foreground
+"""
+import argparse
+import logging
+import os
+import random
+import secrets
+import signal
+import socket
+import sys
+import threading
+import time
+from datetime import datetime
+
+import arcgis_api
+from change_feed import update_change_feed_metrics
+from config import ARCGIS_GROUP_SYNC_INTERVAL_SECONDS, ARCGIS_TOKEN_REFRESH_INTERVAL_SECONDS, \
+    CHANGE_FEED_METRICS_INTERVAL_SECONDS, REDIS_SWEEP_INTERVAL_SECONDS, SCHEDULER_HISTORY, SCHEDULER_LEASE_MS, \
+    SCHEDULER_TICK_SECONDS, STALE_TOKEN_TTL_SECONDS
+from manage_arcgis_user_groups_helper_functions import sync_arcgis_group_titles
+from metrics import SCHEDULER_JOB_DURATION, SCHEDULER_JOB_LAST_SUCCESS, SCHEDULER_LEADER
+from redis_helpers import (
+    ACCESS_TOKEN_TO_USERINFO_KEY, AUTH_CODE_TO_ACCESS_TOKEN_KEY, expire_unbounded_keys, get_scheduler_job,
+    get_scheduler_leader, get_scheduler_runs, hold_scheduler_lease, prune_user_token_indexes, record_scheduler_run,
+    release_scheduler_lease, update_scheduler_job
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./scheduler.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+class Job:
+
+    def __init__(self, name, func, interval, timeout, jitter=0.1):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.timeout = timeout
+        self.jitter = jitter
+
+    def next_run(self, now):
+        return now + self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class Scheduler:
+
+    def __init__(self, jobs, lease_ms=SCHEDULER_LEASE_MS, tick_seconds=SCHEDULER_TICK_SECONDS,
+                 history=SCHEDULER_HISTORY):
+        self.jobs = {job.name: job for job in jobs}
+        self.lease_ms = lease_ms
+        self.tick_seconds = tick_seconds
+        self.history = history
+        self.owner = None
+        self.is_leader = False
+        self._runs = {}  # job name -> (thread, run) while a run has not returned
+        self._stop = threading.Event()
+        self._pid = None
+
+    def start(self):
+        """Run the scheduler loop in a background thread of this process."""
+        self._claim_process()
+        threading.Thread(target=self._loop, name='scheduler', daemon=True).start()
+        logger.info(f"Scheduler started as {self.owner} with jobs {sorted(self.jobs)}")
+
+    def run_forever(self):
+        self._claim_process()
+        logger.info(f"Scheduler running as {self.owner} with jobs {sorted(self.jobs)}")
+        self._loop()
+
+    def stop(self):
+        self._stop.set()
+        if self.is_leader and self._pid == os.getpid():
+            try:
+                release_scheduler_lease(self.owner)
+            except Exception as e:
+                logger.error(f"Error releasing scheduler lease: {e}")
+            self._set_leader(False)
+
+    def _claim_process(self):
+        self._pid = os.getpid()
+        self.owner = f"{socket.gethostname()}:{self._pid}:{secrets.token_hex(4)}"
+        self._stop.clear()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            # gevent carries the master's greenlets into forked workers; only the starting process schedules
+            if os.getpid() != self._pid:
+                return
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"Scheduler tick failed: {e}")
+            self._stop.wait(self.tick_seconds)
+
+    def tick(self, now=None):
+        now = time.time() if now is None else now
+        self._collect(now)
+        self._set_leader(self._hold_lease())
+        if not self.is_leader:
+            return
+        for job in self.jobs.values():
+            if job.name in self._runs:
+                continue
+            next_run = get_scheduler_job(job.name).get('next_run')
+            if not next_run or float(next_run) <= now:
+                self._start(job, now)
+
+    def _hold_lease(self):
+        try:
+            return hold_scheduler_lease(self.owner, self.lease_ms)
+        except Exception as e:
+            logger.error(f"Error renewing scheduler lease: {e}")
+            return False
+
+    def _set_leader(self, leader):
+        if leader != self.is_leader:
+            logger.info(f"Scheduler {self.owner} {'became' if leader else 'is no longer'} the leader")
+            self.is_leader = leader
+            SCHEDULER_LEADER.set(1 if leader else 0)
+
+    def _start(self, job, now):
+        update_scheduler_job(job.name, next_run=job.next_run(now), last_started=now, last_owner=self.owner)
+        run = {'job': job.name, 'owner': self.owner, 'started': now}
+        thread = threading.Thread(target=self._execute, args=(job, run), name=f'scheduler-{job.name}', daemon=True)
+        self._runs[job.name] = (thread, run)
+        thread.start()
+
+    @staticmethod
+    def _execute(job, run):
+        start = time.perf_counter()
+        try:
+            run['result'] = job.func()
+            run['outcome'] = 'ok'
+        except Exception as e:
+            logger.exception(f"Job {job.name} failed")
+            run['outcome'] = 'error'
+            run['error'] = f"{type(e).__name__}: {e}"
+        run['duration'] = time.perf_counter() - start
+
+    def _collect(self, now):
+        for name, (thread, run) in list(self._runs.items()):
+            job = self.jobs[name]
+            if not thread.is_alive():
+                del self._runs[name]
+                if run.get('timed_out'):
+                    logger.warning(f"Job {name} returned after timing out ({run['duration']:.1f}s)")
+                else:
+                    self._record(job, run)
+            elif not run.get('timed_out') and now - run['started'] > job.timeout:
+                run['timed_out'] = True
+                self._record(job, dict(run, outcome='timeout', duration=now - run['started'],
+                                       error=f"still running after {job.timeout}s"))
+
+    def _record(self, job, run):
+        run['finished'] = time.time()
+        SCHEDULER_JOB_DURATION.labels(job.name, run['outcome']).observe(run['duration'])
+        if run['outcome'] == 'ok':
+            SCHEDULER_JOB_LAST_SUCCESS.labels(job.name).set(run['finished'])
+        logger.info(f"Job {job.name}: {run['outcome']} in {run['duration']:.2f}s {run.get('result') or ''}"
+                    f"{run.get('error') or ''}")
+        try:
+            record_scheduler_run(job.name, {k: v for k, v in run.items() if k != 'timed_out'}, self.history)
+        except Exception as e:
+            logger.error(f"Error recording run of {job.name}: {e}")
+
+    def run_now(self, name):
+        """Run one job in the foreground, outside the schedule and without the lease."""
+        job = self.jobs[name]
+        run = {'job': name, 'owner': self.owner or f"{socket.gethostname()}:{os.getpid()}:manual",
+               'started': time.time()}
+        self._execute(job, run)
+        self._record(job, run)
+        return run
+
+
+# Jobs
+
+def sweep_redis():
+    counts = prune_user_token_indexes()
+    counts['ttl_added'] = expire_unbounded_keys(
+        (AUTH_CODE_TO_ACCESS_TOKEN_KEY, ACCESS_TOKEN_TO_USERINFO_KEY), STALE_TOKEN_TTL_SECONDS)
+    return counts
+
+
+def default_jobs():
+    return [
+        Job('refresh_arcgis_token', arcgis_api.refresh_token, ARCGIS_TOKEN_REFRESH_INTERVAL_SECONDS, timeout=60),
+        Job('sync_arcgis_groups', sync_arcgis_group_titles, ARCGIS_GROUP_SYNC_INTERVAL_SECONDS, timeout=300),
+        Job('sweep_redis', sweep_redis, REDIS_SWEEP_INTERVAL_SECONDS, timeout=600),
+        Job('change_feed_metrics', update_change_feed_metrics, CHANGE_FEED_METRICS_INTERVAL_SECONDS, timeout=30),
+    ]
+
+
+scheduler = Scheduler(default_jobs())
+
+
+def _when(timestamp):
+    return datetime.fromtimestamp(float(timestamp)).isoformat(timespec='seconds') if timestamp else '-'
+
+
+def print_status(out=sys.stdout, runs=5):
+    out.write(f"leader: {get_scheduler_leader() or '-'}\n")
+    for name in scheduler.jobs:
+        state = get_scheduler_job(name)
+        out.write(f"\n{name}: next {_when(state.get('next_run'))}, last success {_when(state.get('last_success'))}, "
+                  f"last {state.get('last_outcome') or '-'}\n")
+        for run in get_scheduler_runs(name, runs):
+            out.write(f"  {_when(run['started'])} {run['outcome']:<8} {run['duration']:>8.2f}s "
+                      f"{run.get('error') or run.get('result') or ''}\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--status', action='store_true', help='show the leader, job state and recent runs')
+    parser.add_argument('--run', choices=sorted(scheduler.jobs), help='run one job now and exit')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on this port')
+    args = parser.parse_args(argv)
+
+    if args.status:
+        print_status()
+        return 0
+    if args.run:
+        run = scheduler.run_now(args.run)
+        print(f"{args.run}: {run['outcome']} in {run['duration']:.2f}s {run.get('error') or run.get('result') or ''}")
+        return 0 if run['outcome'] == 'ok' else 1
+    if args.metrics_port:
+        from prometheus_client import start_http_server
+        start_http_server(args.metrics_port)
+    signal.signal(signal.SIGTERM, lambda *_: scheduler.stop())
+    try:
+        scheduler.run_forever()
+    except KeyboardInterrupt:
+        pass
+    scheduler.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+"""
+Single-flight coalescing of identical concurrent calls.
+
+    @single_flight('arcgis.get_group_by_title')
+    def get_group_by_title(group_title): ...
+
+Concurrent calls with the same arguments share one execution. Within a worker the first caller
+runs the function and the others wait on an Event (a gevent event once the worker is
+monkey-patched) and receive its result or exception. Across workers and pods the leader also
+takes a short Redis lease and publishes its result when done; callers elsewhere poll for it and
+run the function themselves if the leader goes away without publishing or the lease runs out.
+Only overlapping calls are coalesced: nothing is cached beyond the flight.
+"""
+import functools
+import hashlib
+import logging
+import secrets
+import threading
+import time
+
+from config import SINGLEFLIGHT_LEASE_MS, SINGLEFLIGHT_POLL_MS, SINGLEFLIGHT_RESULT_TTL_MS, SINGLEFLIGHT_SHARED
+from metrics import SINGLEFLIGHT_CALLS
+from redis_helpers import acquire_flight, flight_key, poll_flight, publish_flight_result, release_flight
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./singleflight.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+def call_key(args, kwargs):
+    """Stable across processes for the str/int/None arguments the lookups take."""
+    return hashlib.sha1(repr((args, sorted(kwargs.items()))).encode()).hexdigest()[:20]
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+
+    def __init__(self, name, shared=SINGLEFLIGHT_SHARED, lease_ms=SINGLEFLIGHT_LEASE_MS,
+                 result_ttl_ms=SINGLEFLIGHT_RESULT_TTL_MS, poll_ms=SINGLEFLIGHT_POLL_MS):
+        self.name = name
+        self.shared = shared
+        self.lease_ms = lease_ms
+        self.result_ttl_ms = result_ttl_ms
+        self.poll_interval = poll_ms / 1000
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            SINGLEFLIGHT_CALLS.labels(self.name, 'local').inc()
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            if self.shared:
+                flight.result = self._do_shared(key, func, args, kwargs)
+            else:
+                SINGLEFLIGHT_CALLS.labels(self.name, 'leader').inc()
+                flight.result = func(*args, **kwargs)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _do_shared(self, key, func, args, kwargs):
+        redis_key = flight_key(self.name, key)
+        owner = secrets.token_hex(8)
+        try:
+            acquired, current = acquire_flight(redis_key, owner, self.lease_ms)
+        except Exception as e:
+            logger.error(f"Error taking single-flight lease {redis_key}, running uncoordinated: {e}")
+            SINGLEFLIGHT_CALLS.labels(self.name, 'fallback').inc()
+            return func(*args, **kwargs)
+
+        if acquired:
+            SINGLEFLIGHT_CALLS.labels(self.name, 'leader').inc()
+            return self._lead(redis_key, owner, func, args, kwargs)
+
+        if current is not None:
+            published, result = self._wait(redis_key, current)
+            if published:
+                SINGLEFLIGHT_CALLS.labels(self.name, 'remote').inc()
+                return result['value']
+        logger.info(f"Single-flight leader for {redis_key} finished without a result, running it here")
+        SINGLEFLIGHT_CALLS.labels(self.name, 'fallback').inc()
+        return func(*args, **kwargs)
+
+    def _lead(self, redis_key, owner, func, args, kwargs):
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self._release(redis_key, owner)
+            raise
+        try:
+            publish_flight_result(redis_key, owner, {'value': result}, self.result_ttl_ms)
+        except Exception as e:
+            logger.error(f"Error publishing single-flight result {redis_key}: {e}")
+            self._release(redis_key, owner)
+        return result
+
+    def _release(self, redis_key, owner):
+        try:
+            release_flight(redis_key, owner)
+        except Exception as e:
+            logger.error(f"Error releasing single-flight lease {redis_key}: {e}")
+
+    def _wait(self, redis_key, owner):
+        deadline = time.monotonic() + self.lease_ms / 1000
+        while time.monotonic() < deadline:
+            try:
+                published, result, current = poll_flight(redis_key, owner)
+            except Exception as e:
+                logger.error(f"Error polling single-flight result {redis_key}: {e}")
+                return False, None
+            if published:
+                return True, result
+            if current != owner:
+                return False, None
+            time.sleep(self.poll_interval)
+        return False, None
+
+
+def single_flight(name, **options):
+    """Decorator coalescing concurrent calls with equal arguments; see the module docstring."""
+    flights = SingleFlight(name, **options)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return flights.do(call_key(args, kwargs), func, *args, **kwargs)
+        wrapper.flights = flights
+        return wrapper
+    return decorator
@@ -0,0 +1,113 @@
+import logging
+import os
+import re
+import subprocess
+import sys
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./startup.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+# Set STARTUP_TRACEMALLOC=1 to trace allocations made while importing the app
+TRACEMALLOC_ENABLED = os.environ.get('STARTUP_TRACEMALLOC') == '1'
+TRACEMALLOC_TOP = int(os.environ.get('STARTUP_TRACEMALLOC_TOP', 15))
+
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|\s+(.*)$')
+
+
+def start_tracemalloc():
+    """Start tracing allocations if enabled. Call before the app is imported."""
+    if TRACEMALLOC_ENABLED and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def read_memory_status(pid='self'):
+    """
+    Return the RSS breakdown (kB) from /proc/<pid>/status.
+    RssAnon is memory private to the process; RssFile and RssShmem are pages that
+    can be shared with the gunicorn master after a --preload fork.
+    """
+    fields = ('VmRSS', 'RssAnon', 'RssFile', 'RssShmem')
+    status = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in fields:
+                    status[name] = int(value.split()[0])
+    except OSError as e:
+        logger.warning(f"Unable to read memory status for {pid}: {e}")
+    return status
+
+
+def read_private_dirty(pid='self'):
+    """Return Private_Dirty (kB) from /proc/<pid>/smaps_rollup, i.e. pages no longer shared copy-on-write."""
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Private_Dirty:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def report_process(label):
+    """Log the memory footprint of the current process and, if tracing, the top import-time allocations."""
+    status = read_memory_status()
+    private_dirty = read_private_dirty()
+    logger.info(f"{label} pid={os.getpid()} memory_kb={status} private_dirty_kb={private_dirty}")
+
+    if tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        logger.info(f"{label} tracemalloc current_kb={current // 1024} peak_kb={peak // 1024}")
+        for stat in snapshot.statistics('filename')[:TRACEMALLOC_TOP]:
+            logger.info(f"{label} tracemalloc {stat}")
+    return status
+
+
+def parse_importtime(stderr_text):
+    """Parse `python -X importtime` output into (cumulative_us, self_us, module) tuples."""
+    entries = []
+    for line in stderr_text.splitlines():
+        match = IMPORTTIME_LINE.match(line.strip())
+        if match:
+            self_us, cumulative_us, module = match.groups()
+            entries.append((int(cumulative_us), int(self_us), module.strip()))
+    return entries
+
+
+def measure_import_time(module='app'):
+    """Import `module` in a fresh interpreter with -X importtime and return the parsed timings."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Report import time of the auth service.")
+    parser.add_argument('--module', default='app')
+    parser.add_argument('--top', type=int, default=25)
+    args = parser.parse_args(argv)
+
+    entries = measure_import_time(args.module)
+    total = max((cumulative for cumulative, _, name in entries if name.strip() == args.module), default=0)
+    print(f"Total import time for {args.module}: {total / 1000:.1f} ms")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for cumulative, self_us, name in sorted(entries, reverse=True)[:args.top]:
+        print(f"{cumulative / 1000:14.1f} {self_us / 1000:9.1f}  {name}")
+
+
+if __name__ == '__main__':
+    main()
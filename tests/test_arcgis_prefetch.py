@@ -0,0 +1,80 @@
+import threading
+import unittest
+from unittest.mock import patch
+
+from arcgis_prefetch import ArcgisPrefetcher
+from manage_arcgis_user_groups_helper_functions import prefetch_arcgis_lookups, process_webhook_event
+
+
+class TestPrefetchLookups(unittest.TestCase):
+
+    @patch("manage_arcgis_user_groups_helper_functions.put_arcgis_prefetch")
+    @patch("manage_arcgis_user_groups_helper_functions.get_email_to_user_groups", return_value=None)
+    @patch("manage_arcgis_user_groups_helper_functions.get_user_groups", return_value=['USGS', 'DOI'])
+    @patch("manage_arcgis_user_groups_helper_functions.arcgis_api")
+    def test_resolves_groups_and_user(self, mock_arcgis_api, _, __, mock_put):
+        mock_arcgis_api.get_group_by_title.side_effect = \
+            lambda title: {'id': 'g1', 'title': title, 'owner': 'admin'} if title == 'USGS' else None
+        mock_arcgis_api.get_user_by_email.return_value = None
+        prefetch_arcgis_lookups('jdoe@usgs.gov')
+        mock_put.assert_called_once_with('jdoe@usgs.gov', {
+            'group_titles': ['USGS', 'DOI'],
+            'groups': {'USGS': {'id': 'g1', 'title': 'USGS'}},
+            'user': None,
+        })
+
+
+class TestWebhookUsesPrefetch(unittest.TestCase):
+
+    @patch("webhook_idempotency.put_user_group_assignment")
+    @patch("webhook_idempotency.get_user_group_assignment", return_value=None)
+    @patch("webhook_idempotency.put_webhook_event_if_absent", return_value=True)
+    @patch("manage_arcgis_user_groups_helper_functions.put_username_to_email")
+    @patch("manage_arcgis_user_groups_helper_functions.get_email_to_user_groups", return_value=None)
+    @patch("manage_arcgis_user_groups_helper_functions.get_user_groups", return_value=['USGS', 'DOI'])
+    @patch("manage_arcgis_user_groups_helper_functions.get_arcgis_prefetch",
+           return_value={'groups': {'USGS': {'id': 'g1', 'title': 'USGS'}, 'ARS': {'id': 'g2', 'title': 'ARS'}}})
+    @patch("manage_arcgis_user_groups_helper_functions.get_prefetched_arcgis_user",
+           return_value={'username': 'jdoe', 'email': 'jdoe@usgs.gov'})
+    @patch("manage_arcgis_user_groups_helper_functions.arcgis_api")
+    def test_add_event_skips_prefetched_lookups(self, mock_arcgis_api, *_):
+        mock_arcgis_api.add_user_to_groups.return_value = []
+        process_webhook_event({'operation': 'add', 'source': 'users', 'username': 'jdoe', 'when': 1})
+        mock_arcgis_api.get_user_from_username.assert_not_called()
+        mock_arcgis_api.add_user_to_groups.assert_called_once_with(
+            {'username': 'jdoe', 'email': 'jdoe@usgs.gov'}, ['USGS', 'DOI'],
+            groups={'USGS': {'id': 'g1', 'title': 'USGS'}})
+
+    @patch("webhook_idempotency.put_webhook_event_if_absent", return_value=True)
+    @patch("manage_arcgis_user_groups_helper_functions.put_username_to_email")
+    @patch("manage_arcgis_user_groups_helper_functions.get_prefetched_arcgis_user")
+    @patch("manage_arcgis_user_groups_helper_functions.arcgis_api")
+    def test_update_event_reads_the_portal(self, mock_arcgis_api, mock_prefetched, *_):
+        mock_arcgis_api.get_user_from_username.return_value = {'username': 'jdoe', 'email': 'new@usgs.gov'}
+        process_webhook_event({'operation': 'update', 'source': 'users', 'username': 'jdoe', 'when': 2})
+        mock_prefetched.assert_not_called()
+        mock_arcgis_api.get_user_from_username.assert_called_once_with('jdoe')
+
+
+class TestArcgisPrefetcher(unittest.TestCase):
+
+    def test_runs_in_background_and_skips_queued_email(self):
+        release = threading.Event()
+        calls = []
+        prefetcher = ArcgisPrefetcher(handler=lambda email: release.wait() and calls.append(email),
+                                      max_queue_size=1, workers=1, enabled=True)
+        self.assertTrue(prefetcher.submit('a@usgs.gov'))
+        self.assertFalse(prefetcher.submit('a@usgs.gov'))
+        release.set()
+        prefetcher.join()
+        self.assertEqual(calls, ['a@usgs.gov'])
+        self.assertTrue(prefetcher.submit('a@usgs.gov'))
+        prefetcher.join()
+
+    def test_disabled_prefetcher_does_nothing(self):
+        prefetcher = ArcgisPrefetcher(handler=self.fail, enabled=False)
+        self.assertFalse(prefetcher.submit('a@usgs.gov'))
+
+
+if __name__ == '__main__':
+    unittest.main()
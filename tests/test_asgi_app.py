@@ -0,0 +1,124 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+from urllib.parse import parse_qs, urlparse
+
+import jwt
+from itsdangerous import Signer
+
+from token_generation import OIDC_BINDING_COOKIE
+
+with patch('app.init_resources'):
+    import asgi_app
+
+USERINFO = {'email': 'a@usgs.gov', 'given_name': 'A', 'family_name': 'Usgs'}
+
+
+def http_response(body):
+    response = MagicMock(status_code=200)
+    response.json.return_value = body
+    return response
+
+
+class TestAsyncLoginFlow(unittest.TestCase):
+    """/auth -> /callback -> /arcgis_callback -> /token on the Quart app, with Redis and login.gov mocked."""
+
+    def setUp(self):
+        self.transactions, self.userinfo, self.codes, self.nonces = {}, {}, {}, []
+
+        async def put_transaction(state, transaction):
+            self.transactions[state] = transaction
+            self.nonces.append(transaction['nonce'])
+            return True
+
+        async def put_login_tokens(email, code, access_token, userinfo, refresh_token=None):
+            self.codes[code] = {'access_token': access_token, 'refresh_token': refresh_token}
+
+        async def put_callback_login(email, userinfo, token_data, handle, auth_access):
+            self.userinfo[handle] = userinfo
+
+        async def token_post(url, headers, data):
+            id_token = jwt.encode({'nonce': self.nonces[-1]}, 'a-test-signing-key-of-sufficient-length', algorithm='HS256')
+            return http_response({'access_token': 'idp-token', 'id_token': id_token})
+
+        http_client = MagicMock(post=AsyncMock(side_effect=token_post),
+                                get=AsyncMock(return_value=http_response(dict(USERINFO))))
+        patchers = [
+            patch('token_generation.AUTH', new=MagicMock()),
+            patch('token_generation.generate_jwt_token', return_value='client-assertion'),
+            patch('login_flow.generate_jwt_token', return_value='arcgis-access-token'),
+            patch('login_flow.is_user_org_in_allowed_orgs', return_value=True),
+            patch('login_flow.is_usda_user', return_value=False),
+            patch('userinfo_cookie.signer', Signer('test-secret', salt='userinfo-cookie')),
+            patch('async_routes.construct_idp_token_post', return_value=('https://idp/token', {}, {})),
+            patch('async_routes.construct_idp_userinfo_get', return_value=('https://idp/userinfo', {})),
+            patch('async_routes.async_http_client', new=http_client),
+            patch('async_routes.arcgis_prefetcher', new=MagicMock()),
+            patch('async_routes.put_oidc_transaction', side_effect=put_transaction),
+            patch('async_routes.pop_oidc_transaction', side_effect=self.pop_transaction),
+            patch('async_routes.get_user_record', new=AsyncMock(return_value=None)),
+            patch('async_routes.put_callback_login', side_effect=put_callback_login),
+            patch('async_routes.get_login_userinfo', side_effect=self.get_login_userinfo),
+            patch('async_routes.put_login_tokens', side_effect=put_login_tokens),
+            patch('async_routes.redeem_auth_code', side_effect=self.redeem_auth_code),
+            patch('asgi_app.RATE_LIMIT_ENABLED', False),
+            patch('asgi_app.init_resources'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.app = asgi_app.create_async_app()
+
+    async def pop_transaction(self, state):
+        return self.transactions.pop(state, None)
+
+    async def get_login_userinfo(self, handle):
+        return self.userinfo.get(handle)
+
+    async def redeem_auth_code(self, code):
+        return self.codes.pop(code, None)
+
+    async def login(self, client, bind=True):
+        response = await client.get('/auth', scheme='https')
+        self.assertEqual(response.status_code, 302)
+        state = parse_qs(urlparse(response.headers['Location']).query)['state'][0]
+        if not bind:
+            client.cookie_jar.clear()
+        response = await client.get('/callback', query_string={'code': 'idp-code', 'state': state}, scheme='https')
+        if response.status_code != 302:
+            return response, None
+        # The binding cookie is spent once the callback succeeds
+        self.assertIn(f'{OIDC_BINDING_COOKIE}=;', ' '.join(response.headers.getlist('Set-Cookie')))
+        response = await client.get('/arcgis_callback', scheme='https')
+        self.assertEqual(response.status_code, 302)
+        code = parse_qs(urlparse(response.headers['Location']).query)['code'][0]
+        return response, code
+
+    def test_login_to_token(self):
+        async def run():
+            client = self.app.test_client()
+            _, code = await self.login(client)
+            response = await client.post('/token', form={'code': code}, scheme='https')
+            body = await response.get_json()
+            self.assertEqual((response.status_code, body['access_token']), (200, 'arcgis-access-token'))
+            self.assertIn('refresh_token', body)
+            # The code is single-use
+            response = await client.post('/token', form={'code': code}, scheme='https')
+            self.assertEqual((response.status_code, await response.get_json()), (400, {'error': 'invalid_grant'}))
+
+        asyncio.run(run())
+
+    def test_callback_from_another_browser_is_refused(self):
+        async def run():
+            response, code = await self.login(self.app.test_client(), bind=False)
+            self.assertEqual((response.status_code, code), (400, None))
+
+        asyncio.run(run())
+
+    def test_asgi_dispatch_sends_login_routes_to_quart(self):
+        self.assertEqual(set(asgi_app.ASYNC_ROUTES), {'/auth', '/callback', '/arcgis_callback', '/token', '/userinfo'})
+        self.assertTrue(callable(asgi_app.app))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+from unittest.mock import patch
+
+from benchmarks.registry import SkipCase
+from benchmarks.runner import compare, run
+
+
+class TestBenchmarkCompare(unittest.TestCase):
+
+    def test_regression_past_threshold_is_reported(self):
+        baseline = {'fast': {'min_us': 10.0}, 'slow': {'min_us': 10.0}}
+        results = {'fast': {'min_us': 11.0}, 'slow': {'min_us': 13.0}}
+        self.assertEqual(compare(results, baseline, 0.25), ['slow'])
+
+    def test_new_cases_are_not_regressions(self):
+        self.assertEqual(compare({'new': {'min_us': 5.0}}, {}, 0.25), [])
+
+
+
+class TestBenchmarkRun(unittest.TestCase):
+
+    def test_broken_case_does_not_stop_the_run(self):
+        def broken():
+            raise RuntimeError('no secret')
+
+        def skipped():
+            raise SkipCase('not here')
+
+        cases = {
+            'a.broken': {'setup': broken, 'requires_redis': False},
+            'b.skipped': {'setup': skipped, 'requires_redis': False},
+            'c.fine': {'setup': lambda: (lambda: None), 'requires_redis': False},
+        }
+        with patch.dict('benchmarks.runner.CASES', cases, clear=True), \
+                patch('benchmarks.runner.measure', return_value=([1e-6], 1)):
+            results, errors = run(None, 1)
+        self.assertEqual((list(results), errors), (['c.fine'], ['a.broken']))
+
+
+if __name__ == "__main__":
+    unittest.main()
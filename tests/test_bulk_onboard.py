@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import bulk_onboard
+
+
+class TestBulkOnboard(unittest.TestCase):
+
+    def write(self, suffix, content):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_read_emails_csv_with_header(self):
+        path = self.write('.csv', 'name,email\nJane,jane@usgs.gov\nJohn,john@epa.gov\n')
+        self.assertEqual(list(bulk_onboard.read_emails(path)), ['jane@usgs.gov', 'john@epa.gov'])
+
+    def test_read_emails_csv_without_header(self):
+        path = self.write('.csv', 'jane@usgs.gov\njohn@epa.gov\n')
+        self.assertEqual(list(bulk_onboard.read_emails(path)), ['jane@usgs.gov', 'john@epa.gov'])
+
+    def test_read_emails_jsonl(self):
+        path = self.write('.jsonl', '{"email": "jane@usgs.gov"}\n\n{"email": "john@epa.gov"}\n')
+        self.assertEqual(list(bulk_onboard.read_emails(path)), ['jane@usgs.gov', 'john@epa.gov'])
+
+    @patch("bulk_onboard.arcgis_api.get_user_by_email", return_value={'username': 'jane'})
+    @patch("bulk_onboard.get_email_to_user_groups", return_value={'user_groups': 'ars'})
+    def test_resolve_user_honors_self_selected_group(self, _, __):
+        email, outcome, user, titles = bulk_onboard.resolve_user('jane@usda.gov')
+        self.assertEqual(outcome, 'resolved')
+        self.assertEqual(titles[-1], 'ARS')
+
+    @patch("bulk_onboard.arcgis_api.get_user_by_email")
+    @patch("bulk_onboard.get_email_to_user_groups", return_value=None)
+    def test_resolve_user_outside_allowed_orgs(self, _, mock_get_user):
+        self.assertEqual(bulk_onboard.resolve_user('jane@gmail.com')[1], 'not_in_allowed_orgs')
+        mock_get_user.assert_not_called()
+
+    @patch("bulk_onboard.webhook_idempotency.mark_assignment_satisfied")
+    @patch("bulk_onboard.arcgis_api.add_users_to_group", side_effect=lambda group, usernames, token: ['b'])
+    @patch("bulk_onboard.arcgis_api.get_token", return_value='t')
+    def test_apply_memberships_marks_only_users_in_every_group(self, _, __, mock_mark):
+        resolved = [('a@usgs.gov', 'resolved', {'username': 'a'}, ['USGS']),
+                    ('b@usgs.gov', 'resolved', {'username': 'b'}, ['USGS']),
+                    ('c@usda.gov', 'resolved', {'username': 'c'}, ['USGS', 'Missing'])]
+        groups = {'USGS': {'id': 'g1', 'title': 'USGS'}}
+        batches, not_added = bulk_onboard.apply_memberships(resolved, groups, MagicMock(map=map), False, 10)
+        self.assertEqual((batches, not_added), (1, {'b'}))
+        mock_mark.assert_called_once_with('a', ['USGS'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+
+from flask import Flask
+
+import arcgis_api
+import redis_helpers
+from change_feed import change_feed_blueprint, read_changes, update_change_feed_metrics
+
+CHANGES = [
+    {'id': '1000-0', 'op': 'user.update', 'email': 'a@usgs.gov', 'fields': ['auth_access'],
+     'auth_access': {'is_disallowed': False}},
+    {'id': '1000-1', 'op': 'user.username', 'email': 'a@usgs.gov', 'username': 'a_usgs'},
+]
+
+
+class TestChangeEntries(unittest.TestCase):
+
+    def test_entries_are_flat_strings_and_decode_back(self):
+        entry = redis_helpers.change_entry('group_assignment.put', username='a_usgs', groups=['A', 'B'], email=None)
+        self.assertEqual(entry, {'op': 'group_assignment.put', 'username': 'a_usgs', 'groups': '["A","B"]'})
+        self.assertEqual(redis_helpers.decode_change('1-0', entry)['groups'], ['A', 'B'])
+
+    @patch('redis_helpers.CHANGE_FEED_ENABLED', False)
+    def test_disabled_feed_queues_nothing(self):
+        pipe = MagicMock()
+        redis_helpers.queue_change(pipe, 'user.delete', email='a@usgs.gov')
+        pipe.xadd.assert_not_called()
+
+    @patch('arcgis_api.record_change')
+    @patch('arcgis_api.http_session')
+    def test_add_users_records_only_added_usernames(self, mock_session, mock_record):
+        mock_session.post.return_value.json.return_value = {'notAdded': ['b_usgs']}
+        not_added = arcgis_api.add_users_to_group({'id': 'g1', 'title': 'USGS'}, ['a_usgs', 'b_usgs'], token='t')
+        self.assertEqual(not_added, ['b_usgs'])
+        mock_record.assert_called_once_with('arcgis.add_users', group='USGS', group_id='g1', usernames=['a_usgs'])
+
+
+@patch('change_feed.get_change_feed_bounds', return_value=(2, '1000-0', '1000-1'))
+@patch('change_feed.read_change_feed', return_value=CHANGES)
+class TestReadChanges(unittest.TestCase):
+
+    @patch('change_feed.get_change_feed_offset', return_value='999-0')
+    def test_consumer_resumes_after_its_offset(self, offset, read, bounds):
+        changes, next_offset, truncated = read_changes('audit', count=10)
+        read.assert_called_once_with('999-0', 10)
+        self.assertEqual((next_offset, truncated), ('1000-1', True))
+
+    def test_explicit_offset_and_empty_read(self, read, bounds):
+        read.return_value = []
+        self.assertEqual(read_changes(after='1000-1'), ([], '1000-1', False))
+
+    @patch('user_state.ADMIN_API_TOKEN', 'secret')
+    def test_endpoint_serves_ndjson_with_next_offset(self, read, bounds):
+        app = Flask(__name__)
+        app.register_blueprint(change_feed_blueprint)
+        client = app.test_client()
+        self.assertEqual(client.get('/admin/changes').status_code, 403)
+        headers = {'Authorization': 'Bearer secret'}
+        self.assertEqual(client.get('/admin/changes?after=nope', headers=headers).status_code, 400)
+
+        response = client.get('/admin/changes?after=1000-0&count=5', headers=headers)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['op'] for line in response.get_data(as_text=True).splitlines()],
+                         ['user.update', 'user.username'])
+        self.assertEqual((response.headers['X-Change-Feed-Next'], response.headers['X-Change-Feed-Truncated']),
+                         ('1000-1', 'false'))
+
+        with patch('change_feed.put_change_feed_offset') as mock_commit:
+            response = client.post('/admin/changes/offsets', json={'consumer': 'audit', 'id': '1000-1'},
+                                   headers=headers)
+            self.assertEqual(response.status_code, 200)
+            mock_commit.assert_called_once_with('audit', '1000-1')
+
+
+class TestChangeFeedMetrics(unittest.TestCase):
+
+    @patch('change_feed.get_next_change_ids', return_value=['1000-0', None])
+    @patch('change_feed.get_change_feed_offsets', return_value={'reporting': '999-0', 'audit': '1000-1'})
+    @patch('change_feed.get_change_feed_bounds', return_value=(2, '1000-0', '1000-1'))
+    def test_lag_is_the_age_of_the_oldest_uncommitted_change(self, bounds, offsets, next_ids):
+        result = update_change_feed_metrics(now=61.0)
+        next_ids.assert_called_once_with(['1000-1', '999-0'])
+        self.assertEqual(result, {'length': 2, 'lag_seconds': {'audit': 60.0, 'reporting': 0.0}})
+
+
+if __name__ == '__main__':
+    unittest.main()
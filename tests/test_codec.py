@@ -0,0 +1,68 @@
+import json
+import unittest
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+from flask import Flask, jsonify
+
+import codec
+from codec import CodecJSONProvider, decode, encode
+
+VALUE = {'is_disallowed': False, 'has_selected_group': True, 'groups': ['USDA', 'ARS'], 'count': 3}
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_roundtrip_every_codec(self):
+        for tag in codec.CODECS:
+            encoded = encode(VALUE, codec=tag)
+            self.assertTrue(encoded.startswith(f'{tag}:'))
+            self.assertEqual(decode(encoded), VALUE)
+
+    def test_legacy_untagged_json_is_read(self):
+        self.assertEqual(decode(json.dumps(VALUE)), VALUE)
+        self.assertEqual(decode('"usgs"'), 'usgs')
+        self.assertIsNone(decode(None))
+
+    def test_legacy_writes_during_rollout(self):
+        with patch('codec.WRITE_CODEC', None):
+            self.assertEqual(encode(VALUE), json.dumps(VALUE))
+
+    def test_unknown_codec_falls_back(self):
+        self.assertIn(codec._select_write_codec('msgpack'), codec.CODECS)
+
+
+class TestCodecJSONProvider(unittest.TestCase):
+
+    def test_jsonify_uses_provider(self):
+        app = Flask(__name__)
+        app.json = CodecJSONProvider(app)
+        with app.test_request_context():
+            response = jsonify(VALUE)
+        self.assertEqual(json.loads(response.data), VALUE)
+        self.assertEqual(app.json.loads(app.json.dumps(VALUE)), VALUE)
+
+    def test_jsonify_output_matches_default_provider(self):
+        value = {**VALUE, 'when': datetime(2025, 1, 2, tzinfo=timezone.utc), 'é': 'ü'}
+        for debug in (False, True):
+            app = Flask(__name__)
+            app.debug = debug
+            with app.test_request_context():
+                expected = json.loads(jsonify(value).data)
+            app.json = CodecJSONProvider(app)
+            with app.test_request_context(), patch('codec.orjson.dumps', wraps=codec.orjson.dumps) as mock_dumps:
+                response = jsonify(value)
+            mock_dumps.assert_called_once()
+            self.assertEqual(json.loads(response.data), expected)
+            self.assertEqual(b'\n  "' in response.data, debug)
+            self.assertLess(response.data.index(b'count'), response.data.index(b'groups'))
+
+    def test_unsupported_arguments_fall_back_to_stdlib(self):
+        provider = CodecJSONProvider(Flask(__name__))
+        with patch('codec.orjson.dumps') as mock_dumps:
+            self.assertEqual(provider.dumps([1, 2], indent=4), json.dumps([1, 2], indent=4))
+        mock_dumps.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
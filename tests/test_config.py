@@ -0,0 +1,44 @@
+import unittest
+from unittest.mock import patch, MagicMock
+
+from config import LazyResource
+
+
+class TestLazyResource(unittest.TestCase):
+
+    def test_factory_not_called_until_used(self):
+        """Ensure the wrapped object is only built on first attribute access"""
+        factory = MagicMock(__name__='factory')
+        resource = LazyResource(factory)
+        factory.assert_not_called()
+        resource.ping()
+        resource.ping()
+        factory.assert_called_once()
+
+    def test_rebuilt_in_new_process(self):
+        """Ensure a per-process resource is rebuilt after the pid changes (fork)"""
+        factory = MagicMock(__name__='factory', side_effect=[MagicMock(), MagicMock()])
+        resource = LazyResource(factory, per_process=True)
+        with patch("config.os.getpid", return_value=100):
+            first = resource._resolve()
+        with patch("config.os.getpid", return_value=200):
+            second = resource._resolve()
+        self.assertIsNot(first, second)
+        self.assertEqual(factory.call_count, 2)
+
+    def test_patching_proxied_attribute(self):
+        """Ensure attributes such as redis_client.get can still be patched"""
+        resource = LazyResource(MagicMock(__name__='factory'))
+        with patch.object(resource, "get", return_value="value"):
+            self.assertEqual(resource.get("key"), "value")
+
+    def test_isinstance_without_building(self):
+        """Ensure isinstance checks (e.g. Flask-Session's Redis check) see the wrapped type"""
+        factory = MagicMock(__name__='factory')
+        resource = LazyResource(factory, cls=dict)
+        self.assertIsInstance(resource, dict)
+        factory.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import redis
+
+import redis_helpers
+from degraded_mode import RecentCache, WriteBehindBuffer, recent_cache, write_buffer, write_or_buffer
+from redis_breaker import CircuitBreaker, RedisUnavailable, _guarded
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=3, window_seconds=10, cooldown_seconds=5)
+        self.transitions = []
+        self.breaker.add_listener(lambda old, new: self.transitions.append(new))
+
+    def fail(self):
+        def timeout():
+            raise redis.TimeoutError('timed out')
+        with self.assertRaises(redis.TimeoutError):
+            _guarded(self.breaker, timeout)
+
+    @patch('redis_breaker.time.monotonic')
+    def test_trips_fails_fast_and_recovers_after_probe(self, monotonic):
+        monotonic.return_value = 100
+        for _ in range(3):
+            self.fail()
+        self.assertEqual(self.transitions, ['open'])
+
+        command = MagicMock(return_value='PONG')
+        with self.assertRaises(RedisUnavailable):
+            _guarded(self.breaker, command)
+        command.assert_not_called()
+
+        monotonic.return_value = 106
+        self.assertEqual(_guarded(self.breaker, command), 'PONG')
+        self.assertEqual(self.transitions, ['open', 'half_open', 'closed'])
+        self.assertFalse(self.breaker.is_open)
+
+    @patch('redis_breaker.time.monotonic')
+    def test_failed_probe_reopens(self, monotonic):
+        monotonic.return_value = 100
+        for _ in range(3):
+            self.fail()
+        monotonic.return_value = 106
+        self.fail()
+        self.assertEqual(self.transitions, ['open', 'half_open', 'open'])
+        with self.assertRaises(RedisUnavailable):
+            _guarded(self.breaker, MagicMock())
+
+    @patch('redis_breaker.time.monotonic')
+    def test_failures_outside_window_do_not_trip(self, monotonic):
+        for now in (100, 111, 122):
+            monotonic.return_value = now
+            self.fail()
+        self.assertEqual(self.transitions, [])
+
+    def test_command_errors_do_not_count(self):
+        def wrong_type():
+            raise redis.ResponseError('WRONGTYPE')
+        for _ in range(5):
+            with self.assertRaises(redis.ResponseError):
+                _guarded(self.breaker, wrong_type)
+        self.assertFalse(self.breaker.is_open)
+
+
+class TestRecentCache(unittest.TestCase):
+
+    @patch('degraded_mode.time.monotonic', return_value=100)
+    def test_bounded_and_expiring(self, monotonic):
+        cache = RecentCache(maxsize=2, ttl=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        monotonic.return_value = 161
+        self.assertIsNone(cache.get('a'))
+
+
+class TestDegradedReadsAndWrites(unittest.TestCase):
+
+    def setUp(self):
+        recent_cache.clear()
+        write_buffer.clear()
+        self.addCleanup(recent_cache.clear)
+        self.addCleanup(write_buffer.clear)
+
+    @patch('degraded_mode.redis_degraded', return_value=True)
+    @patch('redis_helpers.redis_get', return_value=None)
+    def test_userinfo_served_from_cache_while_degraded(self, redis_get, degraded):
+        recent_cache.put('access-token-to-userinfo:t1', {'access_token': 't1', 'userinfo': {'email': 'a@usda.gov'}})
+        response = redis_helpers.get_access_token_to_userinfo('t1')
+        self.assertEqual(response['userinfo'], {'email': 'a@usda.gov'})
+        self.assertIsNone(redis_helpers.get_access_token_to_userinfo('unknown'))
+
+    @patch('degraded_mode.redis_degraded', return_value=False)
+    @patch('redis_helpers.redis_get', return_value=None)
+    def test_cache_not_used_while_healthy(self, redis_get, degraded):
+        recent_cache.put('access-token-to-userinfo:t1', {'access_token': 't1', 'userinfo': {}})
+        self.assertIsNone(redis_helpers.get_access_token_to_userinfo('t1'))
+        # Redis no longer has it, so neither does the cache
+        self.assertIsNone(recent_cache.get('access-token-to-userinfo:t1'))
+
+    @patch('degraded_mode.redis_degraded', return_value=False)
+    @patch('redis_helpers.redis_get', return_value={'auth_code': 'c1', 'access_token': 't1'})
+    def test_reads_are_not_cached(self, redis_get, degraded):
+        redis_helpers.get_auth_code_to_access_token('c1')
+        self.assertIsNone(recent_cache.get('auth-code-to-access-token:c1'))
+
+    @patch('redis_helpers.redis_client')
+    def test_deleted_user_is_evicted(self, redis):
+        recent_cache.put('access-token-to-userinfo:t1', {'access_token': 't1', 'userinfo': {}})
+        recent_cache.put('access-token-to-userinfo:t2', {'access_token': 't2', 'userinfo': {}})
+        pipe = MagicMock()
+        pipe.smembers.return_value = {'access-token-to-userinfo:t1'}
+        redis.transaction.side_effect = lambda func, *watches: func(pipe)
+        redis_helpers.delete_user_record('a@usda.gov')
+        self.assertIsNone(recent_cache.get('access-token-to-userinfo:t1'))
+        self.assertIsNotNone(recent_cache.get('access-token-to-userinfo:t2'))
+
+    @patch('degraded_mode.redis_degraded', return_value=False)
+    def test_failed_write_is_buffered_and_flushed_in_order(self, degraded):
+        written = []
+        down = [True]
+
+        def write(value):
+            if down[0]:
+                raise redis.ConnectionError('connection refused')
+            written.append(value)
+
+        write_or_buffer('first', write, 1)
+        write_or_buffer('second', write, 2)
+        self.assertEqual(len(write_buffer), 2)
+        down[0] = False
+        write_or_buffer('third', write, 3)
+        self.assertEqual(written, [3, 1, 2])
+        self.assertEqual(len(write_buffer), 0)
+
+    @patch('degraded_mode.redis_degraded', return_value=True)
+    def test_writes_skip_redis_while_degraded(self, degraded):
+        write = MagicMock()
+        write_or_buffer('login', write, 'x')
+        write.assert_not_called()
+        self.assertEqual(write_buffer.flush(), 1)
+        write.assert_called_once_with('x')
+
+    def test_full_buffer_drops_oldest(self):
+        buffer = WriteBehindBuffer(maxsize=2)
+        written = []
+        for value in (1, 2, 3):
+            buffer.add(str(value), written.append, (value,))
+        buffer.flush()
+        self.assertEqual(written, [2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+from email_policy import DomainSuffixIndex, EmailPolicy
+
+
+class TestDomainSuffixIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = DomainSuffixIndex([('usda.gov', 'usda'), ('usgs.gov', 'usgs'), ('contractor.usgs.gov', 'contractor')])
+
+    def test_exact_and_subdomain_match(self):
+        self.assertEqual(self.index.lookup('usda.gov'), 'usda')
+        self.assertEqual(self.index.lookup('fs.usda.gov'), 'usda')
+
+    def test_partial_label_does_not_match(self):
+        """Ensure notusda.gov is not treated as usda.gov"""
+        self.assertIsNone(self.index.lookup('notusda.gov'))
+
+    def test_most_specific_rule_wins(self):
+        self.assertEqual(self.index.lookup('region1.contractor.usgs.gov'), 'contractor')
+        self.assertEqual(self.index.lookup('water.usgs.gov'), 'usgs')
+
+
+class TestEmailPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = EmailPolicy(
+            {'usda.gov': 'usda', 'doi.gov': 'doi'},
+            ['special_user@ios.doi.gov'],
+            ['usda.gov', 'contractor.usgs.gov'],
+        )
+
+    def test_get_org(self):
+        self.assertEqual(self.policy.get_org('user@ios.doi.gov'), 'doi')
+        self.assertEqual(self.policy.get_org('User@USDA.GOV'), 'usda')
+        self.assertIsNone(self.policy.get_org('user@invalid'))
+        self.assertIsNone(self.policy.get_org('not-an-email'))
+
+    def test_bypass_users_and_domains(self):
+        self.assertTrue(self.policy.is_bypass('special_user@ios.doi.gov'))
+        self.assertTrue(self.policy.is_bypass('user@contractor.usgs.gov'))
+        self.assertTrue(self.policy.is_bypass('user@fs.usda.gov'))
+        self.assertFalse(self.policy.is_bypass('user@notusda.gov'))
+        self.assertFalse(self.policy.is_bypass('other_user@ios.doi.gov'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import async_redis_helpers
+import login_flow
+from login_flow import NEW_USER_AUTH_ACCESS, callback_decision, should_prefetch
+
+RETURN_TO = 'https://auth.example.gov/arcgis_callback'
+
+
+def usgs_userinfo():
+    return {'email': 'a@usgs.gov', 'given_name': 'A', 'family_name': 'Usgs'}
+
+
+def usda_userinfo():
+    return {'email': 'b@usda.gov', 'given_name': 'B', 'family_name': 'Usda'}
+
+
+@patch('login_flow.is_user_org_in_allowed_orgs', side_effect=lambda email: email.endswith('@usgs.gov'))
+@patch('login_flow.is_usda_user', side_effect=lambda email: email.endswith('@usda.gov'))
+class TestCallbackDecision(unittest.TestCase):
+
+    def test_new_allowed_user_gets_auth_access(self, usda, allowed):
+        self.assertEqual(callback_decision(usgs_userinfo(), None, RETURN_TO), (RETURN_TO, True, NEW_USER_AUTH_ACCESS))
+
+    def test_returning_user_keeps_stored_auth_access(self, usda, allowed):
+        record = {'email': 'a@usgs.gov', 'auth_access': {'is_disallowed': False}}
+        self.assertEqual(callback_decision(usgs_userinfo(), record, RETURN_TO), (RETURN_TO, True, None))
+
+    def test_user_outside_allowed_orgs(self, usda, allowed):
+        userinfo = {'email': 'c@example.com', 'given_name': 'C', 'family_name': 'Example'}
+        self.assertEqual(callback_decision(userinfo, None, RETURN_TO),
+                         (login_flow.USER_NOT_IN_ALLOWED_AGENCY_URL, False, None))
+
+    def test_usda_user_without_group_selects_one(self, usda, allowed):
+        location, set_cookie, auth_access = callback_decision(usda_userinfo(), None, RETURN_TO)
+        self.assertTrue(location.startswith(login_flow.SELF_SELECT_GROUP_FORM_URL))
+        self.assertIn('email=b@usda.gov&firstname=B&lastname=Usda', location)
+        self.assertEqual((set_cookie, auth_access), (True, None))
+
+    def test_disallowed_usda_user_may_reselect(self, usda, allowed):
+        record = {'email': 'b@usda.gov', 'user_groups': 'ars',
+                  'auth_access': {'is_disallowed': True, 'disallowed_selected_group': 'ars'}}
+        location, set_cookie, auth_access = callback_decision(usda_userinfo(), record, RETURN_TO)
+        self.assertTrue(location.startswith(login_flow.SELF_SELECT_GROUP_FORM_URL))
+        self.assertEqual(auth_access, NEW_USER_AUTH_ACCESS)
+
+    def test_disallowed_usda_user_without_groups_is_turned_away(self, usda, allowed):
+        record = {'email': 'b@usda.gov', 'auth_access': {'is_disallowed': True, 'disallowed_selected_group': 'ars'}}
+        self.assertEqual(callback_decision(usda_userinfo(), record, RETURN_TO),
+                         (login_flow.USER_NOT_IN_ALLOWED_AGENCY_URL, False, None))
+
+    def test_prefetch_only_for_users_without_username(self, usda, allowed):
+        self.assertTrue(should_prefetch('a@usgs.gov', None))
+        self.assertFalse(should_prefetch('a@usgs.gov', {'username': 'a_usgs'}))
+        self.assertFalse(should_prefetch('c@example.com', None))
+
+
+@patch('async_redis_helpers.redis_degraded', return_value=False)
+@patch('async_redis_helpers.async_redis_client', new_callable=MagicMock)
+class TestAsyncCallbackWrites(unittest.TestCase):
+
+    def test_callback_writes_in_one_transaction(self, mock_client, degraded):
+        pipe = MagicMock(execute=AsyncMock())
+        mock_client.pipeline.return_value = pipe
+        userinfo = usgs_userinfo()
+        asyncio.run(async_redis_helpers.put_callback_login(
+            'a@usgs.gov', userinfo, {'access_token': 'idp-token'}, 'handle', NEW_USER_AUTH_ACCESS))
+
+        mock_client.pipeline.assert_called_once_with(transaction=True)
+        pipe.execute.assert_awaited_once()
+        record = pipe.hset.call_args_list[0].kwargs['mapping']
+        self.assertIn('auth_access', record)
+        self.assertEqual([call.args[0] for call in pipe.setex.call_args_list],
+                         ['access_token:idp-token', 'login-userinfo:handle'])
+        self.assertEqual(async_redis_helpers.recent_cache.get('login-userinfo:handle'), userinfo)
+
+    @patch('async_redis_helpers.write_buffer')
+    def test_unavailable_redis_buffers_the_write(self, mock_buffer, mock_client, degraded):
+        mock_client.pipeline.return_value = MagicMock(execute=AsyncMock(side_effect=ConnectionError()))
+        with patch('async_redis_helpers.UNAVAILABLE_ERRORS', (ConnectionError,)):
+            asyncio.run(async_redis_helpers.put_login_userinfo('handle', usgs_userinfo()))
+        description, replay, (queue, args) = mock_buffer.add.call_args.args
+        self.assertEqual((description, replay, queue), ('put_login_userinfo handle', async_redis_helpers._replay,
+                                                       async_redis_helpers.queue_login_userinfo))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+
+from flask import Flask
+
+from metrics import init_metrics, key_family, observe_outbound
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        @self.app.route('/ping/<name>')
+        def ping(name):
+            with observe_outbound('arcgis', 'ping'):
+                return 'pong'
+
+        init_metrics(self.app)
+        self.client = self.app.test_client()
+
+    def test_key_family(self):
+        self.assertEqual(key_family('user-auth-access:jdoe@usgs.gov'), 'user-auth-access')
+        self.assertEqual(key_family('arcgis_groups'), 'arcgis_groups')
+
+    def test_metrics_endpoint_reports_route_template(self):
+        """Ensure requests are labeled by route rule rather than the raw path"""
+        self.client.get('/ping/abc')
+        body = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="/ping/<name>",status="200"}', body)
+        self.assertIn('outbound_request_duration_seconds_count{dependency="arcgis",operation="ping",outcome="ok"}', body)
+        self.assertIn('http_requests_in_flight', body)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+from unittest.mock import MagicMock, patch
+from urllib.parse import parse_qs, urlparse
+
+import jwt
+from flask import Flask
+
+import redis_helpers
+import token_generation
+from codec import encode
+
+
+class TestOidcTransaction(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.store = {}
+        put = patch('token_generation.put_oidc_transaction',
+                    side_effect=lambda state, transaction: self.store.__setitem__(state, transaction) or True)
+        sign = patch('token_generation.generate_jwt_token', return_value='client-assertion')
+        auth = patch('token_generation.AUTH', new=MagicMock())
+        for patcher in (put, sign, auth):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def authorize(self, return_to=None):
+        with self.app.test_request_context():
+            self.response = token_generation.get_auth_code_from_idp(return_to)
+        return {k: v[0] for k, v in parse_qs(urlparse(self.response.headers['Location']).query).items()}
+
+    def test_each_login_gets_its_own_state_and_nonce(self):
+        first, second = self.authorize(), self.authorize()
+        self.assertNotEqual(first['state'], second['state'])
+        self.assertNotEqual(first['nonce'], second['nonce'])
+        self.assertEqual(self.store[first['state']]['nonce'], first['nonce'])
+        self.assertEqual(self.store[first['state']]['return_to'], token_generation.ARCGIS_LOGIN_CALLBACK_URL)
+
+    def test_state_is_bound_to_the_browser(self):
+        state = self.authorize()['state']
+        cookie = self.response.headers['Set-Cookie']
+        self.assertTrue(cookie.startswith(f'{token_generation.OIDC_BINDING_COOKIE}='))
+        for attribute in ('HttpOnly', 'Secure', 'Path=/callback', 'SameSite=Lax'):
+            self.assertIn(attribute, cookie)
+        binding = cookie.split(';', 1)[0].split('=', 1)[1]
+        transaction = self.store[state]
+        self.assertNotIn(binding, str(transaction))
+        self.assertTrue(token_generation.oidc_binding_matches(transaction, binding))
+        # A state started in another browser (login CSRF) or without the cookie is refused
+        self.assertFalse(token_generation.oidc_binding_matches(transaction, binding + 'x'))
+        self.assertFalse(token_generation.oidc_binding_matches(transaction, None))
+        self.assertFalse(token_generation.oidc_binding_matches({'nonce': 'n1'}, binding))
+
+    def test_unstored_transaction_is_a_503(self):
+        with patch('token_generation.put_oidc_transaction', return_value=False), self.app.test_request_context():
+            self.assertEqual(token_generation.get_auth_code_from_idp()[1], 503)
+
+    def test_nonce_is_checked_against_the_id_token(self):
+        def token_response(nonce):
+            response = MagicMock(status_code=200)
+            response.json.return_value = {'access_token': 'at', 'id_token': jwt.encode(
+                {'nonce': nonce}, 'a-test-signing-key-of-sufficient-length', algorithm='HS256')}
+            return response
+
+        with patch('token_generation.redis_client'):
+            self.assertEqual(token_generation.handle_idp_token_response(token_response('n1'), nonce='n1'), 'at')
+            self.assertEqual(token_generation.handle_idp_token_response(token_response('n2'), nonce='n1')[1], 400)
+        self.assertIsNone(token_generation.id_token_nonce('not-a-jwt'))
+
+
+class TestPopOidcTransaction(unittest.TestCase):
+
+    @patch('redis_helpers.redis_client')
+    def test_transaction_is_consumed_in_one_command(self, redis):
+        redis.getdel.side_effect = [encode({'nonce': 'n1'}), None]
+        self.assertEqual(redis_helpers.pop_oidc_transaction('s1'), {'nonce': 'n1'})
+        self.assertIsNone(redis_helpers.pop_oidc_transaction('s1'))
+        redis.getdel.assert_called_with('oidc-transaction:s1')
+        redis.get.assert_not_called()
+
+    @patch('redis_helpers.redis_client')
+    def test_failed_write_is_reported(self, redis):
+        redis.setex.side_effect = ConnectionError()
+        self.assertFalse(redis_helpers.put_oidc_transaction('s1', {'nonce': 'n1'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import json
+import os
+import tempfile
+import unittest
+
+from org_hierarchy import OrgHierarchy, compile_hierarchy
+from reloadable_config import ReloadableConfig
+
+GROUPS = ['usda', 'doi', 'usgs', 'fws', 'census', 'all_government']
+PARENT_GROUPS = {
+    'all_government': ['usda', 'doi', 'doc'],
+    'usda': ['usgs', 'fws'],
+    'doi': ['usgs', 'fws'],
+    'doc': ['census'],
+}
+PROPER_GROUP_NAMES = {'usda': 'USDA', 'doi': 'DOI', 'usgs': 'USGS', 'fws': 'FWS', 'doc': 'DOC',
+                      'census': 'Census', 'all_government': 'All_Government'}
+
+
+class TestOrgHierarchy(unittest.TestCase):
+
+    def setUp(self):
+        self.hierarchy = OrgHierarchy(GROUPS, PARENT_GROUPS, PROPER_GROUP_NAMES)
+
+    def test_child_with_multiple_parents_gets_all_ancestors(self):
+        """Ensure usgs resolves to both usda and doi, nearest ancestors first"""
+        self.assertEqual(self.hierarchy.get_parent_groups('usgs'), ['usda', 'doi', 'all_government'])
+        self.assertEqual(self.hierarchy.get_group_titles('usgs'), ['USDA', 'DOI', 'All_Government', 'USGS'])
+
+    def test_non_assignable_ancestor_is_not_traversed(self):
+        """Ensure doc, which is not an assignable group, stops the walk as before"""
+        self.assertEqual(self.hierarchy.get_group_titles('census'), ['Census'])
+
+    def test_unknown_org(self):
+        self.assertEqual(self.hierarchy.get_group_titles('unknown'), [None])
+
+    def test_cycle_is_rejected(self):
+        with self.assertRaises(ValueError):
+            OrgHierarchy(['a', 'b'], {'a': ['b'], 'b': ['a']}, {})
+
+
+class TestReloadableConfig(unittest.TestCase):
+
+    def test_reloads_changed_file_and_keeps_last_good(self):
+        raw = {'groups': GROUPS, 'parent_groups': PARENT_GROUPS, 'proper_group_names': PROPER_GROUP_NAMES}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'org_hierarchy.json')
+            config = ReloadableConfig(path, compile_hierarchy, default=raw, check_interval=0)
+            self.assertEqual(config.get().get_group_titles('fws'), ['USDA', 'DOI', 'All_Government', 'FWS'])
+
+            with open(path, 'w') as f:
+                json.dump(dict(raw, parent_groups={'doi': ['fws']}), f)
+            self.assertEqual(config.get().get_group_titles('fws'), ['DOI', 'FWS'])
+
+            with open(path, 'w') as f:
+                json.dump(dict(raw, parent_groups={'doi': ['fws'], 'fws': ['doi']}), f)
+            os.utime(path, (1, 1))
+            self.assertEqual(config.get().get_group_titles('fws'), ['DOI', 'FWS'])
+
+
+if __name__ == "__main__":
+    unittest.main()
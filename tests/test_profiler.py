@@ -0,0 +1,78 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from flask import Flask
+
+import profiler
+from profiler import RequestSampler, init_profiler, to_collapsed
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class TestRequestSampler(unittest.TestCase):
+
+    def test_samples_the_calling_thread(self):
+        sampler = RequestSampler(interval_ms=1)
+        sampler.start()
+        busy_wait(0.1)
+        sampler.stop()
+        self.assertGreater(sum(sampler.samples.values()), 10)
+        self.assertTrue(any('busy_wait' in frame for stack in sampler.samples for frame in stack))
+
+        profile = sampler.to_speedscope('test')
+        self.assertEqual(profile['profiles'][0]['type'], 'sampled')
+        self.assertIn('busy_wait', to_collapsed(profile))
+
+
+class TestProfilerHooks(unittest.TestCase):
+
+    def create_app(self):
+        app = Flask(__name__)
+
+        @app.route('/slow')
+        def slow():
+            busy_wait(0.05)
+            return 'ok'
+
+        init_profiler(app)
+        return app
+
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        for name, value in (('PROFILER_DIR', self.profile_dir), ('PROFILER_TOKEN', 'secret')):
+            patcher = patch(f'profiler.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_token_header_profiles_request(self):
+        client = self.create_app().test_client()
+        response = client.get('/slow', headers={'X-Profile': 'secret'})
+        profile_id = response.headers['X-Profile-Id']
+        self.assertTrue(os.path.exists(os.path.join(self.profile_dir, profile_id + profiler.PROFILE_SUFFIX)))
+
+        listing = client.get('/admin/profiles', headers={'X-Profile': 'secret'}).get_json()
+        self.assertEqual(listing[0]['route'], '/slow')
+        collapsed = client.get(f'/admin/profiles/{profile_id}?format=collapsed', headers={'X-Profile': 'secret'})
+        self.assertIn(b'slow', collapsed.data)
+
+    def test_requests_without_token_are_not_profiled(self):
+        client = self.create_app().test_client()
+        self.assertNotIn('X-Profile-Id', client.get('/slow', headers={'X-Profile': 'wrong'}).headers)
+        self.assertEqual(client.get('/admin/profiles').status_code, 403)
+
+    def test_disabled_registers_nothing(self):
+        with patch('profiler.PROFILER_TOKEN', None), patch('profiler.PROFILER_ENABLED', False):
+            app = self.create_app()
+        self.assertNotIn('profiler', app.blueprints)
+        self.assertEqual(app.before_request_funcs, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
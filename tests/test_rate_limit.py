@@ -0,0 +1,57 @@
+import unittest
+from unittest.mock import patch
+
+from flask import Flask
+
+from rate_limit import check_rate_limit, parse_limit, route_buckets
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def setUp(self):
+        app = Flask(__name__)
+
+        @app.route('/auth')
+        def auth():
+            return 'signed'
+
+        @app.route('/userinfo')
+        def userinfo():
+            return 'ok'
+
+        app.before_request(check_rate_limit)
+        self.client = app.test_client()
+
+    def test_parse_limit(self):
+        self.assertEqual(parse_limit('30/60'), (30.0, 0.5))
+        self.assertIsNone(parse_limit(''))
+
+    def test_buckets_per_ip_and_global(self):
+        buckets, scopes = route_buckets('/auth', '10.0.0.1')
+        self.assertEqual([key for key, _, _ in buckets], ['rate-limit:auth:ip:10.0.0.1', 'rate-limit:auth:global'])
+        self.assertEqual(scopes, ['ip', 'global'])
+
+    @patch('rate_limit.take_rate_limit_tokens', return_value=(False, 2500, [0.2, 40.0]))
+    def test_rejection_skips_view_and_sets_retry_after(self, mock_take):
+        response = self.client.get('/auth', headers={'X-Forwarded-For': '1.2.3.4, 10.0.0.7'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '3')
+        # Only the address appended by the trusted ingress is used
+        self.assertEqual(mock_take.call_args.args[0][0][0], 'rate-limit:auth:ip:10.0.0.7')
+
+    @patch('rate_limit.take_rate_limit_tokens', return_value=(True, 0, [29.0, 2999.0]))
+    def test_allowed(self, _):
+        self.assertEqual(self.client.get('/auth').data, b'signed')
+
+    @patch('rate_limit.take_rate_limit_tokens', side_effect=ConnectionError)
+    def test_fails_open(self, _):
+        self.assertEqual(self.client.get('/auth').status_code, 200)
+
+    @patch('rate_limit.take_rate_limit_tokens')
+    def test_unlimited_routes_do_not_touch_redis(self, mock_take):
+        self.client.get('/userinfo')
+        mock_take.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
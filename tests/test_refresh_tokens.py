@@ -0,0 +1,118 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import fakeredis
+from flask import Flask
+
+import redis_helpers
+from routes import routes_blueprint
+from token_generation import generate_refresh_token
+
+
+class TestRefreshTokenGrant(unittest.TestCase):
+
+    def setUp(self):
+        app = Flask(__name__)
+        app.register_blueprint(routes_blueprint)
+        self.client = app.test_client()
+        sign = patch('login_flow.generate_jwt_token', return_value='renewed-access-token')
+        sign.start()
+        self.addCleanup(sign.stop)
+
+    @patch('routes.redeem_auth_code', side_effect=[{'access_token': 't1', 'refresh_token': 'fam.secret'}, None])
+    def test_code_grant_returns_the_refresh_token_once(self, mock_redeem):
+        body = self.client.post('/token', data={'code': 'c1'}).get_json()
+        self.assertEqual((body['access_token'], body['refresh_token']), ('t1', 'fam.secret'))
+        response = self.client.post('/token', data={'code': 'c1'})
+        self.assertEqual((response.status_code, response.get_json()), (400, {'error': 'invalid_grant'}))
+        mock_redeem.assert_called_with('c1')
+
+    @patch('routes.redeem_auth_code')
+    def test_missing_code_is_invalid_grant(self, mock_redeem):
+        response = self.client.post('/token', data={})
+        self.assertEqual((response.status_code, response.get_json()), (400, {'error': 'invalid_grant'}))
+        mock_redeem.assert_not_called()
+
+    @patch('routes.rotate_refresh_token', return_value=('ok', 'a@usgs.gov'))
+    def test_refresh_rotates_within_the_family(self, mock_rotate):
+        response = self.client.post('/token', data={'grant_type': 'refresh_token', 'refresh_token': 'fam.secret'})
+        body = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body['access_token'], 'renewed-access-token')
+        self.assertTrue(body['refresh_token'].startswith('fam.'))
+        self.assertNotEqual(body['refresh_token'], 'fam.secret')
+        mock_rotate.assert_called_once_with('fam.secret', body['refresh_token'], 'renewed-access-token', 3600)
+
+    @patch('routes.rotate_refresh_token', return_value=('reused', 'a@usgs.gov'))
+    def test_reused_token_is_rejected(self, _):
+        response = self.client.post('/token', data={'grant_type': 'refresh_token', 'refresh_token': 'fam.old'})
+        self.assertEqual((response.status_code, response.get_json()), (400, {'error': 'invalid_grant'}))
+
+    @patch('routes.rotate_refresh_token')
+    def test_malformed_token_never_reaches_redis(self, mock_rotate):
+        response = self.client.post('/token', data={'grant_type': 'refresh_token', 'refresh_token': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+        mock_rotate.assert_not_called()
+
+
+@patch('redis_helpers.redis_client')
+class TestRefreshTokenStorage(unittest.TestCase):
+
+    def test_login_stores_only_the_digest(self, mock_client):
+        token = generate_refresh_token()
+        family, secret = redis_helpers.split_refresh_token(token)
+        redis_helpers.put_login_tokens('a@usgs.gov', 'c1', 't1', {'email': 'a@usgs.gov'}, refresh_token=token)
+        pipe = mock_client.pipeline.return_value
+        family_item = pipe.hset.call_args_list[2].kwargs['mapping']
+        self.assertEqual(family_item['current'], redis_helpers.refresh_token_digest(secret))
+        self.assertNotIn(secret, str(family_item))
+        pipe.expire.assert_any_call(f'refresh-token:{family}', redis_helpers.REFRESH_TOKEN_TTL_SECONDS)
+        self.assertIn(f'refresh-token:{family}', pipe.sadd.call_args.args)
+
+    def test_code_is_read_and_deleted_in_one_transaction(self, mock_client):
+        pipe = mock_client.pipeline.return_value
+        pipe.execute.return_value = [{'access_token': 't1', 'refresh_token': 'fam.secret'}, 1]
+        self.assertEqual(redis_helpers.redeem_auth_code('c1')['refresh_token'], 'fam.secret')
+        mock_client.pipeline.assert_called_once_with(transaction=True)
+        pipe.hgetall.assert_called_once_with('auth-code-to-access-token:c1')
+        pipe.delete.assert_called_once_with('auth-code-to-access-token:c1')
+        pipe.execute.return_value = [{}, 0]
+        self.assertIsNone(redis_helpers.redeem_auth_code('c1'))
+
+    def test_code_record_expires(self, mock_client):
+        redis_helpers.put_login_tokens('a@usgs.gov', 'c1', 't1', {'email': 'a@usgs.gov'}, refresh_token='fam.secret')
+        mock_client.pipeline.return_value.expire.assert_any_call(
+            'auth-code-to-access-token:c1', redis_helpers.AUTH_CODE_TTL_SECONDS)
+
+    def test_rotation_must_stay_in_the_family(self, mock_client):
+        with patch('redis_helpers._script') as mock_script:
+            self.assertEqual(redis_helpers.rotate_refresh_token('fam.a', 'other.b', 't2', 60), ('invalid', None))
+            mock_script.assert_not_called()
+            mock_script.return_value = MagicMock(return_value=['reused', 'a@usgs.gov'])
+            self.assertEqual(redis_helpers.rotate_refresh_token('fam.a', 'fam.b', 't2', 60), ('reused', 'a@usgs.gov'))
+            args = mock_script.return_value.call_args.kwargs['args']
+            self.assertEqual(args[:2], [redis_helpers.refresh_token_digest('a'), redis_helpers.refresh_token_digest('b')])
+
+
+class TestRefreshedTokenRevocation(unittest.TestCase):
+    """Runs the rotation script for real, so the index it writes is the one account deletion reads."""
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        for patcher in (patch('redis_helpers.redis_client', self.redis), patch.dict(redis_helpers._scripts, clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_deleting_the_user_revokes_a_refreshed_token(self):
+        token = generate_refresh_token()
+        family, _ = redis_helpers.split_refresh_token(token)
+        redis_helpers.put_login_tokens('a@usgs.gov', 'c1', 't1', {'email': 'a@usgs.gov'}, refresh_token=token)
+        self.assertEqual(redis_helpers.rotate_refresh_token(token, f'{family}.next', 't2', 60), ('ok', 'a@usgs.gov'))
+        self.assertIn('access-token-to-userinfo:t2', self.redis.smembers('user-tokens:a@usgs.gov'))
+        redis_helpers.delete_user_record('a@usgs.gov')
+        self.assertFalse(self.redis.exists('access-token-to-userinfo:t2'))
+        self.assertIsNone(redis_helpers.get_access_token_to_userinfo('t2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
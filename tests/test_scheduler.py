@@ -0,0 +1,95 @@
+import threading
+import unittest
+from unittest.mock import patch
+
+import arcgis_api
+from scheduler import Job, Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.jobs_state = {}
+        self.recorded = []
+        patches = {
+            'hold_scheduler_lease': patch('scheduler.hold_scheduler_lease', return_value=True),
+            'get_scheduler_job': patch('scheduler.get_scheduler_job',
+                                       side_effect=lambda name: self.jobs_state.get(name, {})),
+            'update_scheduler_job': patch('scheduler.update_scheduler_job',
+                                          side_effect=lambda name, **fields: self.jobs_state.setdefault(name, {}).update(fields)),
+            'record_scheduler_run': patch('scheduler.record_scheduler_run',
+                                          side_effect=lambda name, run, history: self.recorded.append(run)),
+        }
+        self.mocks = {}
+        for name, patcher in patches.items():
+            self.mocks[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+        self.calls = []
+        self.scheduler = Scheduler([Job('job', lambda: self.calls.append(1) or 'done', interval=60, timeout=5)])
+        self.scheduler.owner = 'test-owner'
+
+    def finish_runs(self):
+        for thread, _ in list(self.scheduler._runs.values()):
+            thread.join()
+
+    def test_leader_runs_due_job_once_per_interval(self):
+        self.scheduler.tick(now=1000)
+        self.finish_runs()
+        self.scheduler.tick(now=1001)
+        self.assertEqual(self.calls, [1])
+        self.assertEqual([run['outcome'] for run in self.recorded], ['ok'])
+        self.assertEqual(self.recorded[0]['result'], 'done')
+        next_run = self.jobs_state['job']['next_run']
+        self.assertTrue(1000 + 54 <= next_run <= 1000 + 66)
+
+        self.scheduler.tick(now=next_run + 1)
+        self.finish_runs()
+        self.assertEqual(self.calls, [1, 1])
+
+    def test_follower_does_not_run_jobs(self):
+        self.mocks['hold_scheduler_lease'].return_value = False
+        self.scheduler.tick(now=1000)
+        self.assertEqual(self.scheduler._runs, {})
+        self.assertFalse(self.scheduler.is_leader)
+
+    def test_slow_run_is_recorded_as_timeout_and_not_restarted(self):
+        release = threading.Event()
+        self.scheduler.jobs['job'].func = release.wait
+        self.scheduler.tick(now=1000)
+        self.scheduler.tick(now=1010)
+        self.assertEqual([run['outcome'] for run in self.recorded], ['timeout'])
+        self.jobs_state['job']['next_run'] = 0
+        self.scheduler.tick(now=1011)
+        self.assertEqual(len(self.scheduler._runs), 1)
+        release.set()
+        self.finish_runs()
+        self.scheduler.tick(now=1012)
+        self.assertEqual(len(self.recorded), 1)
+
+    def test_failing_job_is_recorded_as_error(self):
+        self.scheduler.jobs['job'].func = lambda: 1 / 0
+        run = self.scheduler.run_now('job')
+        self.assertEqual(run['outcome'], 'error')
+        self.assertIn('ZeroDivisionError', run['error'])
+
+
+class TestArcgisTokenRefresh(unittest.TestCase):
+
+    @patch('arcgis_api.generate_token')
+    @patch('arcgis_api.get_cached_arcgis_token', return_value=('cached', 3600 * 1000))
+    def test_cached_token_is_used_and_kept_until_close_to_expiry(self, cached, generate):
+        self.assertEqual(arcgis_api.get_token(), 'cached')
+        self.assertFalse(arcgis_api.refresh_token(min_remaining_seconds=900))
+        generate.assert_not_called()
+        cached.return_value = ('cached', 600 * 1000)
+        self.assertTrue(arcgis_api.refresh_token(min_remaining_seconds=900))
+        generate.assert_called_once()
+
+    @patch('arcgis_api.generate_token', return_value='fresh')
+    @patch('arcgis_api.get_cached_arcgis_token', return_value=(None, 0))
+    def test_missing_token_is_generated(self, cached, generate):
+        self.assertEqual(arcgis_api.get_token(), 'fresh')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from singleflight import SingleFlight, call_key, single_flight
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def run_concurrently(self, func, count=5):
+        results, errors = [], []
+
+        def call():
+            try:
+                results.append(func())
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_concurrent_calls_run_once(self):
+        calls = []
+
+        @single_flight('test.lookup', shared=False)
+        def lookup(name):
+            calls.append(name)
+            time.sleep(0.05)
+            return {'name': name}
+
+        results, errors = self.run_concurrently(lambda: lookup('ars'))
+        self.assertEqual(calls, ['ars'])
+        self.assertEqual(results, [{'name': 'ars'}] * 5)
+        self.assertEqual(errors, [])
+        # Once the flight has landed the next call runs again
+        lookup('ars')
+        self.assertEqual(len(calls), 2)
+
+    def test_leader_exception_reaches_waiters(self):
+        def fail():
+            time.sleep(0.05)
+            raise RuntimeError('portal down')
+
+        flights = SingleFlight('test.fail', shared=False)
+        results, errors = self.run_concurrently(lambda: flights.do('k', fail), count=3)
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(flights._flights, {})
+
+    def test_call_key_distinguishes_arguments(self):
+        self.assertEqual(call_key(('a',), {}), call_key(('a',), {}))
+        self.assertNotEqual(call_key(('a',), {}), call_key(('b',), {}))
+
+
+class TestSharedSingleFlight(unittest.TestCase):
+
+    @patch('singleflight.publish_flight_result')
+    @patch('singleflight.acquire_flight', return_value=(True, 'me'))
+    def test_leader_publishes_result(self, acquire, publish):
+        flights = SingleFlight('test.shared', shared=True)
+        self.assertEqual(flights.do('k', lambda: 'token'), 'token')
+        self.assertEqual(publish.call_args.args[2], {'value': 'token'})
+
+    @patch('singleflight.poll_flight', side_effect=[(False, None, 'other'), (True, {'value': None}, None)])
+    @patch('singleflight.acquire_flight', return_value=(False, 'other'))
+    def test_follower_takes_remote_result(self, acquire, poll):
+        flights = SingleFlight('test.shared', shared=True, poll_ms=1)
+        self.assertIsNone(flights.do('k', lambda: self.fail('should not run')))
+        self.assertEqual(poll.call_count, 2)
+
+    @patch('singleflight.poll_flight', return_value=(False, None, None))
+    @patch('singleflight.acquire_flight', return_value=(False, 'other'))
+    def test_follower_runs_itself_when_leader_is_lost(self, acquire, poll):
+        flights = SingleFlight('test.shared', shared=True)
+        self.assertEqual(flights.do('k', lambda: 'mine'), 'mine')
+
+    @patch('singleflight.acquire_flight', side_effect=ConnectionError)
+    def test_redis_outage_runs_uncoordinated(self, acquire):
+        flights = SingleFlight('test.shared', shared=True)
+        self.assertEqual(flights.do('k', lambda: 'mine'), 'mine')
+
+
+if __name__ == '__main__':
+    unittest.main()
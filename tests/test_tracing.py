@@ -0,0 +1,88 @@
+import unittest
+
+from flask import Flask, redirect
+
+from metrics import observe_outbound
+from tracing import TRACE_COOKIE, adopt_traceparent, init_tracing, otlp_payload, parse_traceparent, set_attribute
+
+
+class ListExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+class TestTracing(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = ListExporter()
+        app = Flask(__name__)
+
+        @app.route('/auth')
+        def auth():
+            return redirect('https://idp.example.gov/authorize')
+
+        @app.route('/callback')
+        def callback():
+            set_attribute('enduser.id', 'jane@usda.gov')
+            with observe_outbound('login.gov', 'token'):
+                pass
+            return 'ok'
+
+        @app.route('/token')
+        def token():
+            adopt_traceparent('00-' + 'a' * 32 + '-' + 'b' * 16 + '-01')
+            return 'ok'
+
+        init_tracing(app, exporters=[self.exporter])
+        self.client = app.test_client()
+
+    def test_redirect_carries_trace_to_next_hop(self):
+        response = self.client.get('/auth')
+        trace_id, span_id = parse_traceparent(self.client.get_cookie(TRACE_COOKIE).value)
+        self.client.get('/callback')
+
+        auth_span, callback_span, token_span = [s for s in self.exporter.spans if s.kind == 'server'] + \
+            [s for s in self.exporter.spans if s.kind == 'client']
+        self.assertEqual(auth_span.span_id, span_id)
+        self.assertEqual(callback_span.trace_id, trace_id)
+        self.assertEqual(callback_span.parent_span_id, auth_span.span_id)
+        self.assertEqual(callback_span.attributes['enduser.id'], 'jane@usda.gov')
+        self.assertEqual(token_span.name, 'login.gov token')
+        self.assertEqual(token_span.parent_span_id, callback_span.span_id)
+        self.assertEqual(response.status_code, 302)
+
+    def test_adopt_reparents_request(self):
+        self.client.get('/token')
+        span = self.exporter.spans[0]
+        self.assertEqual((span.trace_id, span.parent_span_id), ('a' * 32, 'b' * 16))
+
+    def test_incoming_traceparent_header_wins(self):
+        self.client.get('/callback', headers={'traceparent': '00-' + 'c' * 32 + '-' + 'd' * 16 + '-01'})
+        self.assertEqual(self.exporter.spans[0].trace_id, 'c' * 32)
+
+    def test_otlp_payload(self):
+        self.client.get('/callback')
+        spans = otlp_payload(self.exporter.spans)['resourceSpans'][0]['scopeSpans'][0]['spans']
+        self.assertEqual(len(spans), 2)
+        self.assertEqual(len(spans[0]['traceId']), 32)
+
+    def test_spans_are_not_recorded_outside_requests(self):
+        with observe_outbound('arcgis', 'get_user'):
+            pass
+        self.assertEqual(self.exporter.spans, [])
+
+    def test_disabled_registers_nothing(self):
+        app = Flask(__name__)
+        init_tracing(app, exporters=[])
+        self.assertEqual(app.before_request_funcs, {})
+
+    def test_parse_traceparent_rejects_garbage(self):
+        self.assertIsNone(parse_traceparent('garbage'))
+        self.assertIsNone(parse_traceparent(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
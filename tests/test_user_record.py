@@ -0,0 +1,122 @@
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+
+import redis_helpers
+from codec import encode
+
+
+class TestUserRecord(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('redis_helpers.redis_client')
+        self.redis = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_record_fields_are_decoded(self):
+        self.redis.hgetall.return_value = {'version': '1', 'email': 'a@usda.gov',
+                                           'auth_access': encode({'is_disallowed': False}), 'user_groups': encode('ars')}
+        record = redis_helpers.get_user_record('a@usda.gov')
+        self.assertEqual(record['auth_access'], {'is_disallowed': False})
+        self.assertEqual(redis_helpers.get_email_to_user_groups('a@usda.gov', record=record)['user_groups'], 'ars')
+        self.redis.hgetall.assert_called_once_with('user:a@usda.gov')
+
+    def test_update_is_one_hset_on_the_record(self):
+        redis_helpers.put_user_auth_access('a@usda.gov', {'is_disallowed': False, 'has_selected_group': True})
+        pipe = self.redis.pipeline.return_value
+        (record_call, legacy_call) = pipe.hset.call_args_list
+        key, mapping = record_call.args[0], record_call.kwargs['mapping']
+        self.assertEqual(key, 'user:a@usda.gov')
+        self.assertEqual(mapping['version'], redis_helpers.USER_RECORD_VERSION)
+        # Dual-written in the legacy format during the rollout
+        self.assertEqual(legacy_call.args[0], 'user-auth-access:a@usda.gov')
+        self.assertEqual(json.loads(legacy_call.kwargs['mapping']['auth_access'])['has_selected_group'], True)
+        # The change-feed entry goes in the same transaction
+        self.redis.pipeline.assert_called_once_with(transaction=True)
+        entry = pipe.xadd.call_args.args[1]
+        self.assertEqual((entry['op'], entry['email'], entry['fields']), ('user.update', 'a@usda.gov', '["auth_access"]'))
+        pipe.execute.assert_called_once()
+
+    def test_legacy_keys_are_read_and_backfilled(self):
+        legacy = {
+            'user-auth-access:a@usda.gov': {'user_email': 'a@usda.gov', 'auth_access': json.dumps({'is_disallowed': True}),
+                                            'has_selected_group': 'False'},
+            'user-email-to-user-groups:a@usda.gov': {'user_email': 'a@usda.gov', 'user_groups': json.dumps('ars')},
+        }
+        self.redis.hgetall.side_effect = lambda key: legacy.get(key, {})
+        record = redis_helpers.get_user_record('a@usda.gov')
+        self.assertEqual(record['auth_access'], {'is_disallowed': True, 'has_selected_group': 'False'})
+        self.assertEqual(record['user_groups'], 'ars')
+        pipe = self.redis.pipeline.return_value
+        self.assertEqual(pipe.hset.call_args.args[0], 'user:a@usda.gov')
+        self.assertEqual(pipe.xadd.call_args.args[1]['op'], 'user.migrate')
+
+    def test_partial_record_is_completed_from_legacy_keys(self):
+        stored = {
+            'user:a@usda.gov': {'version': '1', 'email': 'a@usda.gov', 'username': 'auser'},
+            'user-auth-access:a@usda.gov': {'user_email': 'a@usda.gov', 'auth_access': json.dumps({'is_disallowed': False})},
+            'user-email-to-user-groups:a@usda.gov': {'user_email': 'a@usda.gov', 'user_groups': json.dumps('ars')},
+        }
+        self.redis.hgetall.side_effect = lambda key: dict(stored.get(key, {}))
+        record = redis_helpers.get_user_record('a@usda.gov')
+        self.assertEqual((record['username'], record['auth_access'], record['user_groups']),
+                         ('auser', {'is_disallowed': False}, 'ars'))
+        pipe = self.redis.pipeline.return_value
+        # Only missing fields are backfilled, without overwriting a concurrent write
+        self.assertIn(('user:a@usda.gov', 'user_groups', encode('ars')), [c.args for c in pipe.hsetnx.call_args_list])
+        pipe.hset.assert_called_once_with('user:a@usda.gov', 'migrated', 1)
+
+        stored['user:a@usda.gov']['migrated'] = '1'
+        self.redis.hgetall.reset_mock()
+        redis_helpers.get_user_record('a@usda.gov')
+        self.redis.hgetall.assert_called_once_with('user:a@usda.gov')
+
+    def test_unknown_user(self):
+        self.redis.hgetall.return_value = {}
+        self.assertIsNone(redis_helpers.get_user_record('new@usda.gov'))
+        self.assertIsNone(redis_helpers.get_user_auth_access('new@usda.gov'))
+        self.redis.hset.assert_not_called()
+
+    def test_delete_is_one_call(self):
+        pipe = MagicMock()
+        pipe.smembers.return_value = {'access-token-to-userinfo:t1', 'auth-code-to-access-token:c1'}
+        self.redis.transaction.side_effect = lambda func, *watches: func(pipe)
+        redis_helpers.delete_user_record('a@usda.gov', 'auser')
+        # The index is watched, so a token indexed after SMEMBERS makes the transaction retry
+        self.assertEqual(self.redis.transaction.call_args.args[1:], ('user-tokens:a@usda.gov',))
+        pipe.multi.assert_called_once()
+        pipe.delete.assert_called_once()
+        keys = pipe.delete.call_args.args
+        self.assertIn('user:a@usda.gov', keys)
+        self.assertIn('user-username:auser', keys)
+        self.assertIn('user-auth-access:a@usda.gov', keys)
+        self.assertIn('user-tokens:a@usda.gov', keys)
+        self.assertIn('access-token-to-userinfo:t1', keys)
+        self.assertIn('auth-code-to-access-token:c1', keys)
+        self.redis.scan_iter.assert_not_called()
+
+    def test_login_tokens_are_indexed_in_the_same_transaction(self):
+        redis_helpers.put_login_tokens('a@usda.gov', 'c1', 't1', {'email': 'a@usda.gov'})
+        self.redis.pipeline.assert_called_once_with(transaction=True)
+        self.redis.pipeline.return_value.sadd.assert_called_once_with(
+            'user-tokens:a@usda.gov', 'auth-code-to-access-token:c1', 'access-token-to-userinfo:t1')
+        self.redis.pipeline.return_value.execute.assert_called_once()
+        # The index outlives its longest-lived member
+        self.redis.pipeline.return_value.eval.assert_any_call(
+            redis_helpers.EXTEND_TTL_SCRIPT, 1, 'user-tokens:a@usda.gov',
+            max(redis_helpers.AUTH_CODE_TTL_SECONDS, redis_helpers.ACCESS_TOKEN_TTL_SECONDS))
+
+    def test_login_tokens_need_an_email(self):
+        with self.assertRaises(ValueError):
+            redis_helpers.put_login_tokens(None, 'c1', 't1', {})
+        self.redis.pipeline.assert_not_called()
+
+    def test_username_alias_falls_back_to_legacy(self):
+        self.redis.get.return_value = None
+        self.redis.hgetall.return_value = {'username': 'auser', 'user_email': 'a@usda.gov'}
+        self.assertEqual(redis_helpers.get_username_to_email('auser'), {'username': 'auser', 'user_email': 'a@usda.gov'})
+        self.redis.pipeline.return_value.set.assert_called_once_with('user-username:auser', 'a@usda.gov')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+
+from flask import Flask
+
+import redis_helpers
+import user_state
+from user_state import iter_user_states, parse_query, user_state_blueprint
+
+RECORDS = {
+    'a@usgs.gov': {'email': 'a@usgs.gov', 'username': 'a_usgs', 'auth_access': {'is_disallowed': False}},
+    'b@usda.gov': {'email': 'b@usda.gov', 'legacy': True, 'user_groups': 'ars'},
+}
+
+
+def fake_records(emails):
+    return [RECORDS.get(email) for email in emails]
+
+
+def fake_username_emails(usernames):
+    return [{'a_usgs': 'a@usgs.gov'}.get(username) for username in usernames]
+
+
+@patch('user_state.get_username_emails_bulk', side_effect=fake_username_emails)
+@patch('user_state.get_user_records_bulk', side_effect=fake_records)
+class TestUserStateQuery(unittest.TestCase):
+
+    def test_states_in_input_order(self, records, usernames):
+        states = list(iter_user_states(['a_usgs', 'b@usda.gov', 'nobody', 'c@epa.gov']))
+        self.assertEqual([state['query'] for state in states], ['a_usgs', 'b@usda.gov', 'nobody', 'c@epa.gov'])
+        self.assertEqual(states[0]['email'], 'a@usgs.gov')
+        self.assertEqual(states[0]['auth_access'], {'is_disallowed': False})
+        self.assertEqual((states[1]['source'], states[1]['user_groups']), ('legacy', 'ars'))
+        self.assertEqual((states[2]['found'], states[2]['email'], states[2]['username']), (False, None, 'nobody'))
+        self.assertFalse(states[3]['found'])
+
+    def test_reads_in_batches(self, records, usernames):
+        queries = (f"user{i}@usgs.gov" for i in range(25))
+        self.assertEqual(len(list(iter_user_states(queries, batch_size=10))), 25)
+        self.assertEqual([len(call.args[0]) for call in records.call_args_list], [10, 10, 5])
+        usernames.assert_not_called()
+
+    @patch('user_state.ADMIN_API_TOKEN', 'secret')
+    def test_endpoint_streams_ndjson_to_admins(self, records, usernames):
+        app = Flask(__name__)
+        app.register_blueprint(user_state_blueprint)
+        client = app.test_client()
+        self.assertEqual(client.post('/admin/user_state', data='a_usgs').status_code, 403)
+        self.assertEqual(client.post('/admin/user_state', data='a_usgs',
+                                     headers={'Authorization': 'Bearer wrong'}).status_code, 403)
+
+        response = client.post('/admin/user_state', data='email\na_usgs\n\nc@epa.gov\n',
+                               headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([(line['query'], line['found']) for line in lines], [('a_usgs', True), ('c@epa.gov', False)])
+
+
+class TestBulkReads(unittest.TestCase):
+
+    @patch('redis_helpers.redis_client')
+    def test_unmigrated_users_are_read_from_legacy_keys(self, mock_client):
+        pipe = mock_client.pipeline.return_value
+        pipe.execute.side_effect = [
+            [{'email': 'a@usgs.gov', 'version': '1', 'username': 'a_usgs'}, {},
+             {'email': 'c@usgs.gov', 'version': '1', 'migrated': '1'}],
+            [{'user_email': 'a@usgs.gov', 'auth_access': '{"is_disallowed": false}'}, {},
+             {'user_email': 'b@usda.gov', 'auth_access': '{"is_disallowed": true}'}, {}],
+        ]
+        records = redis_helpers.get_user_records_bulk(['a@usgs.gov', 'b@usda.gov', 'c@usgs.gov'])
+        # A record written only by the username alias still gets its legacy fields
+        self.assertEqual(records[0], {'email': 'a@usgs.gov', 'version': '1', 'username': 'a_usgs', 'legacy': True,
+                                      'auth_access': {'is_disallowed': False}})
+        self.assertEqual(records[1], {'email': 'b@usda.gov', 'legacy': True, 'auth_access': {'is_disallowed': True}})
+        self.assertEqual(records[2], {'email': 'c@usgs.gov', 'version': '1', 'migrated': '1'})
+        self.assertEqual(pipe.hgetall.call_count, 7)
+        mock_client.hset.assert_not_called()
+
+    def test_parse_query(self):
+        self.assertEqual(parse_query(' a@usgs.gov \n'), 'a@usgs.gov')
+        self.assertEqual(parse_query('{"username": "a_usgs"}'), 'a_usgs')
+        self.assertIsNone(parse_query('Email'))
+        self.assertIsNone(parse_query('   '))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import json
+import unittest
+from unittest.mock import patch
+
+from itsdangerous import Signer
+
+import userinfo_cookie
+from userinfo_cookie import issue_userinfo_cookie, is_legacy_userinfo_cookie, load_userinfo_cookie
+
+USERINFO = {'email': 'jane.doe@usda.gov', 'given_name': 'jane', 'family_name': 'doe'}
+
+
+class TestUserinfoCookie(unittest.TestCase):
+
+    def setUp(self):
+        self.store = {}
+        put = patch('userinfo_cookie.put_login_userinfo', side_effect=self.store.__setitem__)
+        get = patch('userinfo_cookie.get_login_userinfo', side_effect=self.store.get)
+        signer = patch('userinfo_cookie.signer', Signer('test-secret', salt='userinfo-cookie'))
+        for patcher in (put, get, signer):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_issue_and_load(self):
+        cookie = issue_userinfo_cookie(USERINFO)
+        self.assertNotIn('jane', cookie)
+        self.assertLess(len(cookie), 64)
+        self.assertEqual(load_userinfo_cookie(cookie), USERINFO)
+
+    def test_tampered_cookie_is_rejected(self):
+        cookie = issue_userinfo_cookie(USERINFO)
+        handle, signature = cookie.rsplit('.', 1)
+        self.assertIsNone(load_userinfo_cookie(f'{handle}x.{signature}'))
+        self.assertIsNone(load_userinfo_cookie('not-a-signed-handle'))
+
+    def test_expired_handle_returns_none(self):
+        cookie = issue_userinfo_cookie(USERINFO)
+        self.store.clear()
+        self.assertIsNone(load_userinfo_cookie(cookie))
+
+    @patch('userinfo_cookie.legacy_cookies_until', userinfo_cookie._parse_sunset('2999-01-01T00:00:00'))
+    def test_legacy_json_cookie_accepted_until_sunset(self):
+        cookie = json.dumps(USERINFO)
+        self.assertTrue(is_legacy_userinfo_cookie(cookie))
+        self.assertEqual(load_userinfo_cookie(cookie), USERINFO)
+        self.assertIsNone(userinfo_cookie.legacy_userinfo(cookie, now=userinfo_cookie.legacy_cookies_until))
+        self.assertFalse(is_legacy_userinfo_cookie(issue_userinfo_cookie(USERINFO)))
+        self.assertIsNone(load_userinfo_cookie(None))
+
+    def test_legacy_json_cookie_rejected_by_default(self):
+        self.assertEqual(userinfo_cookie._parse_sunset(''), 0.0)
+        self.assertIsNone(load_userinfo_cookie(json.dumps(USERINFO)))
+
+    @patch('userinfo_cookie.FLASK_SECRET_KEY', '')
+    def test_missing_secret_key_fails(self):
+        with self.assertRaises(RuntimeError):
+            userinfo_cookie._create_signer()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+from unittest.mock import patch
+
+import arcgis_api
+import webhook_idempotency
+from manage_arcgis_user_groups_helper_functions import process_webhook_event
+
+
+class TestWebhookIdempotency(unittest.TestCase):
+
+    def test_key_prefers_event_id(self):
+        event = {'eventId': 'abc', 'username': 'jdoe', 'operation': 'add', 'when': 1}
+        self.assertEqual(webhook_idempotency.event_idempotency_key(event), 'abc')
+
+    def test_key_falls_back_to_user_operation_timestamp(self):
+        event = {'username': 'jdoe', 'operation': 'update', 'source': 'users', 'when': 1700000000}
+        self.assertEqual(webhook_idempotency.event_idempotency_key(event), 'jdoe:update:1700000000')
+
+    def test_key_without_timestamp_covers_the_whole_payload(self):
+        key = webhook_idempotency.event_idempotency_key
+        event = {'username': 'jdoe', 'operation': 'update', 'source': 'users'}
+        self.assertEqual(key(event), key(dict(event)))
+        self.assertNotEqual(key(event), key(dict(event, properties={'role': 'admin'})))
+        self.assertNotEqual(key(event), 'jdoe:update:')
+
+    @patch("webhook_idempotency.put_webhook_event_if_absent", return_value=False)
+    @patch("manage_arcgis_user_groups_helper_functions.arcgis_api.get_user_from_username")
+    def test_duplicate_event_skips_portal(self, mock_get_user, _):
+        """Ensure a duplicate delivery short-circuits before any portal call"""
+        process_webhook_event({'operation': 'update', 'source': 'users', 'username': 'jdoe'})
+        mock_get_user.assert_not_called()
+
+    @patch("webhook_idempotency.delete_webhook_event")
+    @patch("webhook_idempotency.put_webhook_event_if_absent", return_value=True)
+    @patch("manage_arcgis_user_groups_helper_functions.arcgis_api.get_user_from_username", side_effect=RuntimeError)
+    def test_failed_event_is_released(self, _, __, mock_delete):
+        """Ensure a failed event can be retried"""
+        with self.assertRaises(RuntimeError):
+            process_webhook_event({'operation': 'update', 'source': 'users', 'username': 'jdoe', 'when': 1})
+        mock_delete.assert_called_once_with('jdoe:update:1')
+
+    @patch("manage_arcgis_user_groups_helper_functions.get_prefetched_arcgis_user", return_value=None)
+    @patch("webhook_idempotency.put_user_group_assignment")
+    @patch("webhook_idempotency.get_user_group_assignment", return_value=['DOI', 'USGS'])
+    @patch("webhook_idempotency.put_webhook_event_if_absent", return_value=True)
+    @patch("manage_arcgis_user_groups_helper_functions.put_username_to_email")
+    @patch("manage_arcgis_user_groups_helper_functions.get_email_to_user_groups", return_value=None)
+    @patch("manage_arcgis_user_groups_helper_functions.get_user_groups", return_value=['USGS', 'DOI'])
+    @patch("manage_arcgis_user_groups_helper_functions.arcgis_api")
+    def test_satisfied_assignment_skips_add_users(self, mock_arcgis_api, *_):
+        mock_arcgis_api.get_user_from_username.return_value = {'username': 'jdoe', 'email': 'jdoe@usgs.gov'}
+        process_webhook_event({'operation': 'add', 'source': 'users', 'username': 'jdoe'})
+        mock_arcgis_api.add_user_to_groups.assert_not_called()
+
+    @patch("manage_arcgis_user_groups_helper_functions.get_prefetched_arcgis_user", return_value=None)
+    @patch("webhook_idempotency.delete_webhook_event")
+    @patch("webhook_idempotency.put_user_group_assignment")
+    @patch("webhook_idempotency.get_user_group_assignment", return_value=None)
+    @patch("webhook_idempotency.put_webhook_event_if_absent", return_value=True)
+    @patch("manage_arcgis_user_groups_helper_functions.put_username_to_email")
+    @patch("manage_arcgis_user_groups_helper_functions.get_email_to_user_groups", return_value=None)
+    @patch("manage_arcgis_user_groups_helper_functions.get_user_groups", return_value=['USGS', 'DOI'])
+    @patch("manage_arcgis_user_groups_helper_functions.arcgis_api")
+    def test_partial_assignment_is_not_marked_satisfied(self, mock_arcgis_api, _, __, ___, ____, _____,
+                                                        mock_put_assignment, mock_delete, ______):
+        """Ensure a group that was not applied leaves the event retryable"""
+        mock_arcgis_api.get_user_from_username.return_value = {'username': 'jdoe', 'email': 'jdoe@usgs.gov'}
+        mock_arcgis_api.add_user_to_groups.return_value = ['DOI']
+        with self.assertRaises(RuntimeError):
+            process_webhook_event({'operation': 'add', 'source': 'users', 'username': 'jdoe', 'when': 1})
+        mock_put_assignment.assert_not_called()
+        mock_delete.assert_called_once_with('jdoe:add:1')
+
+
+class TestAddUserToGroups(unittest.TestCase):
+
+    @patch("arcgis_api.record_change")
+    @patch("arcgis_api.get_token", return_value='token')
+    @patch("arcgis_api.get_group_by_title", return_value=None)
+    @patch("arcgis_api.http_session")
+    def test_returns_titles_not_applied(self, mock_session, _, __, ___):
+        mock_session.post.return_value.json.side_effect = [{'notAdded': []}, {'notAdded': ['jdoe']}]
+        groups = {'USGS': {'id': 'g1', 'title': 'USGS'}, 'DOI': {'id': 'g2', 'title': 'DOI'}}
+        not_applied = arcgis_api.add_user_to_groups({'username': 'jdoe'}, ['USGS', 'DOI', 'Missing'], groups=groups)
+        self.assertEqual(not_applied, ['DOI', 'Missing'])
+
+
+if __name__ == "__main__":
+    unittest.main()
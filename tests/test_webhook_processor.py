@@ -0,0 +1,115 @@
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+from flask import Flask
+
+from manage_arcgis_user_groups_helper_functions import get_event_user_key, group_events_by_user
+from routes import routes_blueprint
+from webhook_processor import WebhookProcessor
+
+
+def user_event(operation, username):
+    return {'operation': operation, 'source': 'users', 'username': username}
+
+
+class TestGroupEventsByUser(unittest.TestCase):
+
+    def test_all_events_are_grouped_by_user(self):
+        """Ensure events past the first one are not dropped"""
+        data = {'events': [user_event('add', 'a'), user_event('add', 'b'),
+                           {'operation': 'delete', 'source': 'user', 'id': 'c'}]}
+        user_events, collapsed = group_events_by_user(data)
+        self.assertEqual([key for key, _ in user_events], ['a', 'b', 'c'])
+        self.assertEqual(collapsed, 0)
+
+    def test_superseded_updates_collapse(self):
+        """Ensure back-to-back updates for a user collapse into the last one"""
+        events = [user_event('update', 'a'), user_event('update', 'a'), user_event('update', 'a')]
+        user_events, collapsed = group_events_by_user({'events': events})
+        self.assertEqual(user_events, [('a', [events[-1]])])
+        self.assertEqual(collapsed, 2)
+
+    def test_add_is_never_collapsed(self):
+        """Ensure an add followed by an update keeps the group assignment"""
+        events = [user_event('add', 'a'), user_event('update', 'a')]
+        user_events, _ = group_events_by_user({'events': events})
+        self.assertEqual(user_events, [('a', events)])
+
+    def test_non_user_events_ignored(self):
+        user_events, _ = group_events_by_user({'events': [{'operation': 'add', 'source': 'groups', 'id': 'g'}]})
+        self.assertEqual(user_events, [])
+
+
+class TestWebhookProcessor(unittest.TestCase):
+
+    def test_events_are_processed(self):
+        done = threading.Event()
+        handler = MagicMock(side_effect=lambda event: done.set())
+        processor = WebhookProcessor(handler=handler, max_queue_size=10, workers=1)
+        accepted, count = processor.submit({'events': [user_event('add', 'a')]})
+        self.assertTrue(accepted)
+        self.assertEqual(count, 1)
+        self.assertTrue(done.wait(2))
+        self.assertTrue(processor.join(2))
+        self.assertEqual(processor.stats()['processed'], 1)
+
+    def test_rejects_when_saturated(self):
+        """Ensure payloads that do not fit in the queue are rejected and counted as dropped"""
+        started, release = threading.Event(), threading.Event()
+        processor = WebhookProcessor(handler=lambda event: started.set() or release.wait(2), max_queue_size=1, workers=1)
+        processor.submit({'events': [user_event('add', 'a')]})
+        started.wait(2)
+        processor.submit({'events': [user_event('add', 'b')]})
+        accepted, count = processor.submit({'events': [user_event('add', 'c'), user_event('add', 'd')]})
+        release.set()
+        self.assertFalse(accepted)
+        self.assertEqual(processor.stats()['dropped'], 2)
+
+    def test_rejects_when_stopped(self):
+        processor = WebhookProcessor(handler=MagicMock(), max_queue_size=10, workers=1)
+        processor.stop()
+        accepted, _ = processor.submit({'events': [user_event('add', 'a')]})
+        self.assertFalse(accepted)
+
+    def test_stop_drains_accepted_events(self):
+        """Ensure events answered 200 are finished before the worker exits"""
+        release, handled = threading.Event(), []
+        processor = WebhookProcessor(handler=lambda event: release.wait(2) and handled.append(event['username']),
+                                     max_queue_size=10, workers=2)
+        processor.submit({'events': [user_event('add', 'a'), user_event('add', 'b')]})
+        self.assertFalse(processor.stop(timeout=0.05))
+        release.set()
+        self.assertTrue(processor.stop(timeout=2))
+        self.assertEqual(sorted(handled), ['a', 'b'])
+
+    def test_events_for_one_user_run_in_order_across_payloads(self):
+        handled = []
+        processor = WebhookProcessor(
+            handler=lambda event: handled.append((get_event_user_key(event), event['operation'])),
+            max_queue_size=100, workers=4)
+        for i in range(20):
+            processor.submit({'events': [user_event('add', f'user{i}')]})
+            processor.submit({'events': [{'operation': 'delete', 'source': 'user', 'id': f'user{i}'}]})
+        self.assertTrue(processor.join(2))
+        for i in range(20):
+            user = [operation for username, operation in handled if username == f'user{i}']
+            self.assertEqual(user, ['add', 'delete'])
+
+
+
+class TestWebhookStatsRoute(unittest.TestCase):
+
+    @patch('user_state.ADMIN_API_TOKEN', 'admin-secret')
+    def test_stats_need_the_admin_token(self):
+        app = Flask(__name__)
+        app.register_blueprint(routes_blueprint)
+        client = app.test_client()
+        self.assertEqual(client.get('/arcgis_webhook/stats').status_code, 403)
+        response = client.get('/arcgis_webhook/stats', headers={'Authorization': 'Bearer admin-secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('queue_depth', response.get_json())
+
+
+if __name__ == "__main__":
+    unittest.main()
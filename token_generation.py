@@ -1,20 +1,25 @@
 import base64
+import hashlib
+import hmac
 import json
 import os
 import secrets
 import time
 import re
+from functools import lru_cache
 import jwt
 import logging
 from flask import redirect
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
-from config import redis_client, AUTH, AUTH_PRIVATE_KEY
+from config import redis_client, AUTH, AUTH_PRIVATE_KEY, ARCGIS_LOGIN_CALLBACK_URL, OIDC_TRANSACTION_TTL_SECONDS
+from codec import encode, decode
+from redis_helpers import IDP_ACCESS_TOKEN_KEY, put_oidc_transaction
 
 # Initialize logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler('./token_generation.log')
+file_handler = logging.FileHandler('./token_generation.log', delay=True)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 file_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
@@ -58,7 +63,15 @@ def load_pem_key():
         raise
 
 
-pem_key = load_pem_key()
+@lru_cache(maxsize=None)
+def get_pem_key():
+    """Return the signing key, parsing it on first use rather than at import."""
+    return load_pem_key()
+
+@lru_cache(maxsize=None)
+def get_signing_key():
+    """The parsed private key. Signing with it skips re-parsing the PEM on every token (~45 ms)."""
+    return serialization.load_pem_private_key(get_pem_key(), password=None, backend=default_backend())
 
 def generate_auth_code(length=30):
     """Generate a secure authentication code."""
@@ -78,10 +91,14 @@ def generate_jwt_token(aud, client_id):
         'aud': aud,
         'jti': nonce,
         'exp': int(time.time()) + 300,
-    }, pem_key, algorithm='RS256')
+    }, get_signing_key(), algorithm='RS256')
     logger.debug("Generated JWT token: %s", jwt_token)
     return jwt_token
 
+def generate_refresh_token(family=None):
+    """A refresh token `<family>.<secret>`; rotation keeps the family and replaces the secret."""
+    return f"{family or secrets.token_urlsafe(16)}.{secrets.token_urlsafe(32)}"
+
 def generate_oidc_state(length=16):
     """Generate an OIDC state value."""
     logger.debug("Generating OIDC state of length %d", length)
@@ -89,29 +106,66 @@ def generate_oidc_state(length=16):
     logger.debug("Generated OIDC state: %s", state)
     return state
 
-oidc_state = generate_oidc_state()
+# Binds an OIDC state to the browser that started the login: /auth sets it, the transaction keeps
+# only its digest, and /callback rejects a state arriving without it (login CSRF)
+OIDC_BINDING_COOKIE = 'oidc_binding'
+
+def get_auth_code_from_idp(return_to=None):
+    """Redirect user to Identity Provider (IDP) for authentication.
+
+    State and nonce are fresh for every login and kept in Redis until /callback consumes them,
+    so the callback may land on any worker or replica.
+    """
+    redirect_url, state, transaction, binding = idp_authorization_request(return_to)
+    if not put_oidc_transaction(state, transaction):
+        return 'Sign-in is temporarily unavailable, please try again', 503
+    logger.info("Redirecting to IDP authorization endpoint")
+    response = redirect(redirect_url)
+    set_oidc_binding_cookie(response, binding)
+    return response
 
-def get_auth_code_from_idp():
-    """Redirect user to Identity Provider (IDP) for authentication."""
+def set_oidc_binding_cookie(response, binding):
+    """Set the binding cookie on a Flask or Quart response; only /callback ever receives it."""
+    response.set_cookie(OIDC_BINDING_COOKIE, binding, max_age=OIDC_TRANSACTION_TTL_SECONDS, path='/callback',
+                        httponly=True, secure=True, samesite='Lax')
+
+def oidc_binding_digest(binding):
+    return hashlib.sha256(binding.encode()).hexdigest()
+
+def oidc_binding_matches(transaction, binding):
+    """True if `binding` (the cookie /callback received) is the one /auth set for this transaction."""
+    expected = transaction.get('binding')
+    return bool(expected and binding) and hmac.compare_digest(expected, oidc_binding_digest(binding))
+
+def idp_authorization_request(return_to=None):
+    """(authorization URL, state, transaction to store under the state, browser binding) for a new login."""
     client_id = AUTH.IDP.CLIENT_ID
     base_url = AUTH.IDP.BASE_URL
-    logger.info("Redirecting to IDP authorization endpoint")
+    state = generate_oidc_state()
+    nonce = generate_nonce()
+    binding = secrets.token_urlsafe(16)
+    transaction = {
+        'nonce': nonce,
+        'return_to': return_to or ARCGIS_LOGIN_CALLBACK_URL,
+        'created_at': int(time.time()),
+        'binding': oidc_binding_digest(binding),
+    }
     redirect_url = (
         f"{base_url}"
         f"{AUTH.IDP.AUTHORIZATION_ROUTE}?"
         f"acr_values={AUTH.IDP.ACR_VALUE}&"
         f"client_id={client_id}&"
-        f"nonce={generate_nonce()}&"
+        f"nonce={nonce}&"
         f"prompt={AUTH.IDP.PROMPT}&"
         f"redirect_uri={AUTH.IDP.REDIRECT_URI}&"
         f"response_type={AUTH.IDP.RESPONSE_TYPE}&"
         f"scope={AUTH.IDP.SCOPE}&"
-        f"state={oidc_state}&"
+        f"state={state}&"
         f"client_assertion_type={AUTH.IDP.CLIENT_ASSERTION_TYPE}&"
         f"client_assertion={generate_jwt_token(base_url, client_id)}"
     )
     logger.debug("Redirect URL: %s", redirect_url)
-    return redirect(redirect_url)
+    return redirect_url, state, transaction, binding
 
 def construct_idp_token_post(idp_code):
     """Construct IDP token POST request."""
@@ -128,8 +182,31 @@ def construct_idp_token_post(idp_code):
     logger.debug("Constructed token POST data: %s", json.dumps(data, indent=2))
     return token_url, headers, data
 
-def handle_idp_token_response(idp_token_response):
+def id_token_nonce(id_token):
+    """The nonce claim of an ID token, or None if it cannot be read.
+
+    The token comes straight from the IdP token endpoint over TLS, so its claims are read
+    without verifying the signature (OIDC Core 3.1.3.7).
+    """
+    try:
+        return jwt.decode(id_token, options={'verify_signature': False}).get('nonce')
+    except jwt.InvalidTokenError:
+        return None
+
+def handle_idp_token_response(idp_token_response, nonce=None):
     """Process IDP token response and store data in Redis session."""
+    token_data = read_idp_token_response(idp_token_response, nonce)
+    if isinstance(token_data, tuple):
+        return token_data
+    access_token = token_data['access_token']
+    redis_client.setex(f"{IDP_ACCESS_TOKEN_KEY}:{access_token}", 3600, encode(token_data))
+    return access_token
+
+def read_idp_token_response(idp_token_response, nonce=None):
+    """
+    Validate an IDP token response (requests or httpx). Returns the token data, or an
+    (error message, status) tuple.
+    """
     logger.info("Handling IDP token response")
     if idp_token_response.status_code != 200:
         error_message = 'Error: Failed to exchange code for token'
@@ -166,9 +243,12 @@ def handle_idp_token_response(idp_token_response):
         logger.error("IDP token response missing access token: %s", json.dumps(token_data, indent=2))
         return "Error: Missing access token in response", 500
 
+    if nonce is not None and id_token_nonce(token_data.get('id_token')) != nonce:
+        logger.error("IDP ID token nonce does not match the login transaction")
+        return "Error: Invalid ID token nonce", 400
+
     logger.info("IDP token exchange successful")
-    redis_client.setex(f"access_token:{access_token}", 3600, json.dumps(token_data))
-    return access_token
+    return token_data
 
 def construct_idp_userinfo_get(access_token):
     """Construct IDP userinfo request."""
@@ -229,7 +309,8 @@ def parse_x509_subject(x509_subject):
 
 
 def parse_auth_access(user_auth_access):
-    user_auth_access_dict = json.loads(user_auth_access)
+    # get_user_auth_access() returns the field decoded; raw strings are still accepted
+    user_auth_access_dict = decode(user_auth_access) if isinstance(user_auth_access, str) else user_auth_access
     user_is_disallowed = user_auth_access_dict.get('is_disallowed')
     user_previous_selected_group = user_auth_access_dict.get('disallowed_selected_group')
     logger.info(f'User permissions loaded: {user_auth_access_dict}')
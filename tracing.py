@@ -0,0 +1,330 @@
+"""
+Request-scoped tracing for the login flow, OpenTelemetry-style.
+
+Every request gets a server span; observe_outbound() and observe_redis() in metrics.py add a
+client span for each login.gov, ArcGIS and Redis call. One login is one trace: the context
+travels through the browser redirects in the `trace` cookie (W3C traceparent format), and to
+the ArcGIS server-side /token call through the auth code record. An incoming `traceparent`
+header takes precedence over both.
+
+Spans are exported when their request finishes, to the exporters named in TRACING_EXPORTERS:
+`file` appends one JSON span per line to TRACING_FILE, `otlp` posts OTLP/HTTP JSON batches to
+OTEL_EXPORTER_OTLP_ENDPOINT. With TRACING_EXPORTERS empty no hooks are registered.
+
+    python tracing.py traces.jsonl --user jane.doe@usda.gov    # print that user's login traces
+"""
+import argparse
+import contextvars
+import json
+import logging
+import os
+import queue
+import secrets
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from flask import g, request
+
+from config import OTEL_EXPORTER_OTLP_ENDPOINT, OTEL_SERVICE_NAME, TRACING_EXPORTERS, TRACING_FILE
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./tracing.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+TRACE_COOKIE = 'trace'
+TRACE_COOKIE_MAX_AGE = 900
+OTLP_BATCH_SIZE = 256
+OTLP_QUEUE_SIZE = 10000
+
+# Spans of the request being handled by this greenlet/thread; None when not tracing
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_span_id', 'name', 'kind', 'start_ns', 'end_ns', 'attributes',
+                 'status')
+
+    def __init__(self, name, kind, trace_id, parent_span_id=None, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent_span_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.status = 'ok'
+
+    def end(self):
+        self.end_ns = time.time_ns()
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_span_id': self.parent_span_id,
+            'name': self.name, 'kind': self.kind, 'start_ns': self.start_ns, 'end_ns': self.end_ns,
+            'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 3), 'attributes': self.attributes,
+            'status': self.status, 'service': OTEL_SERVICE_NAME,
+        }
+
+
+class RequestTrace:
+    """The spans of one request; the first is the server span."""
+
+    def __init__(self, root):
+        self.root = root
+        self.spans = [root]
+        self.stack = [root]
+
+    def adopt(self, traceparent):
+        """Re-parent this request under a trace found mid-request (e.g. stored with an auth code)."""
+        parsed = parse_traceparent(traceparent)
+        if parsed is None:
+            return
+        trace_id, parent_span_id = parsed
+        for span in self.spans:
+            span.trace_id = trace_id
+        self.root.parent_span_id = parent_span_id
+
+
+def parse_traceparent(value):
+    try:
+        version, trace_id, span_id, _ = value.split('-')
+        int(trace_id, 16), int(span_id, 16)
+    except (AttributeError, ValueError):
+        return None
+    if version != '00' or len(trace_id) != 32 or len(span_id) != 16:
+        return None
+    return trace_id, span_id
+
+
+def format_traceparent(span):
+    return f"00-{span.trace_id}-{span.span_id}-01"
+
+
+def current_traceparent():
+    trace = _current_trace.get()
+    return format_traceparent(trace.stack[-1]) if trace else None
+
+
+def adopt_traceparent(traceparent):
+    trace = _current_trace.get()
+    if trace is not None and traceparent:
+        trace.adopt(traceparent)
+
+
+def set_attribute(key, value):
+    """Set an attribute on the current request's server span (no-op when not tracing)."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.root.attributes[key] = value
+
+
+@contextmanager
+def start_span(name, **attributes):
+    """Child span of whatever is current in this request; does nothing outside a traced request."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    parent = trace.stack[-1]
+    span = Span(name, 'client', parent.trace_id, parent.span_id, attributes)
+    trace.spans.append(span)
+    trace.stack.append(span)
+    try:
+        yield span
+    except Exception as e:
+        span.status = 'error'
+        span.attributes['exception.type'] = type(e).__name__
+        raise
+    finally:
+        span.end()
+        trace.stack.pop()
+
+
+# Exporters
+
+class FileExporter:
+    """Appends spans as JSON lines; usable offline and readable by `python tracing.py`."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(span.to_dict()) + '\n' for span in spans)
+        with self.lock, open(self.path, 'a') as f:
+            f.write(lines)
+
+
+class OTLPHttpExporter:
+    """Posts batches to an OTLP/HTTP collector (JSON encoding) from a background thread."""
+
+    def __init__(self, endpoint):
+        self.url = endpoint.rstrip('/') + '/v1/traces'
+        self.queue = queue.Queue(maxsize=OTLP_QUEUE_SIZE)
+        self.session = requests.Session()
+        self.dropped = 0
+        self._pid = None
+
+    def export(self, spans):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='otlp-exporter', daemon=True).start()
+        for span in spans:
+            try:
+                self.queue.put_nowait(span)
+            except queue.Full:
+                self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < OTLP_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.session.post(self.url, json=otlp_payload(batch), timeout=5)
+            except Exception as e:
+                logger.error(f"Error exporting {len(batch)} spans to {self.url}: {e}")
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_payload(spans):
+    kinds = {'server': 2, 'client': 3}
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': OTEL_SERVICE_NAME}}]},
+        'scopeSpans': [{
+            'scope': {'name': 'auth-service.tracing'},
+            'spans': [{
+                'traceId': span.trace_id, 'spanId': span.span_id, 'parentSpanId': span.parent_span_id or '',
+                'name': span.name, 'kind': kinds.get(span.kind, 1),
+                'startTimeUnixNano': str(span.start_ns), 'endTimeUnixNano': str(span.end_ns),
+                'attributes': [{'key': k, 'value': _otlp_value(v)} for k, v in span.attributes.items()],
+                'status': {'code': 2 if span.status == 'error' else 1},
+            } for span in spans],
+        }],
+    }]}
+
+
+def create_exporters(names=TRACING_EXPORTERS):
+    exporters = []
+    for name in names:
+        if name == 'file':
+            exporters.append(FileExporter(TRACING_FILE))
+        elif name == 'otlp' and OTEL_EXPORTER_OTLP_ENDPOINT:
+            exporters.append(OTLPHttpExporter(OTEL_EXPORTER_OTLP_ENDPOINT))
+        else:
+            logger.error(f"Unknown or unconfigured tracing exporter: {name}")
+    return exporters
+
+
+def init_tracing(app, exporters=None):
+    """Trace every request of the app; no hooks are registered when no exporter is configured."""
+    exporters = create_exporters() if exporters is None else exporters
+    if not exporters:
+        return
+
+    @app.before_request
+    def start_request_span():
+        parent = parse_traceparent(request.headers.get('traceparent')) or \
+            parse_traceparent(request.cookies.get(TRACE_COOKIE))
+        trace_id, parent_span_id = parent if parent else (secrets.token_hex(16), None)
+        root = Span(f"{request.method} {request.url_rule.rule if request.url_rule else request.path}", 'server',
+                    trace_id, parent_span_id, {'http.method': request.method, 'http.target': request.path})
+        trace = RequestTrace(root)
+        g.trace_token = _current_trace.set(trace)
+
+    @app.after_request
+    def carry_trace_across_redirect(response):
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.root.attributes['http.status_code'] = response.status_code
+            if 300 <= response.status_code < 400:
+                response.set_cookie(TRACE_COOKIE, format_traceparent(trace.root), max_age=TRACE_COOKIE_MAX_AGE,
+                                    httponly=True, secure=True, samesite='Lax')
+        return response
+
+    @app.teardown_request
+    def export_request_spans(exc):
+        token = g.pop('trace_token', None)
+        trace = _current_trace.get()
+        if token is not None:
+            _current_trace.reset(token)
+        if trace is None:
+            return
+        if exc is not None:
+            trace.root.status = 'error'
+        trace.root.end()
+        for exporter in exporters:
+            try:
+                exporter.export(trace.spans)
+            except Exception as e:
+                logger.error(f"Error exporting spans: {e}")
+
+
+# Offline report
+
+def load_spans(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def print_trace(spans, out=sys.stdout):
+    children = {}
+    for span in spans:
+        children.setdefault(span['parent_span_id'], []).append(span)
+    span_ids = {span['span_id'] for span in spans}
+    roots = [span for span in spans if span['parent_span_id'] not in span_ids]
+
+    def walk(span, depth):
+        attributes = {k: v for k, v in span['attributes'].items() if k in ('http.status_code', 'enduser.id')}
+        out.write(f"{'  ' * depth}{span['name']:<{60 - 2 * depth}} {span['duration_ms']:>10.1f} ms"
+                  f"{' ERROR' if span['status'] == 'error' else ''} {attributes or ''}\n")
+        for child in sorted(children.get(span['span_id'], []), key=lambda s: s['start_ns']):
+            walk(child, depth + 1)
+
+    for root in sorted(roots, key=lambda s: s['start_ns']):
+        walk(root, 0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', nargs='?', default=TRACING_FILE, help='span file written by the file exporter')
+    parser.add_argument('--user', help='only traces with a span tagged enduser.id=USER')
+    parser.add_argument('--trace-id', help='only this trace')
+    args = parser.parse_args(argv)
+
+    traces = {}
+    for span in load_spans(args.path):
+        traces.setdefault(span['trace_id'], []).append(span)
+    for trace_id, spans in traces.items():
+        if args.trace_id and trace_id != args.trace_id:
+            continue
+        if args.user and not any(span['attributes'].get('enduser.id') == args.user for span in spans):
+            continue
+        total = (max(s['end_ns'] for s in spans) - min(s['start_ns'] for s in spans)) / 1e6
+        print(f"trace {trace_id} ({len(spans)} spans, {total:.1f} ms end to end)")
+        print_trace(spans)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+Bulk lookup of what is stored for a list of users, for the help desk and agency admins.
+
+Each query is an email or a portal username. Queries are read in batches of USER_STATE_BATCH_SIZE;
+per batch the username aliases, the user records and, for users not migrated yet, the legacy
+user-auth-access / user-email-to-user-groups / username-to-email keys are each read in one
+pipelined round trip. Results are yielded as NDJSON, one line per query in input order, so memory
+stays flat however many users are asked for:
+
+    {"query": "jdoe", "email": "jdoe@usgs.gov", "username": "jdoe", "found": true, "source": "record",
+     "auth_access": {"is_disallowed": false, "has_selected_group": false}, "user_groups": null}
+
+    python user_state.py jdoe@usgs.gov jdoe_usgs          # queries as arguments
+    python user_state.py --file users.txt > states.ndjson  # one query per line (or NDJSON {"email": ...})
+    cut -d, -f1 users.csv | python user_state.py --file -
+
+The same stream is served by POST /admin/user_state (Authorization: Bearer <ADMIN_API_TOKEN>) with
+one query per line, or a JSON {"queries": [...]}, as the body.
+"""
+import argparse
+import hmac
+import json
+import logging
+import sys
+import time
+from itertools import islice
+
+from flask import Blueprint, Response, abort, jsonify, request, stream_with_context
+
+from config import ADMIN_API_TOKEN, USER_STATE_BATCH_SIZE, USER_STATE_MAX_QUERIES
+from redis_helpers import get_user_records_bulk, get_username_emails_bulk
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./user_state.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+user_state_blueprint = Blueprint('user_state', __name__)
+
+
+def parse_query(line):
+    """A query from one input line: a bare email or username, or an NDJSON object with either."""
+    line = line.strip()
+    if line.startswith('{'):
+        item = json.loads(line)
+        line = (item.get('email') or item.get('username') or '').strip()
+    if line.lower() in ('email', 'username'):
+        return None  # CSV-style header
+    return line or None
+
+
+def lookup_batch(queries):
+    """Yield the state of each query, in order, after two to four pipelined round trips."""
+    usernames = sorted({query for query in queries if '@' not in query})
+    username_emails = dict(zip(usernames, get_username_emails_bulk(usernames))) if usernames else {}
+    emails = [query if '@' in query else username_emails.get(query) for query in queries]
+    known = [email for email in emails if email]
+    records = dict(zip(known, get_user_records_bulk(known))) if known else {}
+
+    for query, email in zip(queries, emails):
+        record = records.get(email) if email else None
+        yield {
+            'query': query,
+            'email': email,
+            'username': (record or {}).get('username') or (query if '@' not in query else None),
+            'found': record is not None,
+            'source': ('legacy' if record.get('legacy') else 'record') if record is not None else None,
+            'auth_access': (record or {}).get('auth_access'),
+            'user_groups': (record or {}).get('user_groups'),
+        }
+
+
+def iter_user_states(queries, batch_size=USER_STATE_BATCH_SIZE):
+    """Yield the state of every query; `queries` may be any iterable and is consumed one batch at a time."""
+    queries = iter(queries)
+    while True:
+        batch = list(islice(queries, batch_size))
+        if not batch:
+            return
+        yield from lookup_batch(batch)
+
+
+def ndjson_line(state):
+    return json.dumps(state, separators=(',', ':')) + '\n'
+
+
+# Admin endpoint
+
+def require_admin_token():
+    auth_header = request.headers.get('Authorization', '')
+    token = auth_header[7:] if auth_header.startswith('Bearer ') else ''
+    if not ADMIN_API_TOKEN or not token or not hmac.compare_digest(token, ADMIN_API_TOKEN):
+        abort(403)
+
+
+def _request_queries():
+    if request.is_json:
+        body = request.get_json(silent=True)
+        lines = body.get('queries') if isinstance(body, dict) else body
+        if not isinstance(lines, list):
+            raise ValueError('queries must be a list')
+    else:
+        lines = request.get_data(as_text=True).splitlines()
+    queries = [query for query in map(parse_query, map(str, lines)) if query]
+    if len(queries) > USER_STATE_MAX_QUERIES:
+        abort(413, f"At most {USER_STATE_MAX_QUERIES} queries per request")
+    return queries
+
+
+@user_state_blueprint.route('/admin/user_state', methods=['POST'])
+def user_state_route():
+    require_admin_token()
+    try:
+        queries = _request_queries()
+    except ValueError:
+        return jsonify({'error': 'Body must be one email or username per line, or {"queries": [...]}'}), 400
+    logger.info(f"User state query for {len(queries)} users from {request.remote_addr}")
+
+    def generate():
+        try:
+            for state in iter_user_states(queries):
+                yield ndjson_line(state)
+        except Exception as e:
+            # Headers are already sent; end the stream with an error line the client can detect
+            logger.error(f"User state query failed: {e}")
+            yield ndjson_line({'error': f"Redis error, results incomplete: {e}"})
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+# Command line
+
+def read_queries(paths, arguments):
+    yield from arguments
+    for path in paths:
+        f = sys.stdin if path == '-' else open(path)
+        try:
+            for line in f:
+                query = parse_query(line)
+                if query:
+                    yield query
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('queries', nargs='*', help='emails or usernames')
+    parser.add_argument('--file', action='append', default=[], help="file of queries, one per line ('-' for stdin)")
+    parser.add_argument('--batch-size', type=int, default=USER_STATE_BATCH_SIZE)
+    args = parser.parse_args(argv)
+    if not args.queries and not args.file:
+        parser.error('give queries as arguments or with --file')
+
+    start = time.perf_counter()
+    total = found = 0
+    for state in iter_user_states(read_queries(args.file, args.queries), args.batch_size):
+        sys.stdout.write(ndjson_line(state))
+        total += 1
+        found += state['found']
+    elapsed = time.perf_counter() - start
+    sys.stderr.write(f"{total} queries, {found} found, {total - found} not found in {elapsed:.2f}s "
+                     f"({total / max(elapsed, 1e-9):.0f} users/s)\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
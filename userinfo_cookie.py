@@ -0,0 +1,76 @@
+import secrets
+import time
+from datetime import datetime, timezone
+
+from itsdangerous import BadSignature, Signer
+
+from codec import decode
+from config import FLASK_SECRET_KEY, LazyResource, USERINFO_LEGACY_COOKIES_UNTIL
+from redis_helpers import put_login_userinfo, get_login_userinfo
+
+
+def _create_signer():
+    if not FLASK_SECRET_KEY:
+        raise RuntimeError("FLASK_SECRET_KEY must be set to sign userinfo cookies")
+    return Signer(FLASK_SECRET_KEY, salt='userinfo-cookie')
+
+
+def _parse_sunset(value):
+    if not value:
+        return 0.0
+    sunset = datetime.fromisoformat(value)
+    if sunset.tzinfo is None:
+        sunset = sunset.replace(tzinfo=timezone.utc)
+    return sunset.timestamp()
+
+
+# The `userinfo` cookie carries only a signed random handle; the userinfo itself stays in
+# Redis (login-userinfo:<handle>) for USERINFO_COOKIE_TTL_SECONDS. The signer is resolved in
+# init_resources so a missing FLASK_SECRET_KEY fails at startup rather than at the first login.
+signer = LazyResource(_create_signer, cls=Signer)
+legacy_cookies_until = _parse_sunset(USERINFO_LEGACY_COOKIES_UNTIL)
+
+
+def issue_userinfo_cookie(userinfo):
+    """Store userinfo server-side and return the signed handle to put in the cookie."""
+    handle, cookie = new_userinfo_cookie()
+    put_login_userinfo(handle, userinfo)
+    return cookie
+
+
+def new_userinfo_cookie():
+    """(handle, cookie value) for userinfo the caller stores under the handle."""
+    handle = secrets.token_urlsafe(16)
+    return handle, signer.sign(handle).decode()
+
+
+def is_legacy_userinfo_cookie(cookie):
+    """Cookies issued before the handle was introduced hold the userinfo JSON itself."""
+    return bool(cookie) and cookie.lstrip('"').startswith('{')
+
+
+def legacy_userinfo(cookie, now=None):
+    """
+    The userinfo in a legacy JSON cookie, or None once USERINFO_LEGACY_COOKIES_UNTIL has passed
+    (or was never set). Legacy cookies are unsigned, so they are only honored during the rollout.
+    """
+    now = time.time() if now is None else now
+    return decode(cookie) if now < legacy_cookies_until else None
+
+
+def load_userinfo_cookie(cookie):
+    """Return the userinfo dict referenced by a cookie, or None if it is missing, forged or expired."""
+    if not cookie:
+        return None
+    if is_legacy_userinfo_cookie(cookie):
+        return legacy_userinfo(cookie)
+    handle = userinfo_cookie_handle(cookie)
+    return get_login_userinfo(handle) if handle else None
+
+
+def userinfo_cookie_handle(cookie):
+    """The handle in a signed cookie, or None if the signature does not match."""
+    try:
+        return signer.unsign(cookie).decode()
+    except BadSignature:
+        return None
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import logging
+import threading
+
+from metrics import WEBHOOK_EVENTS
+
+from redis_helpers import (
+    put_webhook_event_if_absent, delete_webhook_event,
+    get_user_group_assignment, put_user_group_assignment
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./webhook_idempotency.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+_lock = threading.Lock()
+counters = {
+    'events_checked': 0,
+    'events_suppressed': 0,
+    'assignments_checked': 0,
+    'assignments_suppressed': 0,
+}
+
+
+def _count(name, amount=1):
+    with _lock:
+        counters[name] += amount
+
+
+def event_idempotency_key(event):
+    """
+    Key identifying a webhook delivery. ArcGIS retries resend the same event, so an explicit
+    event id is used when present, otherwise (user, operation, timestamp). Note that `id` on
+    user events is the username, not an event id. Without a timestamp, (user, operation) would
+    match every later event of that kind, so the whole payload is hashed instead.
+    """
+    if event.get('eventId'):
+        return str(event['eventId'])
+    user_key = event.get('username') or event.get('id')
+    if event.get('when') in (None, ''):
+        payload = json.dumps(event, sort_keys=True, separators=(',', ':'), default=str)
+        return f"{user_key}:{event.get('operation')}:sha256-{hashlib.sha256(payload.encode()).hexdigest()}"
+    return f"{user_key}:{event.get('operation')}:{event['when']}"
+
+
+def claim_event(event):
+    """Returns True if this event has not been seen before and should be processed."""
+    _count('events_checked')
+    if put_webhook_event_if_absent(event_idempotency_key(event)):
+        return True
+    _count('events_suppressed')
+    WEBHOOK_EVENTS.labels('suppressed').inc()
+    logger.info(f"Suppressed duplicate webhook event: {event_idempotency_key(event)}")
+    return False
+
+
+def release_event(event):
+    """Forget a claimed event so that an ArcGIS retry is processed after a failure."""
+    delete_webhook_event(event_idempotency_key(event))
+
+
+def is_assignment_satisfied(username, group_titles):
+    """Returns True if the user was already added to exactly these groups."""
+    _count('assignments_checked')
+    assigned = get_user_group_assignment(username)
+    if assigned is not None and assigned == sorted(group_titles):
+        _count('assignments_suppressed')
+        WEBHOOK_EVENTS.labels('assignment_suppressed').inc()
+        logger.info(f"Group assignment for {username} already satisfied: {group_titles}")
+        return True
+    return False
+
+
+def mark_assignment_satisfied(username, group_titles):
+    put_user_group_assignment(username, group_titles)
+
+
+def stats():
+    with _lock:
+        snapshot = dict(counters)
+    checked = snapshot['events_checked']
+    snapshot['event_suppression_rate'] = round(snapshot['events_suppressed'] / checked, 4) if checked else 0.0
+    return snapshot
@@ -0,0 +1,170 @@
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
+from collections import deque
+
+import webhook_idempotency
+from config import WEBHOOK_QUEUE_SIZE, WEBHOOK_WORKERS
+from metrics import WEBHOOK_EVENTS, WEBHOOK_EVENT_LATENCY
+from manage_arcgis_user_groups_helper_functions import group_events_by_user, process_webhook_event
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler('./webhook_processor.log', delay=True)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+LATENCY_SAMPLE_SIZE = 1000
+
+
+class WebhookProcessor:
+    """
+    Bounded in-process worker pool for ArcGIS webhook events.
+
+    Each worker has its own queue and every event for a user goes to the same worker (keyed
+    by username), so a user's events run in arrival order even across payloads, while
+    different users are processed concurrently. `submit` rejects a whole payload when the
+    queues cannot hold it, so the caller can answer 429 and let ArcGIS retry.
+    Workers are started lazily in the process that first submits (i.e. after fork).
+    """
+
+    def __init__(self, handler=process_webhook_event, max_queue_size=WEBHOOK_QUEUE_SIZE, workers=WEBHOOK_WORKERS):
+        self.handler = handler
+        self.max_queue_size = max_queue_size
+        self.workers = workers
+        self._queues = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self.running = True
+        self._busy_workers = 0
+        self._latencies = deque(maxlen=LATENCY_SAMPLE_SIZE)
+        self.counters = {
+            'received': 0,
+            'collapsed': 0,
+            'processed': 0,
+            'failed': 0,
+            'dropped': 0,
+        }
+
+    def _ensure_workers(self):
+        if self._pid == os.getpid():
+            return
+        # The total is bounded by the depth check in submit
+        self._queues = [queue.Queue() for _ in range(self.workers)]
+        self._busy_workers = 0
+        for i, work_queue in enumerate(self._queues):
+            threading.Thread(target=self._work, args=(work_queue,), name=f'webhook-worker-{i}', daemon=True).start()
+        self._pid = os.getpid()
+
+    def _queue_for(self, user_key):
+        return self._queues[zlib.crc32(str(user_key).encode()) % len(self._queues)]
+
+    def submit(self, data):
+        """
+        Queue every user event in a webhook payload.
+        Returns (accepted, number_of_events); accepted is False when the pool is saturated or stopped.
+        """
+        user_events, collapsed = group_events_by_user(data)
+        event_count = sum(len(events) for _, events in user_events)
+        with self._lock:
+            self.counters['received'] += event_count + collapsed
+            self.counters['collapsed'] += collapsed
+            WEBHOOK_EVENTS.labels('received').inc(event_count + collapsed)
+            WEBHOOK_EVENTS.labels('collapsed').inc(collapsed)
+            if not self.running:
+                self.counters['dropped'] += event_count
+                WEBHOOK_EVENTS.labels('dropped').inc(event_count)
+                return False, event_count
+            self._ensure_workers()
+            if self.queue_depth() + len(user_events) > self.max_queue_size:
+                self.counters['dropped'] += event_count
+                WEBHOOK_EVENTS.labels('dropped').inc(event_count)
+                logger.warning(f"Webhook queue saturated ({self.queue_depth()}/{self.max_queue_size}), "
+                               f"rejecting {event_count} events")
+                return False, event_count
+            enqueued_at = time.monotonic()
+            for user_key, events in user_events:
+                self._queue_for(user_key).put_nowait((enqueued_at, user_key, events))
+        return True, event_count
+
+    def _work(self, work_queue):
+        while True:
+            enqueued_at, user_key, events = work_queue.get()
+            with self._lock:
+                self._busy_workers += 1
+            try:
+                for event in events:
+                    try:
+                        self.handler(event)
+                        self._record('processed', enqueued_at)
+                    except Exception as e:
+                        self._record('failed', enqueued_at)
+                        logger.error(f"Failed to process webhook event for {user_key}: {e}", exc_info=True)
+            finally:
+                with self._lock:
+                    self._busy_workers -= 1
+                work_queue.task_done()
+
+    def _record(self, outcome, enqueued_at):
+        latency = time.monotonic() - enqueued_at
+        with self._lock:
+            self.counters[outcome] += 1
+            self._latencies.append(latency)
+        WEBHOOK_EVENTS.labels(outcome).inc()
+        WEBHOOK_EVENT_LATENCY.observe(latency)
+
+    def queue_depth(self):
+        return sum(work_queue.qsize() for work_queue in self._queues)
+
+    def busy_workers(self):
+        return self._busy_workers
+
+    def join(self, timeout=None):
+        """Wait until every accepted event has been handled. Returns False if `timeout` ran out first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for work_queue in self._queues:
+            with work_queue.all_tasks_done:
+                while work_queue.unfinished_tasks:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    work_queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stop(self, timeout=0):
+        """
+        Stop accepting new payloads and wait up to `timeout` seconds for the accepted events,
+        since the workers are daemon threads and die with the process. Returns True when drained.
+        """
+        self.running = False
+        if self._pid != os.getpid():
+            return True
+        drained = self.join(timeout)
+        if not drained:
+            logger.error(f"Stopped with {self.queue_depth()} queued and {self._busy_workers} running "
+                         f"webhook payloads after waiting {timeout}s")
+        return drained
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        def percentile(p):
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))], 4) if latencies else None
+        return {
+            **self.counters,
+            **webhook_idempotency.stats(),
+            'queue_depth': self.queue_depth(),
+            'queue_capacity': self.max_queue_size,
+            'busy_workers': self._busy_workers,
+            'workers': self.workers,
+            'latency_seconds_p50': percentile(0.50),
+            'latency_seconds_p95': percentile(0.95),
+            'latency_seconds_p99': percentile(0.99),
+        }
+
+
+webhook_processor = WebhookProcessor()